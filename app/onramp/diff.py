@@ -4,386 +4,739 @@ From OSMExpress https://github.com/protomaps/osmexpress Copyright 2019 Protomaps
 All rights reserved. Licensed under 2-Clause BSD, see LICENSE
 
 """
-from collections import namedtuple
-import copy
 from datetime import datetime
+from functools import partial
+from itertools import chain
 import logging
+from math import ceil
+import multiprocessing
 import sys
+import time
 
 import osmx
 import xml.etree.ElementTree as ET
 
-from .geometry import Bounds
-from .utils import indent
-from .xml_writers import write_xml
+from .geometry import CoordinateStore, Geometry
+from .lookup import OsmxLookup
+from .metrics import Metrics
+from .model import DiffAction, json_line, Member, OsmElement, SerializedActions
+from .osc import read_actions
+from .propagation import DEFAULT_RELATION_DEPTH, Propagation
+from .regions import RegionFilter, RegionIndex
+from .xml_writers import BackgroundTreeWriter, is_ndjson, StreamingTree, write_xml
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 logger.addHandler(logging.StreamHandler(sys.stdout))
 
+# Order of the sections of an augmented diff
+OSM_TYPES = ("node", "way", "relation")
 
-def augmented_diff(
-    osmx_file,
-    osc_file,
-    output_file,
-    end_timestamp=None,
-    osc_sequence=None,
-    osc_url=None,
-):
-    """ Generate an OSM Augmented Diff using osmx_file and osc_file
+# Number of chunks each section is split into per worker process in parallel mode
+CHUNKS_PER_PROCESS = 4
 
-    end_timestamp is the timestamp of the end of the time range in the osc_file.
+# Number of serialized actions handed to the region writers at a time in serial mode
+REGION_CHUNK_SIZE = 256
 
-    Result written as xml to output_file, which can be a local file or S3 URI.
+# osmx.Environment of each osmx file opened by this process, see open_environment
+_environments = {}
 
-    See https://wiki.openstreetmap.org/wiki/Overpass_API/Augmented_Diffs
-    This function should be called on an osmx_file that hasn't yet had osc_file
-    written to it.
+
+def open_environment(osmx_file):
+    """ Return an osmx.Environment for osmx_file, reusing one opened earlier
+
+    Keeping the environment open lets a long running process such as
+    osmx-update --daemon skip reopening the db for every diff. Each transaction
+    still sees the latest commit.
 
     """
+    env = _environments.get(osmx_file)
+    if env is None:
+        env = osmx.Environment(osmx_file)
+        _environments[osmx_file] = env
+    return env
 
-    # 1st pass:
-    # populate the collection of actions
-    # create dictionary from osm_type/osm_id to action
-    # e.g. node/12345 > Node()
-    Action = namedtuple("Action", ["type", "element"])
-    actions = {}
-
-    osc = ET.parse(osc_file).getroot()
-    for block in osc:
-        for e in block:
-            action_key = e.tag + "/" + e.get("id")
-            if action_key in actions:
-                old_action = actions[action_key]
-                old_version = int(old_action.element.get("version"))
-                new_version = int(e.get("version"))
-                # Remove elements created and then deleted in the same interval
-                # TODO: This will not capture any element that is also modified
-                #       between create and delete.
-                if old_action.type == "create" and block.tag == "delete":
-                    logger.warning(
-                        "Skipping element {} which was created and deleted within the interval".format(
-                            action_key
-                        )
-                    )
-                    del actions[action_key]
-                    continue
-                # Always ensure we're updating to the latest version of an object for the diff
-                elif new_version < old_version:
-                    logger.warning(
-                        "Skipping element {}, new version {} is older than version {}".format(
-                            action_key, new_version, old_version
-                        )
-                    )
-                    continue
-            actions[action_key] = Action(block.tag, e)
-
-    action_list = [v for k, v in actions.items()]
-
-    env = osmx.Environment(osmx_file)
-    with osmx.Transaction(env) as txn:
-        locations = osmx.Locations(txn)
-        nodes = osmx.Nodes(txn)
-        ways = osmx.Ways(txn)
-        relations = osmx.Relations(txn)
-
-        def not_in_db(elem):
-            elem_id = int(elem.get("id"))
-            if elem.tag == "node":
-                return not locations.get(elem_id)
-            elif elem.tag == "way":
-                return not ways.get(elem_id)
-            else:
-                return not relations.get(elem_id)
-
-        def rebuild_old_element(elem):
-            elem_id = int(elem.get("id"))
-            if elem.tag == "node":
-                o = nodes.get(elem_id)
-                if o is not None:
-                    it = iter(o.tags)
-                    for t in it:
-                        tag = ET.SubElement(elem, "tag")
-                        tag.set("k", t)
-                        tag.set("v", next(it))
-            elif elem.tag == "way":
-                o = ways.get(elem_id)
-                for n in o.nodes:
-                    node = ET.SubElement(elem, "nd")
-                    node.set("ref", str(n))
-                it = iter(o.tags)
-                for t in it:
-                    tag = ET.SubElement(elem, "tag")
-                    tag.set("k", t)
-                    tag.set("v", next(it))
-            else:
-                o = relations.get(elem_id)
-                for m in o.members:
-                    member = ET.SubElement(elem, "member")
-                    member.set("ref", str(m.ref))
-                    member.set("role", m.role)
-                    member.set("type", str(m.type))
-                it = iter(o.tags)
-                for t in it:
-                    tag = ET.SubElement(elem, "tag")
-                    tag.set("k", t)
-                    tag.set("v", next(it))
-
-            if o:
-                # Set metadata
-                elem.set("version", str(o.metadata.version))
-                elem.set("user", str(o.metadata.user))
-                elem.set("uid", str(o.metadata.uid))
-                timestamp = o.metadata.timestamp
-                formatted = datetime.utcfromtimestamp(timestamp).isoformat()
-                elem.set("timestamp", formatted + "Z")
-                elem.set("changeset", str(o.metadata.changeset))
-            else:
-                # tagless nodes
-                loc = locations.get(elem_id)
-                version = loc[2] if loc else "0"
-                elem.set("version", str(version))
-                elem.set("user", "")
-                elem.set("uid", "0")
-                elem.set("timestamp", "1970-01-01T00:00:00Z")
-                elem.set("changeset", "0")
-
-        # 2nd pass
-        # create an XML tree of actions with old and new sub-elements
-        o = ET.Element("osm")
-        o.set("version", "0.6")
-        o.set(
-            "generator",
-            "Overpass API not used, but achavi detects it at the start of string; https://github.com/azavea/onramp",
-        )
 
-        for action in action_list:
-            # This occurs when an element is created and then deleted before the end of the
-            # temporal window we're diffing
-            if not_in_db(action.element) and action.type == "delete":
-                logger.warning(
-                    "Could not find {} {} in db, skipping".format(
-                        action.element.tag, action.element.get("id")
-                    )
-                )
+def tag_list(tags):
+    """ Convert a flat osmx tag list [k1, v1, k2, v2, ...] to [(k1, v1), (k2, v2), ...] """
+    it = iter(tags)
+    return list(zip(it, it))
+
+
+class DiffBuilder:
+    """ Build the actions of an augmented diff from osc actions and an osmx.Transaction
+
+    actions: dictionary from (osm_type, osm_id) to osc.Action, see osc.read_actions
+    overlay: optional overlay.Overlay of changes to read on top of the db
+    metrics: optional metrics.Metrics that the time spent in each pass is added to
+    relation_depth: levels of parent relations that changes propagate to, see
+                    propagation.Propagation
+    way_cache: optional geometry.WayGeometryCache of way geometries kept from earlier
+               diffs, which relation members are read from and added to
+    geometry_budget: optional number of way member locations that a relation element
+                     can have, see limit_geometry()
+    regions: optional regions.RegionIndex, the diff then only has the actions in its
+             regions and the elements they affect, see prune()
+
+    Use sorted_actions() to build the whole diff, or finish() to build part of a section
+    in parallel mode.
+
+    """
+
+    def __init__(
+        self,
+        actions,
+        txn,
+        overlay=None,
+        metrics=None,
+        relation_depth=DEFAULT_RELATION_DEPTH,
+        way_cache=None,
+        geometry_budget=None,
+        regions=None,
+    ):
+        self.actions = actions
+        # Actions that are written and propagated from, the others only set the new
+        # state of the elements they change
+        self.selected = actions
+        self.regions = regions
+        self.relation_depth = relation_depth
+        self.way_cache = way_cache
+        self.geometry_budget = geometry_budget
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.db = OsmxLookup(txn, overlay=overlay)
+        self.locations = self.db.locations
+        self.nodes = self.db.nodes
+        self.ways = self.db.ways
+        self.relations = self.db.relations
+
+        # Locations of way nodes are added to the store once each and shared by every
+        # geometry that contains them, separately for the old and new state of the db
+        self.store = CoordinateStore()
+        self.old_positions = {}
+        self.new_positions = {}
+
+        # Complete geometries of relation member ways by (way id, use_new), shared by
+        # every relation in the diff that has the way as a member
+        self.way_geometries = {}
+        self.way_geometry_stats = {"lookups": 0, "hits": 0, "reads": 0, "skipped": 0}
+
+        # Ways and relations that aren't in actions but are changed by them, see 4th pass
+        # and propagate()
+        self.affected_ways = set()
+        self.affected_relations = set()
+
+    def not_in_db(self, elem):
+        if elem.type == "node":
+            return not self.locations.get(elem.id)
+        elif elem.type == "way":
+            return not self.ways.get(elem.id)
+        else:
+            return not self.relations.get(elem.id)
+
+    def rebuild_old_element(self, elem):
+        if elem.type == "node":
+            o = self.nodes.get(elem.id)
+            if o is not None:
+                elem.tags = tag_list(o.tags)
+        elif elem.type == "way":
+            o = self.ways.get(elem.id)
+            elem.nds = list(o.nodes)
+            elem.tags = tag_list(o.tags)
+        else:
+            o = self.relations.get(elem.id)
+            elem.members = [Member(str(m.type), m.ref, m.role) for m in o.members]
+            elem.tags = tag_list(o.tags)
+
+        if o:
+            # Set metadata
+            elem.set("version", o.metadata.version)
+            elem.set("user", str(o.metadata.user))
+            elem.set("uid", o.metadata.uid)
+            timestamp = o.metadata.timestamp
+            formatted = datetime.utcfromtimestamp(timestamp).isoformat()
+            elem.set("timestamp", formatted + "Z")
+            elem.set("changeset", o.metadata.changeset)
+        else:
+            # tagless nodes
+            loc = self.locations.get(elem.id)
+            version = loc[2] if loc else 0
+            elem.set("version", version)
+            elem.set("user", "")
+            elem.set("uid", 0)
+            elem.set("timestamp", "1970-01-01T00:00:00Z")
+            elem.set("changeset", 0)
+
+    # 2nd pass
+    # create an action with old and new elements
+    def build_action(self, action):
+        elem = action.element
+        # This occurs when an element is created and then deleted before the end of the
+        # temporal window we're diffing
+        if self.not_in_db(elem) and action.type == "delete":
+            logger.warning("Could not find {} {} in db, skipping".format(elem.type, elem.id))
+            return None
+        if action.type == "create":
+            return DiffAction("create", None, elem)
+        elif action.type == "delete":
+            # get the old metadata
+            modified = elem.copy()
+            self.rebuild_old_element(elem)
+
+            modified.set("visible", "false")
+            modified.nds = []
+            modified.members = []
+            modified.tags = []
+            # TODO: The Geofabrik deleted elements seem to have the old metadata and
+            # old version numbers. Check if this is true of planet replication files
+            return DiffAction("delete", elem, modified)
+        elif self.not_in_db(elem):
+            # Typically occurs when:
+            #  1. (TODO) An element is deleted but then restored later,
+            #     which should remain a modify operation. This will be difficult
+            #     because objects are not retained in OSMX when deleted in OSM.
+            #  2. (OK) An element was created and then modified within the diff interval
+            logger.warning(
+                "Could not find {0} {1} in db, changing to create".format(elem.type, elem.id)
+            )
+            return DiffAction("create", None, elem)
+        else:
+            prev_version = OsmElement(elem.type, elem.id)
+            self.rebuild_old_element(prev_version)
+            return DiffAction("modify", prev_version, elem)
+
+    # 3rd pass
+    # Augment the created "old" and "new" elements
+    def get_lon_lat(self, ref, use_new):
+        if use_new and ("node", ref) in self.actions:
+            node = self.actions[("node", ref)].element
+            return (float(node.lon), float(node.lat))
+        else:
+            ll = self.locations.get(ref)
+            return (ll[1], ll[0])
+
+    def find_lon_lat(self, ref, use_new):
+        try:
+            return self.get_lon_lat(ref, use_new)
+        # If we fail to retrieve a location, it typically means that the OSMX db only
+        # contains locations for a bounding box and we've requested a location that
+        # was trimmed during import.
+        # If you see this error, verify this and if not, open an issue!
+        except TypeError:
+            logger.warning("No loc found for node {}".format(ref))
+            return None
+
+    def get_position(self, ref, use_new):
+        index = self.new_positions if use_new else self.old_positions
+        try:
+            return index[ref]
+        except KeyError:
+            pass
+        if use_new and ("node", ref) not in self.actions:
+            position = self.get_position(ref, False)
+        else:
+            position = self.store.add(*self.get_lon_lat(ref, use_new))
+        index[ref] = position
+        return position
+
+    def find_position(self, ref, use_new):
+        try:
+            return self.get_position(ref, use_new)
+        except TypeError:
+            logger.warning("No loc found for node {}".format(ref))
+            return None
+
+    def way_positions(self, way_id, use_new, positions):
+        """ Append the positions of the nodes of way way_id to positions
+
+        Raises TypeError or AttributeError if the way or a node location isn't in the db,
+        with the positions found before it already appended.
+
+        """
+        changed = use_new and ("way", way_id) in self.actions
+        if changed:
+            node_ids = self.actions[("way", way_id)].element.nds
+        else:
+            cached = self.way_cache.get(way_id) if self.way_cache is not None else None
+            if cached is not None:
+                self.way_geometry_stats["hits"] += 1
+                self.cached_way_positions(cached, use_new, positions)
+                return
+            node_ids = self.ways.get(way_id).nodes
+        index = self.new_positions if use_new else self.old_positions
+        try:
+            positions.extend([index[node_id] for node_id in node_ids])
+        except KeyError:
+            # Don't use find_position, a missing location makes the member incomplete
+            for node_id in node_ids:
+                positions.append(self.get_position(node_id, use_new))
+        self.way_geometry_stats["reads"] += 1
+
+        # Only the db state of a way is kept for later diffs
+        if self.way_cache is not None and not (
+            changed or (use_new and any(("node", n) in self.actions for n in node_ids))
+        ):
+            self.way_cache.put(
+                way_id,
+                node_ids,
+                map(self.store.lons.__getitem__, positions),
+                map(self.store.lats.__getitem__, positions),
+            )
+
+    def cached_way_positions(self, cached, use_new, positions):
+        """ Append the positions of a way in a WayGeometryCache to positions """
+        node_ids, lons, lats = cached
+        for node_id, lon, lat in zip(node_ids, lons, lats):
+            if use_new and ("node", node_id) in self.actions:
+                positions.append(self.get_position(node_id, True))
                 continue
-            a = ET.SubElement(o, "action")
-            a.set("type", action.type)
-            if action.type == "create":
-                a.append(action.element)
-            elif action.type == "delete":
-                old = ET.SubElement(a, "old")
-                new = ET.SubElement(a, "new")
-                # get the old metadata
-                modified = copy.deepcopy(action.element)
-                rebuild_old_element(action.element)
-                old.append(action.element)
-
-                modified.set("visible", "false")
-                for child in list(modified):
-                    modified.remove(child)
-                # TODO: The Geofabrik deleted elements seem to have the old metadata and
-                # old version numbers. Check if this is true of planet replication files
-                new.append(modified)
-            elif not_in_db(action.element):
-                # Typically occurs when:
-                #  1. (TODO) An element is deleted but then restored later,
-                #     which should remain a modify operation. This will be difficult
-                #     because objects are not retained in OSMX when deleted in OSM.
-                #  2. (OK) An element was created and then modified within the diff interval
-                logger.warning(
-                    "Could not find {0} {1} in db, changing to create".format(
-                        action.element.tag, action.element.get("id")
-                    )
-                )
-                a.append(action.element)
-                a.set("type", "create")
-            else:
-                obj_id = action.element.get("id")
-                old = ET.SubElement(a, "old")
-                new = ET.SubElement(a, "new")
-                prev_version = ET.SubElement(old, action.element.tag)
-                prev_version.set("id", obj_id)
-                rebuild_old_element(prev_version)
-                new.append(action.element)
-
-        # 3rd pass
-        # Augment the created "old" and "new" elements
-        def get_lat_lon(ref, use_new):
-            if use_new and ("node/" + ref in actions):
-                node = actions["node/" + ref]
-                lon = "{:.07f}".format(float(node.element.get("lon")))
-                lat = "{:.07f}".format(float(node.element.get("lat")))
-                return (lon, lat)
-            else:
-                ll = locations.get(ref)
-                return ("{:.07f}".format(ll[1]), "{:.07f}".format(ll[0]))
+            try:
+                position = self.old_positions[node_id]
+            except KeyError:
+                position = self.old_positions[node_id] = self.store.add(lon, lat)
+            positions.append(position)
 
-        def augment_nd(nd, use_new, id_field="id"):
-            nd_id = nd.get(id_field)
+    def augment_member(self, mem, use_new):
+        if mem.type == "way":
+            self.way_geometry_stats["lookups"] += 1
+            key = (mem.ref, use_new)
             try:
-                ll = get_lat_lon(nd_id, use_new)
-                nd.set("lon", ll[0])
-                nd.set("lat", ll[1])
-            # If we fail to retrieve a location, it typically means that the OSMX db only
-            # contains locations for a bounding box and we've requested a location that
-            # was trimmed during import.
-            # If you see this error, verify this and if not, open an issue!
-            except TypeError:
-                logger.warning("No loc found for node {}".format(nd_id))
-
-        def augment_member(mem, use_new):
-            if mem.get("type") == "way":
-                ref = mem.get("ref")
-                if use_new and ("way/" + ref in actions):
-                    way = actions["way/" + ref]
-                    for child in way.element:
-                        if child.tag == "nd":
-                            # Don't use augment_nd because no ref on member nd children
-                            ll = get_lat_lon(child.get("ref"), use_new)
-                            nd = ET.SubElement(mem, "nd")
-                            nd.set("lon", ll[0])
-                            nd.set("lat", ll[1])
-                else:
-                    for node_id in ways.get(ref).nodes:
-                        # Don't use augment_nd because no ref on member nd children
-                        ll = get_lat_lon(str(node_id), use_new)
-                        nd = ET.SubElement(mem, "nd")
-                        nd.set("lon", ll[0])
-                        nd.set("lat", ll[1])
-            elif mem.get("type") == "node":
-                augment_nd(mem, use_new, id_field="ref")
-
-        def augment(elem, use_new):
-            if elem.tag == "node":
-                augment_nd(elem, use_new, id_field="id")
-            elif elem.tag == "way":
-                for child in elem:
-                    if child.tag == "nd":
-                        augment_nd(child, use_new, id_field="ref")
-            elif elem.tag == "relation":
-                for child in elem:
-                    if child.tag == "member":
-                        augment_member(child, use_new)
-
-        for elem in o:
+                mem.geometry = Geometry(self.store, self.way_geometries[key])
+                self.way_geometry_stats["hits"] += 1
+                return
+            except KeyError:
+                pass
+            positions = []
+            mem.geometry = Geometry(self.store, positions)
+            self.way_positions(mem.ref, use_new, positions)
+            self.way_geometries[key] = positions
+        elif mem.type == "node":
+            ll = self.find_lon_lat(mem.ref, use_new)
+            if ll is not None:
+                mem.lon, mem.lat = ll
+
+    def augment(self, elem, use_new):
+        if elem.type == "node":
+            ll = self.find_lon_lat(elem.id, use_new)
+            if ll is not None:
+                elem.set("lon", ll[0])
+                elem.set("lat", ll[1])
+        elif elem.type == "way":
+            index = self.new_positions if use_new else self.old_positions
+            try:
+                positions = [index[ref] for ref in elem.nds]
+            except KeyError:
+                positions = [self.find_position(ref, use_new) for ref in elem.nds]
+            elem.geometry = Geometry(self.store, positions)
+        elif elem.type == "relation":
             try:
-                if elem.get("type") == "create":
-                    augment(elem[0], True)
+                if self.geometry_budget is None:
+                    for member in elem.members:
+                        self.augment_member(member, use_new)
                 else:
-                    augment(elem[0][0], False)
-                    augment(elem[1][0], True)
-            except (TypeError, AttributeError):
-                logger.warning(
-                    "Changed {0} {1} is incomplete in db".format(
-                        elem[1][0].tag, elem[1][0].get("id")
-                    )
-                )
+                    self.augment_members_within_budget(elem, use_new)
+            finally:
+                if self.geometry_budget is not None:
+                    self.limit_geometry(elem)
 
-        # 4th pass:
-        # Find changes that propagate to referencing elements:
-        # When a node's location changes, that propagates to any ways it belongs to,
-        # relations it belongs to and also any relations that the way belongs to.
-        # When a way's member list changes, it propagates to any relations it belongs to.
-        node_way = osmx.NodeWay(txn)
-        node_relation = osmx.NodeRelation(txn)
-        way_relation = osmx.WayRelation(txn)
-
-        affected_ways = set()
-        affected_relations = set()
-        for elem in o:
-            if elem.get("type") == "modify":
-                if elem[0][0].tag == "node":
-                    old_loc = (elem[0][0].get("lat"), elem[0][0].get("lon"))
-                    new_loc = (elem[1][0].get("lat"), elem[1][0].get("lon"))
-                    if old_loc != new_loc:
-                        node_id = elem[0][0].get("id")
-                        for rel in node_relation.get(node_id):
-                            if "relation/" + str(rel) not in actions:
-                                affected_relations.add(rel)
-                        for way in node_way.get(node_id):
-                            if "way/" + str(way) not in actions:
-                                affected_ways.add(way)
-                                for rel in way_relation.get(way):
-                                    if "relation/" + str(rel) not in actions:
-                                        affected_relations.add(rel)
-
-                elif elem[0][0].tag == "way":
-                    old_way = [nd.get("ref") for nd in elem[0][0] if nd.tag == "nd"]
-                    new_way = [nd.get("ref") for nd in elem[1][0] if nd.tag == "nd"]
-                    if old_way != new_way:
-                        way_id = elem[0][0].get("id")
-                        for rel in way_relation.get(way_id):
-                            if "relation/" + str(rel) not in actions:
-                                affected_relations.add(rel)
-
-        for w in affected_ways:
-            a = ET.SubElement(o, "action")
-            a.set("type", "modify")
-            old = ET.SubElement(a, "old")
-            way_element = ET.SubElement(old, "way")
-            way_element.set("id", str(w))
-            rebuild_old_element(way_element)
-
-            new = ET.SubElement(a, "new")
-            new_elem = copy.deepcopy(way_element)
-            new.append(new_elem)
-            augment(way_element, use_new=False)
-            augment(new_elem, use_new=True)
-
-        for r in affected_relations:
-            old = ET.Element("old")
-            relation_element = ET.SubElement(old, "relation")
-            relation_element.set("id", str(r))
-            rebuild_old_element(relation_element)
-
-            new_elem = copy.deepcopy(relation_element)
-            new = ET.Element("new")
-            new.append(new_elem)
-            try:
-                augment(relation_element, False)
-                augment(new_elem, True)
+    def augment_members_within_budget(self, elem, use_new):
+        """ Augment the members of a relation element, adding the geometry of unchanged
+        way members only until it has more than geometry_budget locations
 
-                a = ET.SubElement(o, "action")
-                a.set("type", "modify")
-                a.append(old)
-                a.append(new)
-            except (TypeError, AttributeError):
-                # This happens when working with OSM subset and portion of relation is outside of crop BBOX
-                logger.warning("Affected relation {0} is incomplete in db".format(r))
+        The geometries of the unchanged way members after that aren't looked up at all,
+        so the db reads of a huge relation are bounded along with its output. They are
+        skipped whether or not they are already cached, so the output doesn't depend on
+        what earlier diffs, or other worker processes, have read.
 
-    # 5th pass: add bounding boxes
-    for child in o:
-        if len(child[0]) > 0:
-            if child.get("type") == "create":
-                osm_objs = [child[0]]
+        """
+        locations = 0
+        for member in elem.members:
+            if member.type != "way":
+                self.augment_member(member, use_new)
+            elif locations > self.geometry_budget and not self.member_changed(member):
+                self.way_geometry_stats["skipped"] += 1
+            else:
+                self.augment_member(member, use_new)
+                if member.geometry is not None:
+                    locations += len(member.geometry.positions)
+
+    def member_changed(self, member):
+        """ Whether a way member is changed by actions, itself or through its nodes """
+        return ("way", member.ref) in self.actions or member.ref in self.affected_ways
+
+    def limit_geometry(self, elem):
+        """ Keep a relation element's geometry within geometry_budget locations
+
+        Over the budget, only the way members that are changed keep their geometry. The
+        element's bounds are of every member whose geometry was added, see
+        augment_members_within_budget(), and it is marked truncated.
+
+        """
+        members = [m for m in elem.members if m.type == "way" and m.geometry is not None]
+        if sum(len(m.geometry.positions) for m in members) <= self.geometry_budget:
+            return
+        positions = elem.positions()
+        if positions:
+            elem.bounds = self.store.bounds(positions)
+        for member in members:
+            if not self.member_changed(member):
+                member.geometry = None
+        elem.set("truncated", "true")
+        self.metrics.truncated += 1
+
+    def augment_action(self, a):
+        try:
+            if a.type == "create":
+                self.augment(a.new, True)
             else:
-                osm_objs = [child[0][0], child[1][0]]
-            for osm_obj in osm_objs:
-                nds = osm_obj.findall(".//nd")
-                if nds:
-                    bounds = Bounds()
-                    for nd in nds:
-                        bounds.add(float(nd.get("lon")), float(nd.get("lat")))
+                self.augment(a.old, False)
+                self.augment(a.new, True)
+        except (TypeError, AttributeError):
+            logger.warning("Changed {0} {1} is incomplete in db".format(a.new.type, a.new.id))
+
+    # Drop the actions outside of every region, before anything is built from them
+    def prune(self):
+        with self.metrics.timer("prune"):
+            self.selected = RegionFilter(self.actions, self.db, self.regions).run()
+        self.metrics.set("adiff_pruned_actions", len(self.actions) - len(self.selected))
+
+    # 4th pass:
+    # Find changes that propagate to referencing elements:
+    # When a node's location changes, that propagates to any ways it belongs to,
+    # relations it belongs to and also any relations that the way belongs to.
+    # When a way's member list changes, it propagates to any relations it belongs to.
+    # Relations whose geometry changes propagate to their parent relations.
+    # This only reads the db, so it runs before any action is built.
+    def propagate(self):
+        with self.metrics.timer("propagate"):
+            self.affected_ways, self.affected_relations = Propagation(
+                self.actions, self.db, relation_depth=self.relation_depth, changes=self.selected
+            ).run()
+        self.metrics.propagated["way"] = len(self.affected_ways)
+        self.metrics.propagated["relation"] = len(self.affected_relations)
+
+    def affected_way_action(self, w):
+        way_element = OsmElement("way", w)
+        self.rebuild_old_element(way_element)
 
-                    osm_obj.insert(0, bounds.elem())
+        new_elem = way_element.copy()
+        self.augment(way_element, use_new=False)
+        self.augment(new_elem, use_new=True)
+        return DiffAction("modify", way_element, new_elem)
+
+    def affected_relation_action(self, r):
+        relation_element = OsmElement("relation", r)
+        self.rebuild_old_element(relation_element)
+
+        new_elem = relation_element.copy()
+        try:
+            self.augment(relation_element, False)
+            self.augment(new_elem, True)
+            return DiffAction("modify", relation_element, new_elem)
+        except (TypeError, AttributeError):
+            # This happens when working with OSM subset and portion of relation is outside of
+            # crop BBOX
+            logger.warning("Affected relation {0} is incomplete in db".format(r))
+            return None
+
+    # 5th pass: add bounding boxes
+    def add_bounds(self, a):
+        for osm_obj in a.elements():
+            # Bounds of a truncated relation include the geometry it was written without
+            if osm_obj.truncated:
+                continue
+            positions = osm_obj.positions()
+            if positions:
+                osm_obj.bounds = self.store.bounds(positions)
+
+    # Read everything a section will need from the db up front,
+    # in increasing id order for each table
+    def prefetch(self, osm_type, section):
+        elem_ids = [elem_id for elem_id, _ in section]
+        new_elements = [action.element for _, action in section if action is not None]
+
+        if osm_type == "node":
+            self.locations.prefetch(elem_ids)
+            self.nodes.prefetch(
+                elem_id for elem_id, action in section if action.type != "create"
+            )
+            return
+
+        if osm_type == "way":
+            way_ids = elem_ids
+            node_refs = [
+                ref for e in new_elements for ref in e.nds if ("node", ref) not in self.actions
+            ]
+        else:
+            self.relations.prefetch(elem_ids)
+            members = [(m.type, m.ref) for e in new_elements for m in e.members]
+            for elem_id in elem_ids:
+                relation = self.relations.peek(elem_id)
+                if relation is not None:
+                    members.extend((str(m.type), m.ref) for m in relation.members)
+            way_cache = self.way_cache if self.way_cache is not None else ()
+            # With a geometry budget, most unchanged member ways of a large relation are
+            # never read, so those it does read within the budget are left to augment
+            way_ids = [
+                ref
+                for member_type, ref in members
+                if member_type == "way"
+                and ("way", ref) not in self.actions
+                and ref not in way_cache
+                and (self.geometry_budget is None or ref in self.affected_ways)
+            ]
+            node_refs = [ref for member_type, ref in members if member_type == "node"]
+
+        self.ways.prefetch(way_ids)
+        for way_id in way_ids:
+            way = self.ways.peek(way_id)
+            if way is not None:
+                node_refs.extend(way.nodes)
+        self.locations.prefetch(node_refs)
+
+    def finish(self, osm_type, section):
+        """ Yield the finished DiffAction for each (osm_id, action) of a section
+
+        section is sorted by osm_id. action is None for a way or relation that is only
+        affected by other actions.
+
+        """
+        metrics = self.metrics
+        with metrics.timer("prefetch"):
+            self.prefetch(osm_type, section)
+        for elem_id, action in section:
+            if action is not None:
+                with metrics.timer("build"):
+                    a = self.build_action(action)
+                if a is None:
+                    continue
+                with metrics.timer("augment"):
+                    self.augment_action(a)
+            else:
+                with metrics.timer("affected"):
+                    if osm_type == "way":
+                        a = self.affected_way_action(elem_id)
+                    else:
+                        a = self.affected_relation_action(elem_id)
+                if a is None:
+                    continue
+            with metrics.timer("bounds"):
+                self.add_bounds(a)
+            metrics.count_action(a)
+            yield a
 
     # 6th pass
-    # sort by node, way, relation
-    # within each, sorted by increasing ID
-    def sort_by_id(x):
-        return int(x[0].get("id") if x.get("type") == "create" else x[1][0].get("id"))
-
-    def sort_by_type(x):
-        osm_element = x[0] if x.get("type") == "create" else x[1][0]
-        if osm_element.tag == "node":
-            return 1
-        elif osm_element.tag == "way":
-            return 2
-        return 3
-
-    o[:] = sorted(o, key=sort_by_id)
-    o[:] = sorted(o, key=sort_by_type)
+    # Emit actions sorted by node, way, relation and within each by increasing ID,
+    # including the ways and relations affected by the 4th pass.
+    def sorted_actions(self):
+        if self.regions is not None:
+            self.prune()
+        self.propagate()
+        for osm_type in OSM_TYPES:
+            with self.metrics.timer("sort"):
+                section = [
+                    (elem_id, self.selected.get((osm_type, elem_id)))
+                    for elem_id in section_ids(
+                        self.selected, osm_type, self.affected_ways, self.affected_relations
+                    )
+                ]
+            yield from self.finish(osm_type, section)
+
+    def action_locations(self, a):
+        """ (lon, lat) of every known location of the elements of a finished action """
+        lons = self.store.lons
+        lats = self.store.lats
+        for elem in a.elements():
+            if elem.type == "node":
+                yield elem.lon, elem.lat
+            for position in elem.positions():
+                yield lons[position], lats[position]
+            for member in elem.members:
+                if member.lon is not None:
+                    yield member.lon, member.lat
+
+
+def section_ids(actions, osm_type, affected_ways, affected_relations):
+    """ Sorted ids of the elements in the osm_type section of an augmented diff """
+    ids = [elem_id for action_type, elem_id in actions if action_type == osm_type]
+    if osm_type == "way":
+        ids.extend(affected_ways)
+    elif osm_type == "relation":
+        ids.extend(affected_relations)
+    return sorted(ids)
+
+
+# State of each worker process in parallel mode, set by _init_worker
+_worker = {}
+
+
+def _init_worker(
+    osmx_file, actions, selected, overlay, ndjson, affected_ways, geometry_budget, regions
+):
+    _worker["env"] = osmx.Environment(osmx_file)
+    _worker["actions"] = actions
+    _worker["selected"] = selected
+    _worker["overlay"] = overlay
+    _worker["ndjson"] = ndjson
+    _worker["affected_ways"] = affected_ways
+    _worker["geometry_budget"] = geometry_budget
+    _worker["regions"] = regions
+    _worker["deletes_built"] = set()
+
+
+def _finish_chunk(osm_type, elem_ids):
+    """ Finish the actions for elem_ids in a worker process with its own read transaction
+
+    Returns the serialized actions and the metrics.Metrics of finishing them. With
+    regions, the serialized actions are a list of those in each region instead.
+
+    """
+    actions = _worker["actions"]
+    selected = _worker["selected"]
+    regions = _worker["regions"]
+    with osmx.Transaction(_worker["env"]) as txn:
+        metrics = Metrics()
+        builder = DiffBuilder(
+            actions,
+            txn,
+            overlay=_worker["overlay"],
+            metrics=metrics,
+            geometry_budget=_worker["geometry_budget"],
+        )
+        builder.selected = selected
+        builder.affected_ways = _worker["affected_ways"]
+        # Building and augmenting a delete action turns its element into the old
+        # version, which is what later sections see in serial mode
+        for earlier_type in OSM_TYPES[: OSM_TYPES.index(osm_type)]:
+            if earlier_type in _worker["deletes_built"]:
+                continue
+            for (action_type, _), action in selected.items():
+                if action_type == earlier_type and action.type == "delete":
+                    a = builder.build_action(action)
+                    if a is not None:
+                        builder.augment_action(a)
+            _worker["deletes_built"].add(earlier_type)
+        section = [(elem_id, selected.get((osm_type, elem_id))) for elem_id in elem_ids]
+        if regions is not None:
+            serialized = [[] for _ in regions.regions]
+        else:
+            serialized = []
+        for a in builder.finish(osm_type, section):
+            with metrics.timer("serialize"):
+                if regions is not None:
+                    serialize_regional(a, builder, regions, _worker["ndjson"], serialized)
+                elif _worker["ndjson"]:
+                    serialized.append(json_line(a.to_json()))
+                else:
+                    serialized.append(a.to_xml(level=1))
+        metrics.add_lookups(builder.db.stats())
+        metrics.add_lookups({"way_geometry": builder.way_geometry_stats})
+        if regions is not None:
+            return serialized, metrics
+        return SerializedActions(serialized), metrics
+
+
+def serialize_regional(a, builder, regions, ndjson, serialized):
+    """ Append a finished action to the serialized actions of each region it is in
+
+    regions: regions.RegionIndex
+    ndjson: list of whether each region is written as JSON lines rather than xml
+    serialized: list of the serialized actions of each region
+
+    """
+    xml = None
+    json_text = None
+    for i in regions.matching(builder.action_locations(a)):
+        if ndjson[i]:
+            if json_text is None:
+                json_text = json_line(a.to_json())
+            serialized[i].append(json_text)
+        else:
+            if xml is None:
+                xml = a.to_xml(level=1)
+            serialized[i].append(xml)
+
+
+def parallel_actions(
+    osmx_file,
+    actions,
+    processes,
+    metrics,
+    overlay=None,
+    ndjson=False,
+    relation_depth=DEFAULT_RELATION_DEPTH,
+    geometry_budget=None,
+    regions=None,
+):
+    """ Yield the actions of an augmented diff, built by a pool of processes
+
+    The affected ways and relations are found first, in this process. Then each
+    section is split into consecutive chunks of ids which are finished in parallel
+    and yielded in order as SerializedActions, of xml or JSON lines if ndjson is True.
+    The metrics.Metrics of every chunk are merged into metrics, along with the db
+    lookups of finding the affected elements.
+
+    If regions is a regions.RegionIndex, the actions outside of its regions are dropped
+    first, and each chunk is yielded as a list of the serialized actions in each region,
+    with ndjson a list of whether each region is written as JSON lines.
+
+    """
+    with osmx.Transaction(open_environment(osmx_file)) as txn:
+        db = OsmxLookup(txn, overlay=overlay)
+        selected = actions
+        if regions is not None:
+            with metrics.timer("prune"):
+                selected = RegionFilter(actions, db, regions).run()
+            metrics.set("adiff_pruned_actions", len(actions) - len(selected))
+        with metrics.timer("propagate"):
+            affected_ways, affected_relations = Propagation(
+                actions, db, relation_depth=relation_depth, changes=selected
+            ).run()
+        metrics.add_lookups(db.stats())
+    metrics.propagated["way"] = len(affected_ways)
+    metrics.propagated["relation"] = len(affected_relations)
+
+    with multiprocessing.Pool(
+        processes,
+        initializer=_init_worker,
+        initargs=(
+            osmx_file,
+            actions,
+            selected,
+            overlay,
+            ndjson,
+            affected_ways,
+            geometry_budget,
+            regions,
+        ),
+    ) as pool:
+        for osm_type in OSM_TYPES:
+            with metrics.timer("sort"):
+                elem_ids = section_ids(selected, osm_type, affected_ways, affected_relations)
+            if not elem_ids:
+                continue
+            size = ceil(len(elem_ids) / (processes * CHUNKS_PER_PROCESS))
+            chunks = [elem_ids[i : i + size] for i in range(0, len(elem_ids), size)]  # noqa: E203
+            results = metrics.timed(pool.imap(partial(_finish_chunk, osm_type), chunks), "parallel")
+            for fragment, chunk_metrics in results:
+                metrics.merge(chunk_metrics)
+                if regions is not None:
+                    yield fragment
+                elif fragment.serialized:
+                    yield fragment
+
+
+def diff_header(end_timestamp, osc_sequence, osc_url):
+    """ The root, note and meta elements of an augmented diff """
+    o = ET.Element("osm")
+    o.set("version", "0.6")
+    o.set(
+        "generator",
+        "Overpass API not used, but achavi detects it at the start of string; https://github.com/azavea/onramp",
+    )
+
+    # Set diff note
+    note = ET.Element("note")
+    note.text = "The data included in this document is from www.openstreetmap.org. The data is made available under ODbL."
 
     # Set diff metadata
     meta = ET.Element("meta")
@@ -399,13 +752,294 @@ def augmented_diff(
         meta.set("replication_url", str(osc_url))
     else:
         logger.warning("No osc_url provided, cannot set meta.replication_url!")
-    o.insert(0, meta)
+    return o, note, meta
 
-    # Set diff note
-    note = ET.Element("note")
-    note.text = "The data included in this document is from www.openstreetmap.org. The data is made available under ODbL."
-    o.insert(0, note)
 
-    indent(o)
+def augmented_diff(
+    osmx_file,
+    osc_file,
+    output_file,
+    end_timestamp=None,
+    osc_sequence=None,
+    osc_url=None,
+    processes=1,
+    overlay=None,
+    gzip_level=9,
+    gzip_threads=1,
+    metrics=None,
+    relation_depth=DEFAULT_RELATION_DEPTH,
+    way_cache=None,
+    geometry_budget=None,
+):
+    """ Generate an OSM Augmented Diff using osmx_file and osc_file
+
+    end_timestamp is the timestamp of the end of the time range in the osc_file.
+
+    Result written as xml to output_file, which can be a local file or S3 URI.
+    If output_file ends in .ndjson or .ndjson.gz, it is written as newline-delimited
+    JSON instead, see xml_writers.NdjsonTree.
+    Actions are written to output_file one at a time as soon as each is complete.
+
+    If processes is greater than 1, actions are built by a pool of that many processes,
+    each with its own read transaction on osmx_file. Output is the same either way.
+
+    overlay is an optional overlay.Overlay of osmChanges that come before osc_file but
+    haven't been committed to osmx_file yet. The diff is generated as if they had been,
+    and then the changes of osc_file are added to overlay.
+
+    gzip_level and gzip_threads set the compression of .gz output, see
+    xml_writers.gzip_write.
+
+    metrics is an optional metrics.Metrics which the durations of each pass, the
+    number of actions, db lookups and bytes written are added to.
+
+    relation_depth is how many levels of parent relations changes propagate to, through
+    relation_relation, see propagation.Propagation. 0 only includes relations with
+    changed node or way members.
+
+    way_cache is an optional geometry.WayGeometryCache that keeps the geometries of
+    relation member ways for the next diff. The ways changed by osc_file are removed
+    from it once the diff is done. It is only used with processes=1, and has to be
+    passed to every diff of osmx_file in order, or none of them.
+
+    geometry_budget is an optional number of way member locations that each old or new
+    relation element can have. Relations over it, such as a national boundary with one
+    moved node, are written with geometry only for their changed way members, their
+    bounds, and truncated="true".
+
+    See https://wiki.openstreetmap.org/wiki/Overpass_API/Augmented_Diffs
+    This function should be called on an osmx_file that hasn't yet had osc_file
+    written to it, with any osmChanges in between applied to overlay.
+
+    """
+
+    if metrics is None:
+        metrics = Metrics()
+    start = time.perf_counter()
+
+    # 1st pass:
+    # populate the collection of actions
+    # create dictionary from (osm_type, osm_id) to action
+    # e.g. ("node", 12345) > Action()
+    with metrics.timer("parse"):
+        actions = read_actions(osc_file, logger=logger)
+
+    o, note, meta = diff_header(end_timestamp, osc_sequence, osc_url)
+
+    metrics.set("adiff_processes", processes)
+    if processes > 1:
+        write_start = time.perf_counter()
+        output_bytes = write_xml(
+            StreamingTree(
+                o,
+                chain(
+                    [note, meta],
+                    metrics.timed(
+                        parallel_actions(
+                            osmx_file,
+                            actions,
+                            processes,
+                            metrics,
+                            overlay=overlay,
+                            ndjson=is_ndjson(output_file),
+                            relation_depth=relation_depth,
+                            geometry_budget=geometry_budget,
+                        ),
+                        "generate",
+                    ),
+                ),
+            ),
+            output_file,
+            logger=logger,
+            gzip_level=gzip_level,
+            gzip_threads=gzip_threads,
+        )
+        write_time = time.perf_counter() - write_start
+        if overlay is not None:
+            with metrics.timer("overlay"):
+                with osmx.Transaction(open_environment(osmx_file)) as txn:
+                    overlay.apply(actions, OsmxLookup(txn, overlay=overlay))
+    else:
+        with osmx.Transaction(open_environment(osmx_file)) as txn:
+            builder = DiffBuilder(
+                actions,
+                txn,
+                overlay=overlay,
+                metrics=metrics,
+                relation_depth=relation_depth,
+                way_cache=way_cache,
+                geometry_budget=geometry_budget,
+            )
+            write_start = time.perf_counter()
+            output_bytes = write_xml(
+                StreamingTree(
+                    o, chain([note, meta], metrics.timed(builder.sorted_actions(), "generate"))
+                ),
+                output_file,
+                logger=logger,
+                gzip_level=gzip_level,
+                gzip_threads=gzip_threads,
+            )
+            write_time = time.perf_counter() - write_start
+            metrics.add_lookups(builder.db.stats())
+            metrics.add_lookups({"way_geometry": builder.way_geometry_stats})
+            if overlay is not None:
+                # builder.db has cached the state before osc_file, which apply needs
+                with metrics.timer("overlay"):
+                    overlay.apply(actions, builder.db)
+
+    # The db state of the ways changed by osc_file is out of date once it's committed
+    if way_cache is not None:
+        metrics.set("way_cache_invalidated", way_cache.invalidate(actions))
+        metrics.set("way_cache_nodes", way_cache.nodes)
+
+    # Actions are produced while the output is written, leave out the time that took
+    metrics.durations["write"] = write_time - metrics.durations.get("generate", 0)
+    metrics.set("adiff_output_bytes", output_bytes)
+    metrics.durations["total"] = time.perf_counter() - start
+
+    log_metrics(metrics, geometry_budget)
+
+
+def log_metrics(metrics, geometry_budget):
+    for name, table_stats in metrics.lookups.items():
+        logger.debug(
+            "{}: {} lookups, {} cache hits, {} db reads".format(
+                name, table_stats["lookups"], table_stats["hits"], table_stats["reads"]
+            )
+        )
+    if metrics.truncated:
+        logger.info(
+            "{} relation elements over the geometry budget of {} locations were truncated".format(
+                metrics.truncated, geometry_budget
+            )
+        )
+    logger.debug("Passes: {}".format(metrics.summary()))
+
+
+def regional_augmented_diffs(
+    osmx_file,
+    osc_file,
+    regions,
+    end_timestamp=None,
+    osc_sequence=None,
+    osc_url=None,
+    processes=1,
+    overlay=None,
+    gzip_level=9,
+    gzip_threads=1,
+    metrics=None,
+    relation_depth=DEFAULT_RELATION_DEPTH,
+    way_cache=None,
+    geometry_budget=None,
+):
+    """ Generate an augmented diff of osc_file for each of a list of regions at once
+
+    regions is a list of (regions.Region, output_file). Each output_file gets the
+    actions with any location in its region, written the same way as by augmented_diff,
+    whose other arguments are the same.
+
+    The osmChange is read, and each action is built and serialized, only once for all of
+    the regions. Actions outside of every region are dropped before anything is built or
+    propagated from them, see regions.RegionFilter, so ways and relations are only
+    affected by changes in the regions. Each output_file is written in a thread of its
+    own as the actions of its region are produced, see xml_writers.BackgroundTreeWriter.
+
+    """
+    if metrics is None:
+        metrics = Metrics()
+    start = time.perf_counter()
+
+    with metrics.timer("parse"):
+        actions = read_actions(osc_file, logger=logger)
+
+    o, note, meta = diff_header(end_timestamp, osc_sequence, osc_url)
+    index = RegionIndex([region for region, _ in regions])
+    ndjson = [is_ndjson(output_file) for _, output_file in regions]
+
+    metrics.set("adiff_processes", processes)
+    metrics.set("adiff_regions", len(regions))
+    writers = [
+        BackgroundTreeWriter(
+            o,
+            [note, meta],
+            output_file,
+            logger=logger,
+            gzip_level=gzip_level,
+            gzip_threads=gzip_threads,
+        )
+        for _, output_file in regions
+    ]
+    counts = [0] * len(regions)
+
+    def write_fragment(fragment):
+        """ Hand the serialized actions of each region over to its writer """
+        for i, serialized in enumerate(fragment):
+            if serialized:
+                counts[i] += len(serialized)
+                writers[i].put(SerializedActions(serialized))
+
+    try:
+        if processes > 1:
+            fragments = parallel_actions(
+                osmx_file,
+                actions,
+                processes,
+                metrics,
+                overlay=overlay,
+                ndjson=ndjson,
+                relation_depth=relation_depth,
+                geometry_budget=geometry_budget,
+                regions=index,
+            )
+            for fragment in metrics.timed(fragments, "generate"):
+                write_fragment(fragment)
+            if overlay is not None:
+                with metrics.timer("overlay"):
+                    with osmx.Transaction(open_environment(osmx_file)) as txn:
+                        overlay.apply(actions, OsmxLookup(txn, overlay=overlay))
+        else:
+            with osmx.Transaction(open_environment(osmx_file)) as txn:
+                builder = DiffBuilder(
+                    actions,
+                    txn,
+                    overlay=overlay,
+                    metrics=metrics,
+                    relation_depth=relation_depth,
+                    way_cache=way_cache,
+                    geometry_budget=geometry_budget,
+                    regions=index,
+                )
+                fragment = [[] for _ in regions]
+                for a in metrics.timed(builder.sorted_actions(), "generate"):
+                    with metrics.timer("regions"):
+                        serialize_regional(a, builder, index, ndjson, fragment)
+                    if sum(len(serialized) for serialized in fragment) >= REGION_CHUNK_SIZE:
+                        write_fragment(fragment)
+                        fragment = [[] for _ in regions]
+                write_fragment(fragment)
+                metrics.add_lookups(builder.db.stats())
+                metrics.add_lookups({"way_geometry": builder.way_geometry_stats})
+                if overlay is not None:
+                    with metrics.timer("overlay"):
+                        overlay.apply(actions, builder.db)
+
+        # Actions are written while they are produced, this is the time to finish writing
+        write_start = time.perf_counter()
+        output_bytes = sum(writer.close() for writer in writers)
+        metrics.durations["write"] = time.perf_counter() - write_start
+    except BaseException as e:
+        for writer in writers:
+            writer.abort(e)
+        raise
+
+    if way_cache is not None:
+        metrics.set("way_cache_invalidated", way_cache.invalidate(actions))
+        metrics.set("way_cache_nodes", way_cache.nodes)
+
+    for (region, _), count in zip(regions, counts):
+        logger.debug("{}: {} actions".format(region.name, count))
+    metrics.set("adiff_output_bytes", output_bytes)
+    metrics.durations["total"] = time.perf_counter() - start
 
-    write_xml(ET.ElementTree(o), output_file, logger=logger)
+    log_metrics(metrics, geometry_budget)
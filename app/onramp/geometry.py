@@ -1,29 +1,157 @@
-import xml.etree.ElementTree as ET
+from array import array
+from collections import OrderedDict
 
+format_coordinate = "{:.07f}".format
+format_nd = '<nd lon="{}" lat="{}" />'.format
 
-class Bounds:
-    """ Iteratively construct bounding box for a series of (x, y) points. """
+
+class CoordinateStore:
+    """ Columnar store of the node locations used by one augmented diff
+
+    Each location is added once and referred to by its position in the lons and lats
+    arrays. Geometries are lists of positions, so bounds are computed with min/max over
+    the arrays rather than point by point, and each location is formatted at most
+    once, in bulk, when the diff is written.
+
+    """
 
     def __init__(self):
-        self.minx = 180
-        self.maxx = -180
-        self.miny = 90
-        self.maxy = -90
-
-    def add(self, x, y):
-        if x < self.minx:
-            self.minx = x
-        if x > self.maxx:
-            self.maxx = x
-        if y < self.miny:
-            self.miny = y
-        if y > self.maxy:
-            self.maxy = y
-
-    def elem(self):
-        e = ET.Element("bounds")
-        e.set("minlat", "{:.07f}".format(self.miny))
-        e.set("minlon", "{:.07f}".format(self.minx))
-        e.set("maxlat", "{:.07f}".format(self.maxy))
-        e.set("maxlon", "{:.07f}".format(self.maxx))
-        return e
+        self.lons = array("d")
+        self.lats = array("d")
+        self.lon_strings = []
+        self.lat_strings = []
+        self.nd_strings = []
+
+    def add(self, lon, lat):
+        """ Add a location, returning its position """
+        self.lons.append(lon)
+        self.lats.append(lat)
+        return len(self.lons) - 1
+
+    def format(self):
+        """ Format every location added since the last call """
+        formatted = len(self.lon_strings)
+        if formatted < len(self.lons):
+            self.lon_strings.extend(map(format_coordinate, self.lons[formatted:]))
+            self.lat_strings.extend(map(format_coordinate, self.lats[formatted:]))
+            self.nd_strings.extend(
+                map(format_nd, self.lon_strings[formatted:], self.lat_strings[formatted:])
+            )
+
+    def bounds(self, positions):
+        """ (minlon, minlat, maxlon, maxlat) of the locations at positions
+
+        Clamped to the world like the bounds of the original ElementTree writer, which
+        started from (180, 90, -180, -90).
+
+        """
+        lons = list(map(self.lons.__getitem__, positions))
+        lats = list(map(self.lats.__getitem__, positions))
+        return (
+            min(180, min(lons)),
+            min(90, min(lats)),
+            max(-180, max(lons)),
+            max(-90, max(lats)),
+        )
+
+
+class Geometry:
+    """ Sequence of locations in a CoordinateStore, None for an unknown location """
+
+    __slots__ = ("store", "positions")
+
+    def __init__(self, store, positions):
+        self.store = store
+        self.positions = positions
+
+    def known_positions(self):
+        return [p for p in self.positions if p is not None]
+
+    def nd_xml(self):
+        """ <nd lon="" lat="" /> for each location, which must all be known """
+        self.store.format()
+        return list(map(self.store.nd_strings.__getitem__, self.positions))
+
+    def formatted(self):
+        """ (lon, lat) strings for each location, or None if it is unknown """
+        store = self.store
+        store.format()
+        lon_strings = store.lon_strings
+        lat_strings = store.lat_strings
+        return [
+            None if p is None else (lon_strings[p], lat_strings[p]) for p in self.positions
+        ]
+
+    def coordinates(self):
+        """ [lon, lat] rounded like format_coordinate for each location, or None """
+        lons = self.store.lons
+        lats = self.store.lats
+        return [
+            None if p is None else [round(lons[p], 7), round(lats[p], 7)]
+            for p in self.positions
+        ]
+
+
+class WayGeometryCache:
+    """ Bounded LRU cache of the node ids and locations of ways, kept between diffs
+
+    Entries hold the db state of a way, so they stay valid for later diffs until the
+    way or one of its nodes is changed. Call invalidate() with the actions of each
+    diff once it has been generated, before the db moves on to its changes, and use
+    one cache only for consecutive diffs of the same db.
+
+    max_nodes: most node locations held across all of the ways, least recently used
+               ways are evicted first
+
+    """
+
+    def __init__(self, max_nodes):
+        self.max_nodes = max_nodes
+        self.entries = OrderedDict()
+        self.nodes = 0
+
+    def __contains__(self, way_id):
+        return way_id in self.entries
+
+    def get(self, way_id):
+        """ (node ids, lons, lats) of way_id, or None if it isn't cached """
+        entry = self.entries.get(way_id)
+        if entry is not None:
+            self.entries.move_to_end(way_id)
+        return entry
+
+    def put(self, way_id, node_ids, lons, lats):
+        node_ids = tuple(node_ids)
+        if len(node_ids) > self.max_nodes:
+            return
+        old = self.entries.pop(way_id, None)
+        if old is not None:
+            self.nodes -= len(old[0])
+        self.entries[way_id] = (node_ids, array("d", lons), array("d", lats))
+        self.nodes += len(node_ids)
+        while self.nodes > self.max_nodes:
+            _, (evicted, _, _) = self.entries.popitem(last=False)
+            self.nodes -= len(evicted)
+
+    def clear(self):
+        self.entries.clear()
+        self.nodes = 0
+
+    def invalidate(self, actions):
+        """ Remove every way that actions changes, directly or through its nodes
+
+        actions: dictionary from (osm_type, osm_id) to osc.Action, see osc.read_actions
+
+        Returns the number of ways removed.
+
+        """
+        way_ids = {elem_id for osm_type, elem_id in actions if osm_type == "way"}
+        node_ids = {elem_id for osm_type, elem_id in actions if osm_type == "node"}
+        stale = [
+            way_id
+            for way_id, (nodes, _, _) in self.entries.items()
+            if way_id in way_ids or not node_ids.isdisjoint(nodes)
+        ]
+        for way_id in stale:
+            self.nodes -= len(self.entries.pop(way_id)[0])
+        return len(stale)
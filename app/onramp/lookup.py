@@ -0,0 +1,105 @@
+import osmx
+
+
+class CachedTable:
+    """ Memoize reads from an osmx table for the life of its transaction
+
+    table: any osmx table with a get(id) method, e.g. osmx.Locations or osmx.NodeWay
+    iterable: True if table.get returns an iterator, which is stored as a tuple so it
+              can be read more than once
+    overlay: optional dictionary from id to a result that replaces the one in table,
+             see overlay.Overlay
+
+    Results, including misses, are kept until the CachedTable is discarded. Use
+    prefetch() to read a batch of ids in sorted order before they are needed, which
+    keeps reads local within the LMDB B-tree.
+
+    """
+
+    def __init__(self, table, iterable=False, overlay=None):
+        self.table = table
+        self.iterable = iterable
+        self.overlay = overlay
+        self.cache = {}
+        self.lookups = 0
+        self.hits = 0
+        self.reads = 0
+
+    def _read(self, elem_id):
+        if self.overlay and elem_id in self.overlay:
+            result = self.overlay[elem_id]
+            self.cache[elem_id] = result
+            return result
+        self.reads += 1
+        result = self.table.get(elem_id)
+        if self.iterable:
+            result = tuple(result)
+        self.cache[elem_id] = result
+        return result
+
+    def get(self, elem_id):
+        elem_id = int(elem_id)
+        self.lookups += 1
+        try:
+            result = self.cache[elem_id]
+            self.hits += 1
+            return result
+        except KeyError:
+            return self._read(elem_id)
+
+    def prefetch(self, elem_ids):
+        """ Read every id in elem_ids that isn't cached yet, in increasing id order """
+        missing = {int(elem_id) for elem_id in elem_ids}
+        for elem_id in sorted(missing.difference(self.cache)):
+            self._read(elem_id)
+
+    def peek(self, elem_id):
+        """ Return the cached result for elem_id, or None, without counting a lookup """
+        return self.cache.get(int(elem_id))
+
+    def stats(self):
+        return {"lookups": self.lookups, "hits": self.hits, "reads": self.reads}
+
+
+class OsmxLookup:
+    """ Cached access to each of the tables of an open osmx.Transaction
+
+    If overlay is an overlay.Overlay, its uncommitted changes are read in place of
+    the db.
+
+    """
+
+    def __init__(self, txn, overlay=None):
+        tables = overlay.tables if overlay is not None else {}
+        self.locations = CachedTable(osmx.Locations(txn), overlay=tables.get("locations"))
+        self.nodes = CachedTable(osmx.Nodes(txn), overlay=tables.get("nodes"))
+        self.ways = CachedTable(osmx.Ways(txn), overlay=tables.get("ways"))
+        self.relations = CachedTable(osmx.Relations(txn), overlay=tables.get("relations"))
+        self.node_way = CachedTable(
+            osmx.NodeWay(txn), iterable=True, overlay=tables.get("node_way")
+        )
+        self.node_relation = CachedTable(
+            osmx.NodeRelation(txn), iterable=True, overlay=tables.get("node_relation")
+        )
+        self.way_relation = CachedTable(
+            osmx.WayRelation(txn), iterable=True, overlay=tables.get("way_relation")
+        )
+        self.relation_relation = CachedTable(
+            osmx.RelationRelation(txn), iterable=True, overlay=tables.get("relation_relation")
+        )
+
+    def tables(self):
+        return {
+            "locations": self.locations,
+            "nodes": self.nodes,
+            "ways": self.ways,
+            "relations": self.relations,
+            "node_way": self.node_way,
+            "node_relation": self.node_relation,
+            "way_relation": self.way_relation,
+            "relation_relation": self.relation_relation,
+        }
+
+    def stats(self):
+        """ Lookup, cache hit and database read counts for each table """
+        return {name: table.stats() for name, table in self.tables().items()}
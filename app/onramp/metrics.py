@@ -0,0 +1,244 @@
+""" Timings and counters of augmented diff generation, exported as JSON or Prometheus text
+
+A Metrics object is passed to diff.augmented_diff, which fills in the time spent in
+each pass along with action, propagation, db lookup and output size counts.
+osmx-update adds the replication state, the osmx commit and the replication lag, and
+writes each sequence's metrics to a JSON lines file and/or a Prometheus textfile
+that the node exporter textfile collector can scrape.
+
+"""
+import json
+import os
+import tempfile
+import time
+
+PROMETHEUS_PREFIX = "onramp_"
+
+# Descriptions of each pass, in the order they run
+PASSES = {
+    "parse": "Reading the osmChange",
+    "prune": "Dropping the actions outside of every region, in regional mode",
+    "sort": "Sorting the ids of each section of the diff",
+    "prefetch": "Reading each section's elements from the db in id order",
+    "build": "Building old and new elements, including db lookups of old elements",
+    "augment": "Adding coordinates and geometries to the elements of changed actions",
+    "propagate": "Finding the ways and relations affected by changed members",
+    "affected": "Building the actions of affected ways and relations",
+    "bounds": "Adding bounding boxes",
+    "regions": "Finding the regions of each action and serializing it, in regional mode",
+    "serialize": "Serializing actions in worker processes, in parallel mode",
+    "parallel": "Waiting for worker processes, in parallel mode",
+    "generate": "Producing every action of the diff, including all of the passes above",
+    "write": "Serializing, compressing and uploading, excluding generate",
+    "overlay": "Applying the osmChange to the uncommitted changes overlay",
+    "total": "The whole augmented diff",
+    "commit": "Committing to the osmx db",
+}
+
+# Help text of the values that can be set with Metrics.set
+VALUES = {
+    "adiff_output_bytes": "Bytes written to the augmented diff file",
+    "adiff_processes": "Processes used to build the augmented diff",
+    "adiff_pruned_actions": "Actions of the osmChange outside of every region",
+    "adiff_regions": "Regions that augmented diffs were written for",
+    "adiff_sequence": "Minutely augmented diff sequence number",
+    "replication_sequence": "Replication sequence number",
+    "replication_timestamp_seconds": "Timestamp of the replication sequence",
+    "replication_lag_seconds": "Seconds between the replication timestamp and its processing",
+    "last_update_timestamp_seconds": "Time the replication sequence was processed",
+    "way_cache_nodes": "Node locations held in the way geometry cache",
+    "way_cache_invalidated": "Ways removed from the way geometry cache by the last augmented diff",
+}
+
+
+class _Timer:
+    __slots__ = ("durations", "name", "start")
+
+    def __init__(self, durations, name):
+        self.durations = durations
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self.start
+        self.durations[self.name] = self.durations.get(self.name, 0) + elapsed
+
+
+class Metrics:
+    """ Per-pass durations and counters of generating one augmented diff
+
+    durations: pass name > seconds, see PASSES. In parallel mode the passes run in
+               worker processes are summed across all of them, so they are CPU
+               rather than wall clock time.
+    actions: action type > element type > number of actions in the diff
+    propagated: element type > number of ways and relations only affected by changes
+    truncated: number of relation elements written without all of their geometry
+    lookups: db table > lookup, cache hit and db read counts, see lookup.OsmxLookup,
+             and the same for the geometries of relation member ways as way_geometry,
+             which also counts the members over the geometry budget that weren't read
+             as skipped
+    values: other values of the diff, see VALUES
+
+    Metrics are plain data so they can be pickled and merged from worker processes.
+
+    """
+
+    def __init__(self):
+        self.durations = {}
+        self.actions = {}
+        self.propagated = {}
+        self.truncated = 0
+        self.lookups = {}
+        self.values = {}
+
+    def timer(self, name):
+        """ Context manager that adds the time spent in it to the name pass """
+        return _Timer(self.durations, name)
+
+    def timed(self, iterable, name):
+        """ Yield from iterable, adding the time spent producing each item to the name pass """
+        iterator = iter(iterable)
+        while True:
+            with self.timer(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count_action(self, a):
+        by_type = self.actions.setdefault(a.type, {})
+        by_type[a.new.type] = by_type.get(a.new.type, 0) + 1
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def add_lookups(self, stats):
+        """ Add the db stats of an OsmxLookup """
+        for table, table_stats in stats.items():
+            totals = self.lookups.setdefault(table, {})
+            for key, value in table_stats.items():
+                totals[key] = totals.get(key, 0) + value
+
+    def merge(self, other):
+        """ Add the durations and counts of other, e.g. from a worker process """
+        for name, seconds in other.durations.items():
+            self.durations[name] = self.durations.get(name, 0) + seconds
+        for action_type, counts in other.actions.items():
+            by_type = self.actions.setdefault(action_type, {})
+            for osm_type, count in counts.items():
+                by_type[osm_type] = by_type.get(osm_type, 0) + count
+        for osm_type, count in other.propagated.items():
+            self.propagated[osm_type] = self.propagated.get(osm_type, 0) + count
+        self.truncated += other.truncated
+        self.add_lookups(other.lookups)
+
+    def summary(self):
+        """ One line of the duration of each pass that ran, for logging """
+        return ", ".join(
+            "{} {:.3f}s".format(name, self.durations[name])
+            for name in PASSES
+            if name in self.durations
+        )
+
+    def to_json(self):
+        return {
+            "durations": self.durations,
+            "actions": self.actions,
+            "propagated": self.propagated,
+            "truncated": self.truncated,
+            "lookups": self.lookups,
+            **self.values,
+        }
+
+    def to_prometheus(self):
+        """ Metrics in the Prometheus text exposition format """
+        lines = []
+
+        def add(name, help_text, samples):
+            name = PROMETHEUS_PREFIX + name
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} gauge".format(name))
+            for labels, value in samples:
+                if labels:
+                    label_text = ",".join(
+                        '{}="{}"'.format(k, escape_label(v)) for k, v in labels
+                    )
+                    lines.append("{}{{{}}} {}".format(name, label_text, value))
+                else:
+                    lines.append("{} {}".format(name, value))
+
+        if self.durations:
+            add(
+                "adiff_pass_seconds",
+                "Seconds spent in each pass of the last augmented diff",
+                [((("pass", name),), seconds) for name, seconds in self.durations.items()],
+            )
+        if self.actions:
+            add(
+                "adiff_actions",
+                "Actions in the last augmented diff",
+                [
+                    ((("action", action_type), ("type", osm_type)), count)
+                    for action_type, counts in self.actions.items()
+                    for osm_type, count in counts.items()
+                ],
+            )
+        if self.propagated:
+            add(
+                "adiff_propagated",
+                "Ways and relations in the last augmented diff only because of changes to "
+                "their members",
+                [((("type", osm_type),), count) for osm_type, count in self.propagated.items()],
+            )
+        add(
+            "adiff_truncated",
+            "Relation elements in the last augmented diff over the geometry budget",
+            [((), self.truncated)],
+        )
+        for key, help_text in (
+            ("lookups", "Lookups of each db table"),
+            ("hits", "Lookups of each db table answered from the cache"),
+            ("reads", "Reads from each db table"),
+            ("skipped", "Geometries of relation members over the geometry budget not read"),
+        ):
+            samples = [
+                ((("table", table),), table_stats[key])
+                for table, table_stats in self.lookups.items()
+                if key in table_stats
+            ]
+            if samples:
+                add("adiff_db_{}".format(key), help_text + " for the last augmented diff", samples)
+        for name, value in self.values.items():
+            add(name, VALUES.get(name, name), [((), value)])
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        """ Append the metrics to path as one line of JSON """
+        with open(path, "a") as fp:
+            fp.write(json.dumps(self.to_json(), sort_keys=True) + "\n")
+
+    def write_textfile(self, path):
+        """ Replace path with the metrics in Prometheus text format
+
+        The file is written next to path and renamed over it, so a scrape never sees
+        a partly written file.
+
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metrics-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as fp:
+                fp.write(self.to_prometheus())
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
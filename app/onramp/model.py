@@ -0,0 +1,394 @@
+""" Compact records for the actions of an augmented diff
+
+Elements are held as plain typed values while a diff is generated and are only
+turned into xml when they are written out. Output of to_xml() matches serializing
+the equivalent xml.etree.ElementTree tree indented with utils.indent.
+
+"""
+from functools import partial
+import json
+
+from .geometry import format_coordinate
+
+# Attributes held in typed slots of OsmElement, any others are kept in OsmElement.extra
+ELEMENT_ATTRS = frozenset(
+    ["id", "version", "timestamp", "uid", "user", "changeset", "visible", "lat", "lon", "truncated"]
+)
+INT_ATTRS = frozenset(["id", "version", "uid", "changeset"])
+
+# Attribute order of elements and members rebuilt from the osmx db
+REBUILT_ATTRS = ("id", "version", "user", "uid", "timestamp", "changeset")
+REBUILT_MEMBER_ATTRS = ("ref", "role", "type")
+
+# Characters escaped in attribute values and text, the same as ElementTree.write on
+# Python 3.6 of the Docker image. Later Pythons also escape \r and \t in attribute
+# values, which is left out so that output doesn't depend on the Python it runs on.
+ATTRIB_ESCAPES = (
+    ("&", "&amp;"),
+    ("<", "&lt;"),
+    (">", "&gt;"),
+    ('"', "&quot;"),
+    ("\n", "&#10;"),
+)
+TEXT_ESCAPES = ATTRIB_ESCAPES[:3]
+
+_attr_orders = {}
+
+
+def escape(text, escapes=ATTRIB_ESCAPES):
+    for char, entity in escapes:
+        if char in text:
+            text = text.replace(char, entity)
+    return text
+
+
+def attr_order(names):
+    """ Return a shared tuple for the sequence of attribute names """
+    names = tuple(names)
+    return _attr_orders.setdefault(names, names)
+
+
+def with_attrs(attrs, names):
+    """ Append any of names missing from attrs, as ElementTree.set would """
+    missing = [name for name in names if name not in attrs]
+    if not missing:
+        return attrs
+    return attr_order(attrs + tuple(missing))
+
+
+def _attrib(names, values):
+    return "".join(
+        ' {}="{}"'.format(name, escape(value)) for name, value in zip(names, values)
+    )
+
+
+# Compact JSON for newline-delimited output
+json_line = partial(json.dumps, ensure_ascii=False, separators=(",", ":"))
+
+
+def _nd(ref, location):
+    if location is None:
+        return '<nd ref="{}" />'.format(ref)
+    return '<nd ref="{}" lon="{}" lat="{}" />'.format(ref, *location)
+
+
+class Member:
+    """ A relation member, with the geometry added to it by augmentation
+
+    lon, lat: location of a node member
+    geometry: geometry.Geometry of the nodes of a way member
+
+    """
+
+    __slots__ = ("type", "ref", "role", "attrs", "lon", "lat", "geometry")
+
+    def __init__(self, type, ref, role, attrs=REBUILT_MEMBER_ATTRS):
+        self.type = type
+        self.ref = ref
+        self.role = role
+        self.attrs = attrs
+        self.lon = None
+        self.lat = None
+        self.geometry = None
+
+    def copy(self):
+        return Member(self.type, self.ref, self.role, attrs=self.attrs)
+
+    def to_json(self):
+        obj = {"type": self.type, "ref": self.ref, "role": self.role}
+        if self.lon is not None:
+            obj["lon"] = round(self.lon, 7)
+            obj["lat"] = round(self.lat, 7)
+        if self.geometry is not None and self.geometry.positions:
+            obj["geometry"] = self.geometry.coordinates()
+        return obj
+
+    def to_xml(self, level):
+        attrs = self.attrs
+        values = []
+        for name in attrs:
+            if name == "ref":
+                values.append(str(self.ref))
+            else:
+                values.append(getattr(self, name))
+        if self.lon is not None:
+            attrs = with_attrs(attrs, ("lon", "lat"))
+            values.append(format_coordinate(self.lon))
+            values.append(format_coordinate(self.lat))
+        start = "<member" + _attrib(attrs, values)
+        if self.geometry is None or not self.geometry.positions:
+            return start + " />"
+        i = "\n" + (level + 1) * "  "
+        lines = [start + ">"]
+        lines.extend(self.geometry.nd_xml())
+        return i.join(lines) + "\n" + level * "  " + "</member>"
+
+
+class OsmElement:
+    """ A node, way or relation
+
+    Ids, versions, uids and changesets are ints and coordinates are floats.
+    attrs is the order its xml attributes are written in, which follows the
+    osmChange they were read from, or REBUILT_ATTRS for elements rebuilt from the
+    osmx db.
+
+    nds: list of node ids of a way
+    geometry: geometry.Geometry of nds once augmented
+    members: list of Member of a relation
+    tags: list of (key, value)
+    bounds: (minlon, minlat, maxlon, maxlat) once computed
+    truncated: "true" for a relation written without the geometry of some of its members
+    text: text of an element that had no children in the osmChange, such as the
+          whitespace of <way ...>\n</way>, which ElementTree writes back unchanged
+
+    """
+
+    __slots__ = (
+        "type",
+        "id",
+        "version",
+        "timestamp",
+        "uid",
+        "user",
+        "changeset",
+        "visible",
+        "truncated",
+        "lat",
+        "lon",
+        "attrs",
+        "extra",
+        "nds",
+        "geometry",
+        "members",
+        "tags",
+        "bounds",
+        "text",
+    )
+
+    def __init__(self, type, id, attrs=("id",)):
+        self.type = type
+        self.id = id
+        self.version = None
+        self.timestamp = None
+        self.uid = None
+        self.user = None
+        self.changeset = None
+        self.visible = None
+        self.truncated = None
+        self.lat = None
+        self.lon = None
+        self.attrs = attrs
+        self.extra = None
+        self.nds = []
+        self.geometry = None
+        self.members = []
+        self.tags = []
+        self.bounds = None
+        self.text = None
+
+    @classmethod
+    def from_xml(cls, e):
+        """ Create from an xml.etree.ElementTree.Element read from an osmChange """
+        elem = cls(e.tag, int(e.get("id")), attrs=attr_order(e.keys()))
+        for name, value in e.items():
+            if name in ("lat", "lon"):
+                value = float(value)
+            elif name in INT_ATTRS:
+                value = int(value)
+            elif name not in ELEMENT_ATTRS:
+                if elem.extra is None:
+                    elem.extra = {}
+                elem.extra[name] = value
+                continue
+            setattr(elem, name, value)
+        for child in e:
+            if child.tag == "nd":
+                elem.nds.append(int(child.get("ref")))
+            elif child.tag == "member":
+                elem.members.append(
+                    Member(
+                        child.get("type"),
+                        int(child.get("ref")),
+                        child.get("role"),
+                        attrs=attr_order(child.keys()),
+                    )
+                )
+            elif child.tag == "tag":
+                elem.tags.append((child.get("k"), child.get("v")))
+        if len(e) == 0:
+            elem.text = e.text
+        return elem
+
+    def copy(self):
+        """ Copy of the element, without any augmented geometry or bounds """
+        elem = OsmElement(self.type, self.id, attrs=self.attrs)
+        for name in ELEMENT_ATTRS:
+            setattr(elem, name, getattr(self, name))
+        if self.extra is not None:
+            elem.extra = dict(self.extra)
+        elem.nds = list(self.nds)
+        elem.members = [m.copy() for m in self.members]
+        elem.tags = list(self.tags)
+        elem.text = self.text
+        return elem
+
+    def set(self, name, value):
+        """ Set an attribute, appending it to attrs if it isn't there yet """
+        setattr(self, name, value)
+        if name not in self.attrs:
+            self.attrs = attr_order(self.attrs + (name,))
+
+    def positions(self):
+        """ Positions of every known location of the augmented geometry of this element """
+        positions = []
+        if self.geometry is not None:
+            positions.extend(self.geometry.known_positions())
+        for member in self.members:
+            if member.geometry is not None:
+                positions.extend(member.geometry.positions)
+        return positions
+
+    def to_json(self):
+        """ The element as a dictionary that can be serialized as JSON
+
+        Attributes keep their xml names, with ints and coordinates as numbers and
+        visible as a boolean. bounds is [minlon, minlat, maxlon, maxlat], a way has
+        its node ids in nodes and their [lon, lat] or null in geometry, and tags is
+        an object.
+
+        """
+        obj = {"type": self.type}
+        for name in self.attrs:
+            if name in ELEMENT_ATTRS:
+                value = getattr(self, name)
+            else:
+                value = self.extra[name]
+            if value is None:
+                continue
+            if name in ("lat", "lon"):
+                value = round(value, 7)
+            elif name in ("visible", "truncated"):
+                value = value == "true"
+            obj[name] = value
+        if self.bounds is not None:
+            obj["bounds"] = [round(value, 7) for value in self.bounds]
+        if self.type == "way":
+            obj["nodes"] = self.nds
+            if self.geometry is not None:
+                obj["geometry"] = self.geometry.coordinates()
+        elif self.type == "relation":
+            obj["members"] = [member.to_json() for member in self.members]
+        obj["tags"] = dict(self.tags)
+        return obj
+
+    def to_xml(self, level):
+        names = []
+        values = []
+        for name in self.attrs:
+            if name in ELEMENT_ATTRS:
+                value = getattr(self, name)
+            else:
+                value = self.extra[name]
+            if value is None:
+                continue
+            names.append(name)
+            if name in ("lat", "lon"):
+                values.append(format_coordinate(value))
+            else:
+                values.append(str(value))
+        start = "<" + self.type + _attrib(names, values)
+
+        children = []
+        if self.bounds is not None:
+            minlon, minlat, maxlon, maxlat = self.bounds
+            children.append(
+                '<bounds minlat="{}" minlon="{}" maxlat="{}" maxlon="{}" />'.format(
+                    format_coordinate(minlat),
+                    format_coordinate(minlon),
+                    format_coordinate(maxlat),
+                    format_coordinate(maxlon),
+                )
+            )
+        if self.geometry is None:
+            children.extend(_nd(ref, None) for ref in self.nds)
+        else:
+            children.extend(map(_nd, self.nds, self.geometry.formatted()))
+        for member in self.members:
+            children.append(member.to_xml(level + 1))
+        for k, v in self.tags:
+            children.append('<tag k="{}" v="{}" />'.format(escape(k), escape(v)))
+
+        if not children:
+            if self.text is not None:
+                return start + ">" + escape(self.text, TEXT_ESCAPES) + "</" + self.type + ">"
+            return start + " />"
+        i = "\n" + (level + 1) * "  "
+        return (
+            start + ">" + i + i.join(children) + "\n" + level * "  " + "</" + self.type + ">"
+        )
+
+
+class DiffAction:
+    """ One <action> of an augmented diff
+
+    type: create, modify or delete
+    old: OsmElement before the change, None for create
+    new: OsmElement after the change
+
+    """
+
+    __slots__ = ("type", "old", "new")
+
+    def __init__(self, type, old, new):
+        self.type = type
+        self.old = old
+        self.new = new
+
+    def elements(self):
+        return [self.new] if self.old is None else [self.old, self.new]
+
+    def to_json(self):
+        obj = {"type": "action", "action": self.type}
+        if self.old is not None:
+            obj["old"] = self.old.to_json()
+        obj["new"] = self.new.to_json()
+        return obj
+
+    def to_xml(self, level):
+        i = "\n" + (level + 1) * "  "
+        end = "\n" + level * "  " + "</action>"
+        start = '<action type="{}">'.format(self.type)
+        if self.old is None:
+            return start + i + self.new.to_xml(level + 1) + end
+        j = "\n" + (level + 2) * "  "
+        return (
+            start
+            + i
+            + "<old>"
+            + j
+            + self.old.to_xml(level + 2)
+            + i
+            + "</old>"
+            + i
+            + "<new>"
+            + j
+            + self.new.to_xml(level + 2)
+            + i
+            + "</new>"
+            + end
+        )
+
+
+class SerializedActions:
+    """ Consecutive actions already serialized with to_xml(level=1), or as JSON lines """
+
+    __slots__ = ("serialized",)
+
+    def __init__(self, serialized):
+        self.serialized = serialized
+
+    def to_xml(self, level):
+        return ("\n" + level * "  ").join(self.serialized)
+
+    def to_json_lines(self):
+        return "\n".join(self.serialized)
@@ -0,0 +1,113 @@
+from collections import namedtuple
+import logging
+import sys
+import xml.etree.ElementTree as ET
+
+from .model import OsmElement
+
+osc_logger = logging.getLogger(__name__)
+osc_logger.setLevel(logging.INFO)
+osc_logger.addHandler(logging.StreamHandler(sys.stdout))
+
+Action = namedtuple("Action", ["type", "element"])
+
+
+def read_actions(osc_file, logger=None):
+    """ Incrementally read an osmChange document into a dict of actions
+
+    osc_file: path or file-like object containing the osmChange xml
+
+    Returns a dictionary from (osm_type, osm_id) to Action, e.g. ("node", 12345) > Action(),
+    in the order each key was first seen in osc_file. Action.element is an OsmElement.
+
+    The document is read with iterparse and each element is converted to an OsmElement
+    and detached from its parent block once it has been read, so only the actions are
+    held in memory rather than the whole osmChange tree.
+
+    """
+    if logger is None:
+        logger = osc_logger
+
+    actions = {}
+    root = None
+    block = None
+    depth = 0
+    for event, e in ET.iterparse(osc_file, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if depth == 1:
+                root = e
+            elif depth == 2:
+                block = e
+            continue
+
+        depth -= 1
+        if depth == 1:
+            # Finished a create|modify|delete block
+            root.remove(block)
+            block = None
+            continue
+        if depth != 2:
+            continue
+
+        # Finished an OSM element, detach it and keep only its OsmElement
+        block.remove(e)
+        elem = OsmElement.from_xml(e)
+        action_key = (elem.type, elem.id)
+        if action_key in actions:
+            old_action = actions[action_key]
+            old_version = old_action.element.version
+            new_version = elem.version
+            # Remove elements created and then deleted in the same interval
+            # TODO: This will not capture any element that is also modified
+            #       between create and delete.
+            if old_action.type == "create" and block.tag == "delete":
+                logger.warning(
+                    "Skipping element {}/{} which was created and deleted "
+                    "within the interval".format(*action_key)
+                )
+                del actions[action_key]
+                continue
+            # Always ensure we're updating to the latest version of an object for the diff
+            elif new_version < old_version:
+                logger.warning(
+                    "Skipping element {}/{}, new version {} is older than version {}".format(
+                        *action_key, new_version, old_version
+                    )
+                )
+                continue
+        actions[action_key] = Action(block.tag, elem)
+
+    return actions
+
+
+def merge_osmchanges(osc_files, fp):
+    """ Write the changes of several osmChange documents as a single osmChange
+
+    osc_files: paths or file-like objects, in the order their changes were made
+    fp: binary file-like object the merged osmChange is written to
+
+    The create|modify|delete blocks of each document are copied in order, so
+    applying the merged osmChange has the same result as applying each in turn.
+    Elements changed by more than one document are not deduplicated, each of their
+    versions is kept in file order and the last one is what's committed.
+    Only one block is held in memory at a time.
+
+    """
+    fp.write(b"<?xml version='1.0' encoding='UTF-8'?>\n")
+    fp.write(b'<osmChange version="0.6" generator="onramp">\n')
+    for osc_file in osc_files:
+        root = None
+        depth = 0
+        for event, e in ET.iterparse(osc_file, events=("start", "end")):
+            if event == "start":
+                depth += 1
+                if depth == 1:
+                    root = e
+                continue
+            depth -= 1
+            if depth == 1:
+                e.tail = "\n"
+                fp.write(b"  " + ET.tostring(e, encoding="unicode").encode("utf-8"))
+                root.remove(e)
+    fp.write(b"</osmChange>\n")
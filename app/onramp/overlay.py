@@ -0,0 +1,176 @@
+""" In-memory overlay of changes that have been diffed but not yet committed to osmx
+
+When catching up on several sequences, each augmented diff must be generated
+against the state of the osmx db just before its osmChange. Rather than
+committing every osmChange with its own `osmx update`, the changes of each one
+are applied to an Overlay once its diff is written. Reads through an OsmxLookup
+created with the overlay then see the db as if they had been committed, and all
+of the osmChanges can be applied with one batched commit.
+
+Records in the overlay mimic the osmx objects that the diff reads, a value of
+None marks an element that has been deleted.
+
+"""
+import calendar
+from collections import namedtuple
+import time
+
+Metadata = namedtuple("Metadata", ["version", "timestamp", "changeset", "uid", "user"])
+Node = namedtuple("Node", ["tags", "metadata"])
+Way = namedtuple("Way", ["nodes", "tags", "metadata"])
+Relation = namedtuple("Relation", ["members", "tags", "metadata"])
+RelationMember = namedtuple("RelationMember", ["type", "ref", "role"])
+
+# Marks ids that weren't in a table before apply(), see Overlay.revert
+_ABSENT = object()
+
+# Reverse index of relation members by member type, see OsmxLookup
+MEMBER_INDEXES = {
+    "node": "node_relation",
+    "way": "way_relation",
+    "relation": "relation_relation",
+}
+
+
+def flat_tags(tags):
+    """ Convert [(k1, v1), (k2, v2), ...] to the osmx tag list [k1, v1, k2, v2, ...] """
+    return [value for tag in tags for value in tag]
+
+
+def metadata(elem):
+    """ Metadata of an OsmElement read from an osmChange, as osmx stores it """
+    timestamp = 0
+    if elem.timestamp is not None:
+        timestamp = calendar.timegm(time.strptime(elem.timestamp, "%Y-%m-%dT%H:%M:%SZ"))
+    return Metadata(
+        version=elem.version or 0,
+        timestamp=timestamp,
+        changeset=elem.changeset or 0,
+        uid=elem.uid or 0,
+        user=elem.user or "",
+    )
+
+
+class Overlay:
+    """ Changes of osmChanges that haven't been committed to the osmx db yet
+
+    tables maps each OsmxLookup table name to a dictionary from id to the value
+    that table would return once the changes are committed.
+
+    """
+
+    def __init__(self):
+        self.tables = {
+            "locations": {},
+            "nodes": {},
+            "ways": {},
+            "relations": {},
+            "node_way": {},
+            "node_relation": {},
+            "way_relation": {},
+            "relation_relation": {},
+        }
+        # Values that the last apply() replaced, (table, id) > value, see revert()
+        self.replaced = {}
+
+    def clear(self):
+        """ Forget every change, once they have been committed """
+        for table in self.tables.values():
+            table.clear()
+        self.replaced = {}
+
+    def revert(self):
+        """ Undo the last apply(), e.g. to generate the same augmented diff again """
+        for (name, i), value in self.replaced.items():
+            if value is _ABSENT:
+                del self.tables[name][i]
+            else:
+                self.tables[name][i] = value
+        self.replaced = {}
+
+    def apply(self, actions, db):
+        """ Apply the changes of one osmChange on top of the overlay
+
+        actions: dictionary from (osm_type, osm_id) to osc.Action, see osc.read_actions
+        db: OsmxLookup created with this overlay, used to read the state before the changes
+
+        Only the type and id of delete actions are used, so actions may already have
+        been turned into augmented diff actions.
+
+        """
+        locations = {}
+        nodes = {}
+        ways = {}
+        relations = {}
+        # Changes to the reverse indexes, (table, id) > [ids to remove, ids to add]
+        index_changes = {}
+
+        def change_index(table, ids, elem_id, add):
+            for i in ids:
+                index_changes.setdefault((table, i), (set(), set()))[add].add(elem_id)
+
+        for (osm_type, elem_id), action in actions.items():
+            elem = action.element
+            deleted = action.type == "delete"
+            if osm_type == "node":
+                if deleted:
+                    locations[elem_id] = None
+                    nodes[elem_id] = None
+                    continue
+                if elem.lat is None or elem.lon is None:
+                    locations[elem_id] = None
+                else:
+                    locations[elem_id] = (elem.lat, elem.lon, elem.version)
+                nodes[elem_id] = Node(flat_tags(elem.tags), metadata(elem)) if elem.tags else None
+            elif osm_type == "way":
+                old = db.ways.get(elem_id)
+                old_nodes = set(old.nodes) if old is not None else set()
+                new_nodes = set() if deleted else set(elem.nds)
+                change_index("node_way", old_nodes - new_nodes, elem_id, False)
+                change_index("node_way", new_nodes - old_nodes, elem_id, True)
+                if deleted:
+                    ways[elem_id] = None
+                else:
+                    ways[elem_id] = Way(list(elem.nds), flat_tags(elem.tags), metadata(elem))
+            else:
+                old = db.relations.get(elem_id)
+                old_members = set()
+                if old is not None:
+                    old_members = {(str(m.type), m.ref) for m in old.members}
+                new_members = set()
+                if not deleted:
+                    new_members = {(m.type, m.ref) for m in elem.members}
+                for member_type, ref in old_members - new_members:
+                    if member_type in MEMBER_INDEXES:
+                        change_index(MEMBER_INDEXES[member_type], [ref], elem_id, False)
+                for member_type, ref in new_members - old_members:
+                    if member_type in MEMBER_INDEXES:
+                        change_index(MEMBER_INDEXES[member_type], [ref], elem_id, True)
+                if deleted:
+                    relations[elem_id] = None
+                else:
+                    members = [RelationMember(m.type, m.ref, m.role) for m in elem.members]
+                    relations[elem_id] = Relation(members, flat_tags(elem.tags), metadata(elem))
+
+        # Read every reverse index entry before any of the overlay is changed
+        indexes = {}
+        for (table, i), (removed, added) in index_changes.items():
+            current = set(getattr(db, table).get(i))
+            indexes[(table, i)] = tuple(sorted((current - removed) | added))
+
+        self.replaced = {}
+        for name, values in (
+            ("locations", locations),
+            ("nodes", nodes),
+            ("ways", ways),
+            ("relations", relations),
+        ):
+            for i, value in values.items():
+                self._set(name, i, value)
+        for (name, i), ids in indexes.items():
+            self._set(name, i, ids)
+
+    def _set(self, name, i, value):
+        table = self.tables[name]
+        self.replaced.setdefault((name, i), table.get(i, _ABSENT))
+        table[i] = value
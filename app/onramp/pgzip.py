@@ -0,0 +1,139 @@
+""" Multi-threaded gzip compression in the style of pigz
+
+Input is cut into blocks which are deflated on a thread pool, zlib releases the
+GIL while it compresses. Each block is primed with the last 32KB of the block
+before it, so compression is nearly as good as a single stream, and all but the
+last block end on a byte boundary with a sync flush. The compressed blocks are
+written in order between a single gzip header and trailer, so the result is one
+ordinary gzip stream that gunzip and gzip.open read as usual.
+
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+import struct
+import time
+import zlib
+
+BLOCK_SIZE = 128 * 1024
+# Size of the deflate window, the most history a block can refer back to
+DICT_SIZE = 32 * 1024
+
+
+def _deflate(data, zdict, level, last):
+    """ Returns (the deflated block, seconds spent deflating it) """
+    start = time.perf_counter()
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    )
+    return deflated, time.perf_counter() - start
+
+
+class ParallelGzipWriter:
+    """ Binary file-like object that writes what is written to it gzipped to fileobj
+
+    level: zlib compression level, 1-9
+    threads: number of compression threads, defaults to the number of CPUs
+    block_size: bytes of input compressed by each task
+
+    fileobj is not closed by close(). Once closed, stats() returns the amount of
+    input, the throughput of the compression threads and how long writing waited
+    for them.
+
+    """
+
+    def __init__(self, fileobj, level=6, threads=None, block_size=BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.zdict = b""
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+        # Seconds spent deflating in all threads, and waiting for them in write/close
+        self.deflate_time = 0
+        self.wait_time = 0
+        self.closed = False
+        self._write_out(
+            struct.pack("<BBBBLBB", 0x1F, 0x8B, 8, 0, int(time.time()), 0, 255)
+        )
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) > self.block_size:
+            block = bytes(self.buffer[: self.block_size])
+            del self.buffer[: self.block_size]
+            self._submit(block, last=False)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _submit(self, block, last):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append(
+            self.executor.submit(_deflate, block, self.zdict, self.level, last)
+        )
+        self.zdict = (self.zdict + block)[-DICT_SIZE:]
+        # Bound the compressed blocks held in memory
+        while len(self.pending) > 2 * self.threads:
+            self._write_next()
+
+    def _write_next(self):
+        start = time.perf_counter()
+        data, seconds = self.pending.popleft().result()
+        self.wait_time += time.perf_counter() - start
+        self.deflate_time += seconds
+        self._write_out(data)
+
+    def _write_out(self, data):
+        self.compressed_size += len(data)
+        self.fileobj.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._submit(bytes(self.buffer), last=True)
+            self.buffer = bytearray()
+            while self.pending:
+                self._write_next()
+            self._write_out(struct.pack("<LL", self.crc, self.size & 0xFFFFFFFF))
+        finally:
+            self.executor.shutdown()
+
+    def stats(self):
+        """ Returns (input bytes, compressed bytes, input MB/s of one compression thread,
+        seconds that writing waited for compression)
+
+        Only time spent deflating counts towards the rate, not the time that the input
+        took to be written, e.g. while an augmented diff is generated.
+
+        """
+        rate = self.size / 1e6 / self.deflate_time if self.deflate_time > 0 else 0
+        return self.size, self.compressed_size, rate, self.wait_time
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.closed = True
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown()
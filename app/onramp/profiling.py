@@ -0,0 +1,182 @@
+""" Opt-in profiling of augmented diffs that are slow, use a lot of memory, or are sampled
+
+cProfile and tracemalloc slow a diff down several times, so they are only turned
+on for one in every N diffs. Every other diff only has its duration and peak RSS
+measured. When one of those is over a threshold, the diff is generated again under
+the profiler before its changes are committed, so the profile is of the same osmx
+db state and osmChange that made it slow. That makes the slow diff slower still, so
+set the thresholds to catch outliers rather than every busy minute.
+
+"""
+import cProfile
+import logging
+import os
+import pstats
+import resource
+import sys
+import time
+import tracemalloc
+
+profiling_logger = logging.getLogger(__name__)
+profiling_logger.setLevel(logging.INFO)
+profiling_logger.addHandler(logging.StreamHandler(sys.stdout))
+
+# Lines of each table in the .txt summary of a profile
+SUMMARY_LINES = 30
+
+
+def reset_peak_rss():
+    """ Reset the peak RSS of this process, returns False where that isn't supported
+
+    Only Linux allows this, by writing 5 to /proc/self/clear_refs.
+
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    """ Peak RSS of this process in bytes, since it started or reset_peak_rss() """
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+
+
+class DiffProfiler:
+    """ Decide which augmented diffs to profile, and write their profiles to output_dir
+
+    sample: profile every sample-th diff, 0 to not sample any
+    max_seconds: profile diffs that take longer than this many seconds
+    max_memory: profile diffs during which the peak RSS of this process is higher than
+                this many bytes. Worker processes in parallel mode aren't included.
+    frames: number of frames of each allocation traceback that tracemalloc records
+
+    For each diff that is profiled, output_dir gets <tag>.prof, which can be read with
+    pstats or snakeviz, <tag>.tracemalloc, a tracemalloc.Snapshot that can be read
+    with tracemalloc.Snapshot.load, and <tag>.txt, a summary of both and the reason the
+    diff was profiled. In parallel mode only the main process is profiled, see
+    profiled_augmented_diff in osmx-update.
+
+    """
+
+    def __init__(
+        self,
+        output_dir,
+        sample=0,
+        max_seconds=None,
+        max_memory=None,
+        frames=10,
+        logger=None,
+    ):
+        self.output_dir = output_dir
+        self.sample = sample
+        self.max_seconds = max_seconds
+        self.max_memory = max_memory
+        self.frames = frames
+        self.logger = logger if logger is not None else profiling_logger
+        self.diffs = 0
+        if max_memory is not None and not reset_peak_rss():
+            self.logger.warning(
+                "Peak RSS can't be reset on this system, so the memory threshold is "
+                "compared with the peak RSS of the whole process"
+            )
+
+    @property
+    def has_thresholds(self):
+        return self.max_seconds is not None or self.max_memory is not None
+
+    def path(self, tag, suffix):
+        return os.path.join(self.output_dir, tag + suffix)
+
+    def run(self, tag, diff, rerun=None):
+        """ Call diff(), which generates an augmented diff, and profile it if needed
+
+        tag: name of the profile files, e.g. the osc sequence and adiff id
+        rerun: function that generates the same diff again without side effects, which
+               is profiled if diff() was over a threshold. If None, such diffs are only
+               logged.
+
+        Returns the result of diff().
+
+        """
+        self.diffs += 1
+        if self.sample > 0 and self.diffs % self.sample == 0:
+            return self.profile(tag, "1 in {} sample".format(self.sample), diff)
+        if not self.has_thresholds:
+            return diff()
+
+        reset_peak_rss()
+        start = time.perf_counter()
+        result = diff()
+        seconds = time.perf_counter() - start
+        memory = peak_rss()
+
+        reasons = []
+        if self.max_seconds is not None and seconds > self.max_seconds:
+            reasons.append("took {:.2f}s, over {}s".format(seconds, self.max_seconds))
+        if self.max_memory is not None and memory > self.max_memory:
+            reasons.append(
+                "peak RSS {:.0f}MB, over {:.0f}MB".format(memory / 1e6, self.max_memory / 1e6)
+            )
+        if reasons and rerun is None:
+            self.logger.info("Augmented diff {} {}".format(tag, ", ".join(reasons)))
+        elif reasons:
+            reason = ", ".join(reasons)
+            self.logger.info("Augmented diff {} {}, profiling it again".format(tag, reason))
+            self.profile(tag, reason, rerun)
+        return result
+
+    def profile(self, tag, reason, func):
+        """ Call func() with cProfile and tracemalloc on and write the results """
+        profile = cProfile.Profile()
+        tracemalloc.start(self.frames)
+        reset_peak_rss()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            return func()
+        finally:
+            profile.disable()
+            seconds = time.perf_counter() - start
+            snapshot = tracemalloc.take_snapshot()
+            _, traced_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            try:
+                self.write(tag, reason, profile, snapshot, seconds, peak_rss(), traced_peak)
+            except OSError as e:
+                self.logger.warning("Could not write profile of {}: {}".format(tag, e))
+
+    def write(self, tag, reason, profile, snapshot, seconds, memory, traced_peak):
+        os.makedirs(self.output_dir, exist_ok=True)
+        profile.dump_stats(self.path(tag, ".prof"))
+        snapshot.dump(self.path(tag, ".tracemalloc"))
+        with open(self.path(tag, ".txt"), "w") as fp:
+            fp.write("Augmented diff {}\n".format(tag))
+            fp.write("Profiled because: {}\n".format(reason))
+            fp.write(
+                "{:.3f}s with profiling, peak RSS {:.1f}MB, peak traced {:.1f}MB\n\n".format(
+                    seconds, memory / 1e6, traced_peak / 1e6
+                )
+            )
+            stats = pstats.Stats(profile, stream=fp)
+            stats.sort_stats("cumulative").print_stats(SUMMARY_LINES)
+            stats.sort_stats("tottime").print_stats(SUMMARY_LINES)
+            fp.write("Largest allocations still held at the end of the diff:\n\n")
+            for stat in snapshot.statistics("lineno")[:SUMMARY_LINES]:
+                fp.write("{}\n".format(stat))
+        self.logger.info(
+            "Profile of augmented diff {} written to {}".format(
+                tag, self.path(tag, ".{prof,tracemalloc,txt}")
+            )
+        )
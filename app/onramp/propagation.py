@@ -0,0 +1,128 @@
+""" Find the ways and relations that an osmChange changes without containing them
+
+When a node moves, every way and relation it is a member of changes shape, and so
+do the relations of those ways. When a way's node list changes, so do its relations.
+Relations can be members of other relations too, e.g. routes of a route master or
+the boundaries of a boundary hierarchy, so any relation whose geometry changes also
+changes its parent relations, up to the depth of the hierarchy.
+
+Each level of the walk is read from the osmx reverse indexes as one batch of
+deduplicated, sorted ids, and every read is memoized by the OsmxLookup for the rest
+of the diff, so the number of lookups is bounded by the number of elements reached.
+
+"""
+from .geometry import format_coordinate
+
+# Levels of parent relations that changes propagate through by default
+DEFAULT_RELATION_DEPTH = 4
+
+
+def formatted_location(elem):
+    """ (lat, lon) of a node as written to the augmented diff """
+    return tuple(
+        format_coordinate(value) if value is not None else None for value in (elem.lat, elem.lon)
+    )
+
+
+class Propagation:
+    """ Ways and relations changed by actions without being in them
+
+    actions: dictionary from (osm_type, osm_id) to osc.Action, see osc.read_actions
+    db: lookup.OsmxLookup of the db before the actions
+    relation_depth: levels of parent relations to walk up from each relation whose
+                    geometry changed, 0 to not use relation_relation at all
+    changes: optional subset of actions to propagate from, e.g. those in the regions of
+             regions.RegionFilter, all of actions by default
+
+    Call run() before any of the actions are built, it only reads the db and actions.
+
+    """
+
+    def __init__(self, actions, db, relation_depth=DEFAULT_RELATION_DEPTH, changes=None):
+        self.actions = actions
+        self.changes = changes if changes is not None else actions
+        self.db = db
+        self.relation_depth = relation_depth
+        self.affected_ways = set()
+        self.affected_relations = set()
+
+    def modified(self, osm_type):
+        """ (id, element) of each modify action of osm_type """
+        return [
+            (elem_id, action.element)
+            for (action_type, elem_id), action in self.changes.items()
+            if action_type == osm_type and action.type == "modify"
+        ]
+
+    def moved_nodes(self):
+        """ Ids of modified nodes whose location is different in the db """
+        modified = self.modified("node")
+        self.db.locations.prefetch(elem_id for elem_id, _ in modified)
+        moved = []
+        for elem_id, elem in modified:
+            location = self.db.locations.get(elem_id)
+            # Not in the db, so the action is a create
+            if not location:
+                continue
+            old = tuple(format_coordinate(value) for value in location[:2])
+            if old != formatted_location(elem):
+                moved.append(elem_id)
+        return moved
+
+    def reshaped_ways(self):
+        """ Ids of modified ways whose node list is different in the db """
+        modified = self.modified("way")
+        self.db.ways.prefetch(elem_id for elem_id, _ in modified)
+        reshaped = []
+        for elem_id, elem in modified:
+            way = self.db.ways.get(elem_id)
+            if way and list(way.nodes) != elem.nds:
+                reshaped.append(elem_id)
+        return reshaped
+
+    def changed_relations(self):
+        """ Ids of modified relations whose member list is different in the db """
+        modified = self.modified("relation")
+        self.db.relations.prefetch(elem_id for elem_id, _ in modified)
+        changed = []
+        for elem_id, elem in modified:
+            relation = self.db.relations.get(elem_id)
+            if not relation:
+                continue
+            old = [(str(m.type), m.ref, m.role) for m in relation.members]
+            if old != [(m.type, m.ref, m.role) for m in elem.members]:
+                changed.append(elem_id)
+        return changed
+
+    def parents(self, table, elem_ids):
+        """ Union of table.get(elem_id) for elem_ids, read as one sorted batch """
+        table.prefetch(elem_ids)
+        parents = set()
+        for elem_id in elem_ids:
+            parents.update(table.get(elem_id))
+        return parents
+
+    def run(self):
+        """ Fill in affected_ways and affected_relations, and return them """
+        moved = self.moved_nodes()
+        ways = self.parents(self.db.node_way, moved)
+        self.affected_ways = {w for w in ways if ("way", w) not in self.actions}
+
+        # Relations whose geometry changed, whether or not they are in actions
+        changed = self.parents(self.db.node_relation, moved)
+        changed |= self.parents(
+            self.db.way_relation, self.affected_ways.union(self.reshaped_ways())
+        )
+        self.affected_relations = {r for r in changed if ("relation", r) not in self.actions}
+
+        frontier = changed.union(self.changed_relations())
+        seen = set(frontier)
+        for _ in range(self.relation_depth):
+            if not frontier:
+                break
+            frontier = self.parents(self.db.relation_relation, frontier) - seen
+            seen |= frontier
+            self.affected_relations.update(
+                r for r in frontier if ("relation", r) not in self.actions
+            )
+        return self.affected_ways, self.affected_relations
@@ -0,0 +1,306 @@
+""" Regions that augmented diffs can be limited to, one diff per region from a single run
+
+A region is a bbox or a set of polygons. A change is in a region when any location
+of the changed element, before or after the change, is inside it: the node itself,
+the nodes of a way, or the node members and the nodes of the way members of a
+relation. Members that are relations aren't followed.
+
+Actions of the osmChange that aren't in any region are dropped by RegionFilter as
+soon as their locations are read, before anything is built, augmented or propagated
+from, so the cost of a diff grows with the changes in the regions rather than with
+the whole osmChange. See diff.regional_augmented_diffs.
+
+"""
+from itertools import chain
+import json
+from math import floor
+
+# Degrees per side of the cells of a RegionIndex
+DEFAULT_CELL_SIZE = 1.0
+
+
+class Region:
+    """ An area made of polygons, each a list of rings of (lon, lat)
+
+    The first ring of a polygon is its outer ring and any others are holes. Points
+    are inside if they are inside an odd number of rings, so polygons must not
+    overlap.
+
+    """
+
+    def __init__(self, name, polygons):
+        self.name = name
+        self.polygons = polygons
+        self.is_bbox = False
+        edges = [
+            (x1, y1, x2, y2)
+            for polygon in polygons
+            for ring in polygon
+            for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1])
+            if y1 != y2
+        ]
+        points = [point for polygon in polygons for ring in polygon for point in ring]
+        if not points:
+            raise ValueError("Region {} has no coordinates".format(name))
+        self.bbox = (
+            min(x for x, _ in points),
+            min(y for _, y in points),
+            max(x for x, _ in points),
+            max(y for _, y in points),
+        )
+
+        # Edges by the horizontal strips they cross, so a point is only tested against
+        # the edges of its own strip
+        self.strip_count = max(1, min(1024, len(edges) // 4))
+        self.strip_height = (self.bbox[3] - self.bbox[1]) / self.strip_count or 1
+        self.strips = [[] for _ in range(self.strip_count)]
+        for edge in edges:
+            low, high = sorted((edge[1], edge[3]))
+            for i in range(self.strip(low), self.strip(high) + 1):
+                self.strips[i].append(edge)
+
+    @classmethod
+    def from_bbox(cls, name, minlon, minlat, maxlon, maxlat):
+        region = cls(
+            name, [[[(minlon, minlat), (maxlon, minlat), (maxlon, maxlat), (minlon, maxlat)]]]
+        )
+        region.is_bbox = True
+        return region
+
+    def strip(self, lat):
+        i = int((lat - self.bbox[1]) / self.strip_height)
+        return min(max(i, 0), self.strip_count - 1)
+
+    def contains(self, lon, lat):
+        minlon, minlat, maxlon, maxlat = self.bbox
+        if not (minlon <= lon <= maxlon and minlat <= lat <= maxlat):
+            return False
+        if self.is_bbox:
+            return True
+        inside = False
+        for x1, y1, x2, y2 in self.strips[self.strip(lat)]:
+            if (y1 > lat) != (y2 > lat) and lon < (x2 - x1) * (lat - y1) / (y2 - y1) + x1:
+                inside = not inside
+        return inside
+
+
+class RegionIndex:
+    """ Grid of cell_size degree cells over regions, to find the regions of locations
+
+    Each cell lists the regions whose bbox overlaps it, so a location is only tested
+    against the regions near it.
+
+    """
+
+    def __init__(self, regions, cell_size=DEFAULT_CELL_SIZE):
+        self.regions = regions
+        self.cell_size = cell_size
+        self.cells = {}
+        for i, region in enumerate(regions):
+            minlon, minlat, maxlon, maxlat = region.bbox
+            for x in range(self.cell(minlon), self.cell(maxlon) + 1):
+                for y in range(self.cell(minlat), self.cell(maxlat) + 1):
+                    self.cells.setdefault((x, y), []).append(i)
+
+    def cell(self, value):
+        return int(floor(value / self.cell_size))
+
+    def matching(self, locations):
+        """ Indexes of the regions that contain any of an iterable of (lon, lat) """
+        found = set()
+        for lon, lat in locations:
+            if lon is None or lat is None:
+                continue
+            candidates = self.cells.get((self.cell(lon), self.cell(lat)), ())
+            for i in candidates:
+                if i not in found and self.regions[i].contains(lon, lat):
+                    found.add(i)
+                    if len(found) == len(self.regions):
+                        return found
+        return found
+
+
+class RegionFilter:
+    """ The actions of an osmChange that are in any of the regions of an index
+
+    actions: dictionary from (osm_type, osm_id) to osc.Action, see osc.read_actions
+    db: lookup.OsmxLookup of the db before the actions
+    index: RegionIndex
+
+    Locations are read in id order one element type at a time, and memoized by db for
+    the rest of the diff, so actions that are kept don't read them again.
+
+    """
+
+    def __init__(self, actions, db, index):
+        self.actions = actions
+        self.db = db
+        self.index = index
+
+    def of_type(self, osm_type):
+        return [
+            (elem_id, action)
+            for (action_type, elem_id), action in self.actions.items()
+            if action_type == osm_type
+        ]
+
+    def new_element(self, osm_type, elem_id, use_new):
+        """ Element of the action of elem_id if use_new and it isn't a delete
+
+        Deleted elements are read from the db, as the diff keeps their last state for the
+        relations that still have them as members.
+
+        """
+        if not use_new:
+            return None
+        action = self.actions.get((osm_type, elem_id))
+        if action is None or action.type == "delete":
+            return None
+        return action.element
+
+    def node_location(self, ref, use_new):
+        """ (lon, lat) of a node, None if it isn't known """
+        node = self.new_element("node", ref, use_new)
+        if node is not None:
+            return (node.lon, node.lat)
+        location = self.db.locations.get(ref)
+        return (location[1], location[0]) if location else None
+
+    def way_node_ids(self, way_id, use_new):
+        way = self.new_element("way", way_id, use_new)
+        if way is not None:
+            return way.nds
+        way = self.db.ways.get(way_id)
+        return way.nodes if way else ()
+
+    def locations(self, node_ids, use_new):
+        for ref in node_ids:
+            location = self.node_location(ref, use_new)
+            if location is not None:
+                yield location
+
+    def relation_locations(self, members, use_new):
+        for member_type, ref in members:
+            if member_type == "node":
+                location = self.node_location(ref, use_new)
+                if location is not None:
+                    yield location
+            elif member_type == "way":
+                yield from self.locations(self.way_node_ids(ref, use_new), use_new)
+
+    def prefetch_members(self, members):
+        """ Read the ways and node locations of relation members in id order """
+        way_ids = [ref for member_type, ref in members if member_type == "way"]
+        self.db.ways.prefetch(way_ids)
+        node_refs = [ref for member_type, ref in members if member_type == "node"]
+        for way_id in way_ids:
+            new_way = self.new_element("way", way_id, True)
+            if new_way is not None:
+                node_refs.extend(new_way.nds)
+            way = self.db.ways.peek(way_id)
+            if way is not None:
+                node_refs.extend(way.nodes)
+        self.db.locations.prefetch(node_refs)
+
+    def run(self):
+        """ Dictionary of the actions that are in any region """
+        selected = {}
+
+        nodes = self.of_type("node")
+        self.db.locations.prefetch(elem_id for elem_id, _ in nodes)
+        for elem_id, action in nodes:
+            locations = [(action.element.lon, action.element.lat)]
+            if action.type != "create":
+                locations.append(self.node_location(elem_id, False))
+            if self.index.matching(loc for loc in locations if loc is not None):
+                selected[("node", elem_id)] = action
+
+        ways = self.of_type("way")
+        self.db.ways.prefetch(elem_id for elem_id, action in ways if action.type != "create")
+        node_refs = [ref for _, action in ways for ref in action.element.nds]
+        for elem_id, action in ways:
+            if action.type != "create":
+                node_refs.extend(self.way_node_ids(elem_id, False))
+        self.db.locations.prefetch(
+            ref for ref in node_refs if self.new_element("node", ref, True) is None
+        )
+        for elem_id, action in ways:
+            node_ids = self.way_node_ids(elem_id, True)
+            if self.index.matching(self.locations(node_ids, True)) or (
+                action.type != "create"
+                and self.index.matching(self.locations(self.way_node_ids(elem_id, False), False))
+            ):
+                selected[("way", elem_id)] = action
+
+        relations = self.of_type("relation")
+        self.db.relations.prefetch(
+            elem_id for elem_id, action in relations if action.type != "create"
+        )
+        members = []
+        for elem_id, action in relations:
+            relation = self.db.relations.get(elem_id) if action.type != "create" else None
+            members.append(
+                (
+                    [(m.type, m.ref) for m in action.element.members],
+                    [(str(m.type), m.ref) for m in relation.members] if relation else [],
+                )
+            )
+        self.prefetch_members(
+            [member for new, old in members for member in chain(new, old)]
+        )
+        for (elem_id, action), (new, old) in zip(relations, members):
+            if self.index.matching(self.relation_locations(new, True)) or self.index.matching(
+                self.relation_locations(old, False)
+            ):
+                selected[("relation", elem_id)] = action
+        return selected
+
+
+def load_regions(path):
+    """ Regions of each Polygon or MultiPolygon feature of a GeoJSON FeatureCollection
+
+    A feature without a geometry but with a "bbox" of [minlon, minlat, maxlon, maxlat]
+    is a bbox region. Each feature needs a unique "name" property, which the diffs of
+    its region are written to a directory of.
+
+    """
+    with open(path) as fp:
+        collection = json.load(fp)
+    regions = []
+    for feature in collection.get("features", []):
+        name = (feature.get("properties") or {}).get("name")
+        geometry = feature.get("geometry") or {}
+        if not name:
+            raise ValueError("Every region in {} needs a name property".format(path))
+        if "/" in name or name in (".", ".."):
+            raise ValueError("Region name {} can't be used as a directory name".format(name))
+        if not geometry and feature.get("bbox") is not None:
+            bbox = feature["bbox"]
+            if len(bbox) != 4:
+                raise ValueError(
+                    "Region {} bbox must be [minlon, minlat, maxlon, maxlat]".format(name)
+                )
+            regions.append(Region.from_bbox(name, *bbox))
+            continue
+        if geometry.get("type") == "Polygon":
+            polygons = [geometry["coordinates"]]
+        elif geometry.get("type") == "MultiPolygon":
+            polygons = geometry["coordinates"]
+        else:
+            raise ValueError(
+                "Region {} is a {}, not a Polygon or MultiPolygon".format(
+                    name, geometry.get("type")
+                )
+            )
+        regions.append(
+            Region(
+                name,
+                [[[(x, y) for x, y, *_ in ring] for ring in polygon] for polygon in polygons],
+            )
+        )
+    names = [region.name for region in regions]
+    if len(set(names)) != len(names):
+        raise ValueError("Region names in {} are not unique".format(path))
+    if not regions:
+        raise ValueError("No regions in {}".format(path))
+    return regions
@@ -0,0 +1,170 @@
+""" Shared S3 client and a streaming multipart upload sink """
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import sys
+import threading
+
+import boto3
+from botocore.config import Config
+
+s3_logger = logging.getLogger(__name__)
+s3_logger.setLevel(logging.INFO)
+s3_logger.addHandler(logging.StreamHandler(sys.stdout))
+
+# Set to use an S3 compatible service other than AWS, e.g. a local stand-in for testing
+ENDPOINT_URL_VARIABLE = "S3_ENDPOINT_URL"
+
+# S3 multipart uploads need parts of at least 5MB, except for the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """ Return the boto3 S3 client shared by this process
+
+    boto3 clients are thread safe and keep a pool of connections, so reusing one
+    skips the credential lookup and TLS handshakes of creating one per upload.
+    The endpoint can be set with the S3_ENDPOINT_URL environment variable.
+
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = boto3.client(
+                "s3",
+                endpoint_url=os.environ.get(ENDPOINT_URL_VARIABLE) or None,
+                config=Config(max_pool_connections=16, retries={"max_attempts": 5}),
+            )
+        return _client
+
+
+class S3Writer:
+    """ Binary file-like object that uploads what is written to it to S3 as it goes
+
+    Data is cut into parts of part_size bytes which are uploaded with a multipart
+    upload in a background thread while writing continues, so at most a couple of
+    parts are held in memory. Output smaller than one part is uploaded with a single
+    put_object instead.
+
+    Use as a context manager, the upload is completed on a clean exit and aborted if
+    an exception is raised.
+
+    """
+
+    def __init__(
+        self,
+        bucket,
+        key,
+        content_type,
+        content_encoding=None,
+        part_size=DEFAULT_PART_SIZE,
+        client=None,
+    ):
+        self.bucket = bucket
+        self.key = key
+        self.extra_args = {"ContentType": content_type}
+        if content_encoding is not None:
+            self.extra_args["ContentEncoding"] = content_encoding
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.client = client if client is not None else get_client()
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.futures = []
+        self.executor = None
+        self.bytes_written = 0
+        self.closed = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_written += len(data)
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[: self.part_size])
+            del self.buffer[: self.part_size]
+            self._upload_part(part)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _upload_part(self, data):
+        if self.upload_id is None:
+            response = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self.extra_args
+            )
+            self.upload_id = response["UploadId"]
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        # Wait for the previous part so only one upload is in flight at a time
+        if self.futures:
+            self.futures[-1].result()
+        part_number = len(self.futures) + 1
+        self.futures.append(self.executor.submit(self._put_part, part_number, data))
+
+    def _put_part(self, part_number, data):
+        response = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=data,
+        )
+        return {"ETag": response["ETag"], "PartNumber": part_number}
+
+    def close(self):
+        """ Upload anything that is left and complete the upload """
+        if self.closed:
+            return
+        self.closed = True
+        if self.upload_id is None:
+            self.client.put_object(
+                Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), **self.extra_args
+            )
+            return
+        try:
+            if self.buffer or not self.futures:
+                self._upload_part(bytes(self.buffer))
+            parts = [future.result() for future in self.futures]
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.executor.shutdown()
+            self.buffer = bytearray()
+
+    def abort(self):
+        """ Discard anything written so far """
+        self.closed = True
+        self.buffer = bytearray()
+        if self.upload_id is None:
+            return
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown()
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
+        except Exception as e:
+            s3_logger.warning("Could not abort upload of {}: {}".format(self.key, e))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -1,9 +1,8 @@
-from io import BytesIO
 from math import floor
 import os
 from urllib.parse import urlparse
 
-import boto3
+from .s3 import get_client
 
 
 def datetime_to_adiff_sequence(datetime):
@@ -41,13 +40,13 @@ def write_augmented_diff_status(output_path, sequence_id):
     status_filename = "status.txt"
     if output_path.startswith("s3"):
         url = urlparse(output_path)
-        s3 = boto3.resource("s3")
-        bucket = s3.Bucket(url.netloc)
-        with BytesIO() as fp:
-            fp.write(str(sequence_id).encode("utf-8"))
-            fp.seek(0)
-            key_path = os.path.join(url.path.strip("/"), status_filename)
-            bucket.upload_fileobj(fp, key_path, {"ContentType": "text/plain"})
+        key_path = os.path.join(url.path.strip("/"), status_filename)
+        get_client().put_object(
+            Bucket=url.netloc,
+            Key=key_path,
+            Body=str(sequence_id).encode("utf-8"),
+            ContentType="text/plain",
+        )
     else:
         with open(os.path.join(output_path, status_filename), "w") as fp:
             fp.write(str(sequence_id))
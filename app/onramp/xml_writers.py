@@ -1,65 +1,313 @@
+from itertools import chain
 import gzip
-from io import BytesIO
 import logging
 import os
+import queue
 import sys
+import threading
 from urllib.parse import urlparse
 
-import boto3
+import xml.etree.ElementTree as ET
+
+from .model import json_line
+from .pgzip import ParallelGzipWriter
+from .s3 import S3Writer
+from .utils import indent
 
 writer_logger = logging.getLogger(__name__)
 writer_logger.setLevel(logging.INFO)
 writer_logger.addHandler(logging.StreamHandler(sys.stdout))
 
 
-def write_xml(element_tree, output_file, logger=None):
+class StreamingTree:
+    """ Serialize a root element and an iterable of its children one child at a time
+
+    Output is identical to indenting the whole tree with utils.indent and writing
+    it with xml.etree.ElementTree.ElementTree.write, but each child is written as soon
+    as it is produced by children and no reference to it is kept, so neither the
+    whole tree nor the whole document is ever held in memory.
+
+    children may be xml.etree.ElementTree.Element or any object with a
+    to_xml(level) method returning its serialized xml, e.g. model.DiffAction.
+
+    Provides the write method of xml.etree.ElementTree.ElementTree, so it can be
+    passed to any of the writers below.
+
+    """
+
+    def __init__(self, root, children):
+        self.root = root
+        self.children = children
+
+    def write(self, fp, encoding="UTF-8"):
+        # Serialize the root with placeholder text to get its start tag
+        head = self.root.makeelement(self.root.tag, self.root.attrib)
+        head.text = "\n  "
+        start_tag = ET.tostring(head, encoding="unicode")
+        start_tag = start_tag[: -len("</{}>".format(self.root.tag))]
+
+        # Hold back one child so that the last child gets the closing tail
+        previous = None
+        for child in self.children:
+            if previous is None:
+                fp.write(start_tag.encode(encoding, "xmlcharrefreplace"))
+            else:
+                self._write_child(fp, previous, "\n  ", encoding)
+            previous = child
+
+        if previous is None:
+            fp.write(ET.tostring(head.makeelement(head.tag, head.attrib), encoding=encoding))
+        else:
+            self._write_child(fp, previous, "\n", encoding)
+            fp.write("</{}>\n".format(self.root.tag).encode(encoding))
+
+    @staticmethod
+    def _write_child(fp, child, tail, encoding):
+        if isinstance(child, ET.Element):
+            indent(child, level=1)
+            child.tail = None
+            xml = ET.tostring(child, encoding="unicode")
+        else:
+            xml = child.to_xml(level=1)
+        fp.write((xml + tail).encode(encoding, "xmlcharrefreplace"))
+
+
+class BackgroundTreeWriter:
+    """ Write a StreamingTree to output_file in a thread, with children put() as they come
+
+    For writing several outputs from one pass over the actions, as each output's
+    writer pulls its children from a StreamingTree. Children are handed over through a
+    queue of at most queue_size, so only a few of them are held in memory whatever the
+    size of the output. The other arguments are those of write_xml.
+
+    close() waits for the output to be written and returns its size, and abort()
+    raises an exception in the writer instead, which discards an S3 upload. Used as a
+    context manager, the writer is aborted if an exception is raised.
+
+    """
+
+    def __init__(
+        self,
+        root,
+        children,
+        output_file,
+        logger=None,
+        gzip_level=9,
+        gzip_threads=1,
+        queue_size=8,
+    ):
+        self.queue = queue.Queue(queue_size)
+        self.closed = False
+        self.finished = False
+        self.error = None
+        self.bytes_written = 0
+        tree = StreamingTree(root, chain(children, self._children()))
+        self.thread = threading.Thread(
+            target=self._write,
+            args=(tree, output_file, logger, gzip_level, gzip_threads),
+            daemon=True,
+        )
+        self.thread.start()
+
+    def _children(self):
+        while True:
+            child = self.queue.get()
+            if child is None:
+                self.finished = True
+                return
+            if isinstance(child, BaseException):
+                self.finished = True
+                raise child
+            yield child
+
+    def _write(self, tree, output_file, logger, gzip_level, gzip_threads):
+        try:
+            self.bytes_written = write_xml(
+                tree, output_file, logger=logger, gzip_level=gzip_level, gzip_threads=gzip_threads
+            )
+        except BaseException as e:
+            self.error = e
+            # Keep taking children, so put() doesn't block until the writer is closed
+            while not self.finished:
+                child = self.queue.get()
+                self.finished = child is None or isinstance(child, BaseException)
+
+    def put(self, child):
+        """ Write the next child of the root """
+        if self.error is not None:
+            raise self.error
+        self.queue.put(child)
+
+    def close(self):
+        """ Finish the output and return the number of bytes written """
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.bytes_written
+
+    def abort(self, error=None):
+        """ Stop writing with error, or a RuntimeError if None """
+        if self.closed:
+            return
+        self.closed = True
+        if error is None:
+            error = RuntimeError("Writing was aborted")
+        self.queue.put(error)
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort(exc_value)
+
+
+def is_ndjson(output_file):
+    """ True if output_file should be written as newline-delimited JSON """
+    return output_file.endswith((".ndjson", ".ndjson.gz"))
+
+
+def element_json(e, children=True):
+    """ xml.etree.ElementTree.Element as a dictionary with its tag as "type" """
+    obj = {"type": e.tag}
+    obj.update(e.attrib)
+    if e.text and e.text.strip():
+        obj["text"] = e.text
+    if children and len(e):
+        obj["children"] = [element_json(child) for child in e]
+    return obj
+
+
+class NdjsonTree:
+    """ Serialize a StreamingTree or ElementTree as newline-delimited JSON
+
+    The first line is the root element, e.g. {"type":"osm","version":"0.6",...},
+    followed by one line for each of its children. Children with a to_json()
+    method, like model.DiffAction, are written as that, e.g.
+    {"type":"action","action":"modify","old":{...},"new":{...}}, and any other
+    Element as its tag, attributes, text and children. Like StreamingTree,
+    children are written one at a time as they are produced.
+
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def write(self, fp, encoding="UTF-8"):
+        if isinstance(self.tree, StreamingTree):
+            root, children = self.tree.root, self.tree.children
+        else:
+            root = self.tree.getroot()
+            children = list(root)
+        fp.write((json_line(element_json(root, children=False)) + "\n").encode(encoding))
+        for child in children:
+            if hasattr(child, "to_json_lines"):
+                line = child.to_json_lines()
+            elif hasattr(child, "to_json"):
+                line = json_line(child.to_json())
+            else:
+                line = json_line(element_json(child))
+            fp.write((line + "\n").encode(encoding))
+
+
+def write_xml(element_tree, output_file, logger=None, gzip_level=9, gzip_threads=1):
     """ Write xml to output_file
 
     Autoselects appropriate writer based on output_file:
     Supports s3 and local file uris, will automatically gzip
-    XML if output_file ends in .gz
+    XML if output_file ends in .gz, and writes newline-delimited JSON
+    instead of XML if output_file ends in .ndjson or .ndjson.gz
+
+    element_tree may be an xml.etree.ElementTree.ElementTree or a StreamingTree.
+
+    gzip_level and gzip_threads are passed to the gzip writers, see gzip_write.
+
+    Returns the number of bytes written to output_file.
 
     """
+    if is_ndjson(output_file):
+        element_tree = NdjsonTree(element_tree)
     if output_file.startswith("s3"):
         if output_file.endswith(".gz"):
-            s3_gzip_writer(element_tree, output_file, logger=logger)
+            return s3_gzip_writer(
+                element_tree,
+                output_file,
+                logger=logger,
+                gzip_level=gzip_level,
+                gzip_threads=gzip_threads,
+            )
         else:
-            s3_writer(element_tree, output_file, logger=logger)
+            return s3_writer(element_tree, output_file, logger=logger)
     elif output_file.endswith(".gz"):
-        file_gzip_writer(element_tree, output_file, logger=logger)
+        return file_gzip_writer(
+            element_tree,
+            output_file,
+            logger=logger,
+            gzip_level=gzip_level,
+            gzip_threads=gzip_threads,
+        )
+    else:
+        return file_writer(element_tree, output_file, logger=logger)
+
+
+def content_type(output_file):
+    return "application/x-ndjson" if is_ndjson(output_file) else "text/xml"
+
+
+def gzip_write(element_tree, fp, logger, gzip_level=9, gzip_threads=1):
+    """ Write element_tree as gzipped xml to the binary file-like object fp
+
+    gzip_level: zlib compression level, 1-9
+    gzip_threads: if more than 1, compress blocks in parallel with a
+                  pgzip.ParallelGzipWriter and log its throughput per thread
+
+    """
+    if gzip_threads > 1:
+        with ParallelGzipWriter(fp, level=gzip_level, threads=gzip_threads) as gz:
+            element_tree.write(gz, encoding="UTF-8")
+        size, compressed_size, rate, wait_time = gz.stats()
+        logger.debug(
+            "Compressed {:.1f}MB to {:.1f}MB at {:.1f}MB/s per thread with {} threads, "
+            "waited {:.2f}s for compression".format(
+                size / 1e6, compressed_size / 1e6, rate, gzip_threads, wait_time
+            )
+        )
     else:
-        file_writer(element_tree, output_file, logger=logger)
+        with gzip.GzipFile(fileobj=fp, mode="wb", compresslevel=gzip_level) as gz:
+            element_tree.write(gz, encoding="UTF-8")
 
 
-def s3_gzip_writer(element_tree, output_file, logger=None):
+def s3_gzip_writer(element_tree, output_file, logger=None, gzip_level=9, gzip_threads=1):
     """ Write element_tree as gzipped xml to S3
 
     element_tree: xml.etree.ElementTree.ElementTree
     output_file: S3 URI
+    gzip_level, gzip_threads: see gzip_write
+
+    The compressed output is uploaded in parts while element_tree is still being
+    written, see s3.S3Writer.
 
     """
     if logger is None:
         logger = writer_logger
     url = urlparse(output_file)
-    s3 = boto3.resource("s3")
-    bucket = s3.Bucket(url.netloc)
     key_path = url.path.lstrip("/")
-    with BytesIO() as compressed_fp:
-        # Write to Gzip file handle in order to compress directly to the
-        # compressed_fp in memory buffer
-        with gzip.GzipFile(fileobj=compressed_fp, mode="wb") as gz:
-            element_tree.write(gz, encoding="UTF-8")
-        compressed_fp.seek(0)
-        bucket.upload_fileobj(
-            compressed_fp,
-            key_path,
-            {"ContentType": "text/xml", "ContentEncoding": "gzip"},
-        )
+    with S3Writer(
+        url.netloc, key_path, content_type(output_file), content_encoding="gzip"
+    ) as fp:
+        gzip_write(element_tree, fp, logger, gzip_level=gzip_level, gzip_threads=gzip_threads)
     logger.info(
         "Augmented Diff written to: Bucket {}, Path: {} (gzip=True)".format(
             url.netloc, key_path
         )
     )
+    return fp.bytes_written
 
 
 def s3_writer(element_tree, output_file, logger=None):
@@ -68,29 +316,30 @@ def s3_writer(element_tree, output_file, logger=None):
     element_tree: xml.etree.ElementTree.ElementTree
     output_file: S3 URI
 
+    The output is uploaded in parts while element_tree is still being written, see
+    s3.S3Writer.
+
     """
     if logger is None:
         logger = writer_logger
     url = urlparse(output_file)
-    s3 = boto3.resource("s3")
-    bucket = s3.Bucket(url.netloc)
-    with BytesIO() as fp:
+    key_path = url.path.lstrip("/")
+    with S3Writer(url.netloc, key_path, content_type(output_file)) as fp:
         element_tree.write(fp, encoding="UTF-8")
-        fp.seek(0)
-        key_path = url.path.lstrip("/")
-        bucket.upload_fileobj(fp, key_path, {"ContentType": "text/xml"})
     logger.info(
         "Augmented Diff written to: Bucket {}, Path: {} (gzip=False)".format(
             url.netloc, key_path
         )
     )
+    return fp.bytes_written
 
 
-def file_gzip_writer(element_tree, output_file, logger=None):
+def file_gzip_writer(element_tree, output_file, logger=None, gzip_level=9, gzip_threads=1):
     """ Write element_tree as gzipped xml to file
 
     element_tree: xml.etree.ElementTree.ElementTree
     output_file: Local or absolute string filepath
+    gzip_level, gzip_threads: see gzip_write
 
     """
     if logger is None:
@@ -98,9 +347,11 @@ def file_gzip_writer(element_tree, output_file, logger=None):
     output_path, _ = os.path.split(output_file)
     if len(output_path) > 0:
         os.makedirs(output_path, exist_ok=True)
-    with gzip.open(output_file, "wb") as fp:
-        element_tree.write(fp, encoding="UTF-8")
+    with open(output_file, "wb") as fp:
+        gzip_write(element_tree, fp, logger, gzip_level=gzip_level, gzip_threads=gzip_threads)
+        size = fp.tell()
     logger.info("Augmented Diff written to: {} (gzip=True)".format(output_file))
+    return size
 
 
 def file_writer(element_tree, output_file, logger=None):
@@ -117,4 +368,6 @@ def file_writer(element_tree, output_file, logger=None):
         os.makedirs(output_path, exist_ok=True)
     with open(output_file, "wb") as fp:
         element_tree.write(fp, encoding="UTF-8")
+        size = fp.tell()
     logger.info("Augmented Diff written to: {} (gzip=False)".format(output_file))
+    return size
@@ -5,31 +5,269 @@ Some source code from https://github.com/osmcode/pyosmium Copyright (c) 2014-201
 All rights reserved. Licensed under 2-Clause BSD, see LICENSE
 
 """
+import asyncio
+from bisect import bisect_left
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import datetime as dt
+import http.client
+import io
 import logging
 from math import ceil
+import os
+import random
 import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
 import urllib.request as urlrequest
 
 OsmosisState = namedtuple("OsmosisState", ["sequence", "timestamp"])
 DownloadResult = namedtuple("DownloadResult", ["id", "newest"])
 
+# Responses that are worth retrying, anything else >= 400 is an error straight away
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+REDIRECT_STATUSES = frozenset([301, 302, 303, 307, 308])
+MAX_REDIRECTS = 5
+
 
 log = logging.getLogger()
 
 
+class ConnectionPool(object):
+    """ Persistent keep-alive connections to one http or https host.
+
+        Connections are handed out to one thread at a time and returned
+        with put() once the response has been read completely, so a pool
+        can be shared by the threads downloading from a ReplicationServer.
+    """
+
+    def __init__(self, scheme, netloc, timeout=10, maxsize=8):
+        if scheme == "https":
+            self.connection_class = http.client.HTTPSConnection
+        else:
+            self.connection_class = http.client.HTTPConnection
+        self.netloc = netloc
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        """ Returns an idle connection, or a new one if there are none.
+            The second value is True for a connection that was reused.
+        """
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self.connect(), False
+
+    def connect(self):
+        return self.connection_class(self.netloc, timeout=self.timeout)
+
+    def put(self, conn):
+        with self.lock:
+            if len(self.idle) < self.maxsize:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+class StateCache(object):
+    """ On-disk cache of the state files of one replication server.
+
+        Published state files never change, so every OsmosisState that has
+        been downloaded is appended to the file at `path` as a
+        "sequence timestamp" line and reused by later runs. States are also
+        kept in a sorted timestamp index so that timestamp_to_sequence() can
+        start its search from the closest known states. Missing state files
+        are not cached, they may just not be published yet.
+    """
+
+    TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+    def __init__(self, path, baseurl):
+        self.path = path
+        self.states = {}
+        self.timestamps = []
+        self.sequences = []
+        self.lock = threading.Lock()
+        header = "# {}\n".format(baseurl)
+        if os.path.exists(path):
+            # Lines that can't be read, e.g. the last of a run that was killed while
+            # writing it, are skipped
+            with open(path, errors="replace") as fp:
+                if fp.readline() == header:
+                    self.load(fp)
+                else:
+                    log.warning("State cache %s is for another server, replacing it" % path)
+        if not self.states:
+            with open(path, "w") as fp:
+                fp.write(header)
+
+    def load(self, fp):
+        for line in fp:
+            try:
+                seq, ts = line.split()
+                seq = int(seq)
+                ts = dt.datetime.strptime(ts, self.TIMESTAMP_FORMAT)
+            except ValueError:
+                continue
+            if seq not in self.states:
+                self.index(OsmosisState(seq, ts.replace(tzinfo=dt.timezone.utc)))
+
+    def index(self, state):
+        self.states[state.sequence] = state
+        i = bisect_left(self.sequences, state.sequence)
+        self.sequences.insert(i, state.sequence)
+        self.timestamps.insert(i, state.timestamp)
+
+    def get(self, seq):
+        with self.lock:
+            return self.states.get(seq)
+
+    def put(self, state):
+        if state.sequence is None or state.timestamp is None:
+            return
+        with self.lock:
+            if state.sequence in self.states:
+                return
+            self.index(state)
+            with open(self.path, "a") as fp:
+                fp.write(
+                    "{} {}\n".format(
+                        state.sequence, state.timestamp.strftime(self.TIMESTAMP_FORMAT)
+                    )
+                )
+
+    def bracket(self, timestamp):
+        """ Returns the cached states closest to timestamp as (lower, upper),
+            where lower is the last state before timestamp and upper the first
+            state at or after it. Either is `None` if there is no such state.
+        """
+        with self.lock:
+            # Sequences and timestamps both increase, so either can be bisected
+            i = bisect_left(self.timestamps, timestamp)
+            lower = self.states[self.sequences[i - 1]] if i > 0 else None
+            upper = self.states[self.sequences[i]] if i < len(self.sequences) else None
+        return lower, upper
+
+
 class ReplicationServer(object):
     """ Helper functions to communicate with replication servers.
     derived from https://github.com/osmcode/pyosmium
     """
 
-    def __init__(self, url, diff_type="osc.gz"):
+    def __init__(
+        self, url, diff_type="osc.gz", timeout=10, retries=3, backoff=0.5, state_cache=None
+    ):
         self.baseurl = url
         self.diff_type = diff_type
+        # Optional path of a StateCache file
+        self.cache = StateCache(state_cache, url) if state_cache is not None else None
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pools = {}
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "bytes": 0, "retries": 0, "connections": 0}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    def get_pool(self, scheme, netloc):
+        with self.lock:
+            pool = self.pools.get((scheme, netloc))
+            if pool is None:
+                pool = ConnectionPool(scheme, netloc, timeout=self.timeout)
+                self.pools[(scheme, netloc)] = pool
+            return pool
+
+    def close(self):
+        """ Close all pooled connections. """
+        with self.lock:
+            pools, self.pools = list(self.pools.values()), {}
+        for pool in pools:
+            pool.close()
+
+    def get(self, conn, path):
+        """ Send a GET for path on conn and read the whole response. """
+        if conn.sock is None:
+            self.count("connections")
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            raise
+        self.count("requests")
+        self.count("bytes", len(body))
+        return response, body
 
     def open_url(self, url):
-        return urlrequest.urlopen(url, None, 10)
+        """ Downloads url and returns the body as a file-like object.
+
+            http and https downloads reuse pooled keep-alive connections.
+            Connection errors, timeouts and 429/5xx responses are retried
+            up to `retries` times with jittered exponential backoff. Any other
+            error response raises :code:`urllib.error.HTTPError`.
+        """
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            return urlrequest.urlopen(url, None, self.timeout)
+
+        attempt = 0
+        while True:
+            try:
+                return self.request(url)
+            except (OSError, http.client.HTTPException) as err:
+                retry = not isinstance(err, urllib.error.HTTPError) or err.code in RETRY_STATUSES
+                if not retry or attempt >= self.retries:
+                    raise
+                delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                log.warning("Retrying %s in %.1fs after error: %s" % (url, delay, err))
+                self.count("retries")
+                attempt += 1
+                time.sleep(delay)
+
+    def request(self, url):
+        """ Make one GET request for url, following redirects. """
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            pool = self.get_pool(parts.scheme, parts.netloc)
+            path = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+            conn, reused = pool.get()
+            try:
+                response, body = self.get(conn, path)
+            except (OSError, http.client.HTTPException):
+                if not reused:
+                    raise
+                # The server closed the idle connection, try once more on a new one
+                conn = pool.connect()
+                response, body = self.get(conn, path)
+            if response.will_close:
+                conn.close()
+            else:
+                pool.put(conn)
+
+            if response.status in REDIRECT_STATUSES:
+                url = urllib.parse.urljoin(url, response.getheader("Location"))
+                continue
+            if response.status >= 400:
+                raise urllib.error.HTTPError(
+                    url, response.status, response.reason, response.headers, io.BytesIO(body)
+                )
+            return io.BytesIO(body)
+        raise urllib.error.HTTPError(url, response.status, "Too many redirects", None, None)
 
     def timestamp_to_sequence(self, timestamp, balanced_search=False):
         """ Get the sequence number of the replication file that contains the
@@ -52,6 +290,13 @@ class ReplicationServer(object):
         # find a state file that is before the required timestamp
         lower = None
         lowerid = 0
+        if self.cache is not None:
+            # start from the closest states that are already known
+            lower, cached_upper = self.cache.bracket(timestamp)
+            if cached_upper is not None and cached_upper.sequence < upper.sequence:
+                upper = cached_upper
+            if lower is not None and lower.sequence + 1 >= upper.sequence:
+                return lower.sequence
         while lower is None:
             log.info("Trying with Id %s" % lowerid)
             lower = self.get_state_info(lowerid)
@@ -115,12 +360,21 @@ class ReplicationServer(object):
     def get_state_info(self, seq=None):
         """ Downloads and returns the state information for the given
             sequence. If the download is successful, a namedtuple with
-            `sequence` and `timestamp` is returned, otherwise the function
-            returns `None`.
+            `sequence` and `timestamp` is returned. If the state file does
+            not exist the function returns `None`. Other errors are raised
+            once the retries of open_url() are used up, so a flaky server is
+            not mistaken for a missing state file.
         """
+        if seq is not None and self.cache is not None:
+            state = self.cache.get(seq)
+            if state is not None:
+                return state
+
         try:
             response = self.open_url(self.get_state_url(seq))
-        except Exception as err:
+        except urllib.error.HTTPError as err:
+            if err.code not in (404, 410):
+                raise
             logging.error(err)
             return None
 
@@ -145,7 +399,10 @@ class ReplicationServer(object):
                         ts = ts.replace(tzinfo=dt.timezone.utc)
             line = response.readline()
 
-        return OsmosisState(sequence=seq, timestamp=ts)
+        state = OsmosisState(sequence=seq, timestamp=ts)
+        if self.cache is not None:
+            self.cache.put(state)
+        return state
 
     def get_diff_block(self, seq):
         """ Downloads the diff with the given sequence number and returns
@@ -182,3 +439,141 @@ class ReplicationServer(object):
             seq % 1000,
             self.diff_type,
         )
+
+
+class AsyncReplicationServer(object):
+    """ asyncio interface to a replication server.
+
+        Requests are made by the pooled, retrying ReplicationServer in a
+        thread pool, at most `concurrency` at a time. timestamp_to_sequence()
+        probes several state files per round instead of one.
+
+        server is a ReplicationServer, whose connections and state cache
+        are shared.
+    """
+
+    def __init__(self, server, concurrency=8):
+        self.server = server
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.semaphore = None
+
+    async def run(self, func, *args):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.semaphore:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+
+    async def get_state_info(self, seq=None):
+        """ See ReplicationServer.get_state_info """
+        return await self.run(self.server.get_state_info, seq)
+
+    async def get_diff_block(self, seq):
+        """ See ReplicationServer.get_diff_block """
+        return await self.run(self.server.get_diff_block, seq)
+
+    def close(self):
+        self.executor.shutdown()
+
+    async def timestamp_to_sequence(self, timestamp, balanced_search=False, probes=4):
+        """ Get the sequence number of the replication file that contains the
+            given timestamp, like ReplicationServer.timestamp_to_sequence.
+
+            Each round fetches `probes` state files between the current lower
+            and upper bound at once, so the search narrows by a factor of
+            probes + 1 per round trip. Unless `balanced_search` is set, two of
+            the probes are placed either side of the sequence interpolated from
+            the bounds' timestamps, which usually finishes the search in one
+            round for servers that publish at regular intervals. Probes that
+            hit a missing state file move to the nearest untried neighbor.
+        """
+        upper = await self.get_state_info()
+
+        if upper is None:
+            return None
+        if timestamp >= upper.timestamp or upper.sequence <= 0:
+            return upper.sequence
+
+        lower = None
+        if self.server.cache is not None:
+            lower, cached_upper = self.server.cache.bracket(timestamp)
+            if cached_upper is not None and cached_upper.sequence < upper.sequence:
+                upper = cached_upper
+
+        missing = set()
+        floor = 0
+        while True:
+            # the lowest sequence that may still be before timestamp
+            lowerid = lower.sequence + 1 if lower is not None else floor
+            if lowerid >= upper.sequence:
+                return lower.sequence if lower is not None else upper.sequence
+
+            candidates = self.candidates(lowerid, lower, upper, timestamp, balanced_search, probes)
+            candidates = self.untried(candidates, lowerid, upper.sequence, missing)
+            if not candidates:
+                # every state file in between is missing
+                return lower.sequence if lower is not None else upper.sequence
+
+            states = await asyncio.gather(*[self.get_state_info(c) for c in candidates])
+            found = False
+            for candidate, state in zip(candidates, states):
+                if state is None:
+                    missing.add(candidate)
+                elif state.timestamp < timestamp:
+                    found = True
+                    if lower is None or state.sequence > lower.sequence:
+                        lower = state
+                elif state.sequence < upper.sequence:
+                    found = True
+                    upper = state
+            if lower is None:
+                if found:
+                    # Like the serial search, start again from the first sequence
+                    # below the new upper, skipping the files known to be missing
+                    floor = 0
+                else:
+                    # Every probe below upper is missing, so like the serial search
+                    # look above them for the first state before timestamp
+                    floor = max([floor] + [c + 1 for c in candidates if c < upper.sequence])
+
+    @staticmethod
+    def candidates(lowerid, lower, upper, timestamp, balanced_search, probes):
+        """ Sequence numbers to probe in [lowerid, upper.sequence) """
+        span = upper.sequence - lowerid
+        candidates = set()
+        if lower is not None and not balanced_search:
+            ts_int = (upper.timestamp - lower.timestamp).total_seconds()
+            seq_int = upper.sequence - lower.sequence
+            goal = (timestamp - lower.timestamp).total_seconds()
+            guess = lower.sequence + ceil(goal * seq_int / ts_int)
+            candidates.update([guess - 1, guess])
+        splits = probes - len(candidates)
+        for i in range(1, splits + 1):
+            candidates.add(lowerid + (span * i) // (splits + 1))
+        if lower is None:
+            # the search for a state before timestamp starts at the first sequence
+            candidates.add(lowerid)
+        return candidates
+
+    @staticmethod
+    def untried(candidates, lowerid, upperid, missing):
+        """ Move each candidate to the nearest sequence in [lowerid, upperid)
+            that is not known to be missing, dropping duplicates.
+        """
+        result = set()
+        for candidate in candidates:
+            candidate = min(max(candidate, lowerid), upperid - 1)
+            offset = 0
+            while True:
+                below, above = candidate - offset, candidate + offset
+                if below < lowerid and above >= upperid:
+                    break
+                if lowerid <= below and below not in missing and below not in result:
+                    result.add(below)
+                    break
+                if above < upperid and above not in missing and above not in result:
+                    result.add(above)
+                    break
+                offset += 1
+        return sorted(result)
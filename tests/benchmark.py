@@ -0,0 +1,596 @@
+""" Benchmark augmented_diff against a synthetic dataset
+
+Builds an in-memory stand-in for an OSMX database (see memory_osmx.py) and a
+synthetic osmChange with tunable sizes, then times each pass of generating the
+augmented diff and prints the results as JSON. Use --baseline with the JSON of an
+earlier run to check for regressions, e.g. across releases:
+
+    python3 tests/benchmark.py --output before.json
+    python3 tests/benchmark.py --baseline before.json
+
+The results hold the parameters of the run, and a baseline run with other sizes,
+processes, output format or diff options is refused, as its timings aren't
+comparable, unless --ignore-parameters is passed.
+
+Passes are those of onramp.metrics.PASSES, as recorded by augmented_diff in the
+Metrics that osmx-update exports, e.g. parse, propagate, build, augment, bounds and
+write. With --processes, the passes run in worker processes are summed across them.
+augmented_diff is the whole diff from osmChange to output file, as osmx-update runs
+it, and synthetic_data is generating the dataset, which isn't part of onramp.
+
+Timings are the min, median and mean of --repeat runs. Memory isn't measured for
+each pass, only for the whole diff: the retained_bytes and peak_allocated_bytes of
+augmented_diff are measured with tracemalloc in one more run, which is much slower
+and isn't timed. The max_rss_bytes of memory is the high-water mark of the process
+RSS after the timed runs, so it includes the synthetic dataset. With --processes,
+allocations in worker processes aren't traced and their RSS is in
+children_max_rss_bytes.
+
+"""
+import argparse
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import gc
+import json
+import logging
+import os
+from pathlib import Path
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from xml.sax.saxutils import quoteattr
+
+import memory_osmx
+
+# onramp imports osmx, so the stand-in has to be in place first
+sys.modules["osmx"] = memory_osmx
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from onramp.diff import augmented_diff  # noqa: E402
+from onramp.metrics import Metrics  # noqa: E402
+from onramp.propagation import DEFAULT_RELATION_DEPTH  # noqa: E402
+
+OSMX_FILE = "benchmark.osmx"
+END_TIMESTAMP = datetime(2020, 9, 1, 0, 1, tzinfo=timezone.utc)
+# Sizes of the synthetic data and osmChange, each multiplied by --scale
+SIZES = {
+    "ways": (20000, "ways of --way-length nodes"),
+    "way_length": (8, "nodes in each way"),
+    "long_ways": (20, "ways of --long-way-length nodes"),
+    "long_way_length": (2000, "nodes in each long way"),
+    "pois": (20000, "tagged nodes that aren't in a way"),
+    "relations": (1000, "route relations of a few ways, some with relation members"),
+    "multipolygons": (5, "multipolygon relations of --multipolygon-members ways"),
+    "multipolygon_members": (1000, "ways in each multipolygon"),
+    "node_moves": (5000, "modified way nodes, each moves a little"),
+    "way_edits": (500, "modified ways"),
+    "relation_edits": (50, "modified relations"),
+    "creates": (2000, "created nodes, one way is created for every 10"),
+    "deletes": (500, "deleted nodes that aren't in a way, one way is deleted for every 10"),
+}
+# Parameters that have to match those of --baseline for timings to be comparable, with
+# their values in results from before they were recorded
+COMPARED_PARAMETERS = {
+    "seed": None,
+    "sizes": None,
+    "processes": None,
+    "format": None,
+    "gzip_threads": None,
+    "relation_depth": DEFAULT_RELATION_DEPTH,
+    "geometry_budget": None,
+}
+MEMORY_SCOPE = (
+    "tracemalloc allocations are of the whole augmented_diff pass in this process, not "
+    "of each pass, and RSS is the high-water mark of the process and its children"
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark augmented_diff with a synthetic dataset and osmChange"
+    )
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="Multiply every size below by this"
+    )
+    for name, (default, description) in SIZES.items():
+        parser.add_argument(
+            "--{}".format(name.replace("_", "-")),
+            type=int,
+            default=default,
+            help="{} (default {})".format(description.capitalize(), default),
+        )
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs of each pass")
+    parser.add_argument(
+        "--no-allocations", action="store_true", help="Skip the tracemalloc run"
+    )
+    parser.add_argument(
+        "-p", "--processes", type=int, default=1, help="Processes for the augmented_diff pass"
+    )
+    parser.add_argument(
+        "--format",
+        choices=["xml", "xml.gz", "ndjson", "ndjson.gz"],
+        default="xml.gz",
+        help="Output format, as selected by the output file extension",
+    )
+    parser.add_argument("--gzip-threads", type=int, default=1)
+    parser.add_argument(
+        "--relation-depth",
+        type=int,
+        default=DEFAULT_RELATION_DEPTH,
+        help="Levels of parent relations changes propagate to (default {})".format(
+            DEFAULT_RELATION_DEPTH
+        ),
+    )
+    parser.add_argument(
+        "--geometry-budget", type=int, help="Way member locations of each relation (no limit)"
+    )
+    parser.add_argument("--output", type=Path, help="Write results here instead of stdout")
+    parser.add_argument(
+        "--baseline", type=Path, help="Results of an earlier run to compare timings with"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Fraction a pass may be slower than --baseline before it is a regression",
+    )
+    parser.add_argument(
+        "--ignore-parameters",
+        action="store_true",
+        help="Compare with a --baseline run with other parameters, only warning about them",
+    )
+    parser.add_argument("--verbose", action="store_true", help="Keep onramp's log output")
+    return parser.parse_args()
+
+
+def scaled_sizes(args):
+    sizes = {}
+    for name in SIZES:
+        value = getattr(args, name)
+        if not name.endswith("length") and not name.endswith("members"):
+            value = int(round(value * args.scale))
+        sizes[name] = value
+    return sizes
+
+
+class SyntheticData:
+    """ Generate a memory_osmx.Dataset and an osmChange that applies to it
+
+    Ways are strings of nodes a short step apart, and usually start at the last node
+    of the way before them. Multipolygons are made of runs of consecutive ways and
+    every tenth route relation has the relation before it as a member, so changes
+    propagate to ways and relations the way they do in real data.
+
+    """
+
+    def __init__(self, sizes, seed):
+        self.sizes = sizes
+        self.random = random.Random(seed)
+        self.dataset = memory_osmx.Dataset()
+        self.next_node = 1
+        self.next_way = 1
+        self.next_relation = 1
+        self.changes = {"create": [], "modify": [], "delete": []}
+
+    def metadata(self, version=1):
+        return memory_osmx.Metadata(
+            version=version,
+            timestamp=1500000000 + self.random.randint(0, 10 ** 8),
+            changeset=self.random.randint(1, 10 ** 7),
+            uid=self.random.randint(1, 10 ** 6),
+            user="user{}".format(self.random.randint(1, 1000)),
+        )
+
+    def add_node(self, lat, lon, tags=None):
+        node_id = self.next_node
+        self.next_node += 1
+        metadata = self.metadata()
+        self.dataset.locations[node_id] = (lat, lon, metadata.version)
+        if tags:
+            self.dataset.nodes[node_id] = memory_osmx.Node(tags, metadata)
+        return node_id
+
+    def add_way(self, length, previous=None):
+        nodes = []
+        if previous is not None and self.random.random() < 0.5:
+            nodes.append(previous[-1])
+            lat, lon = self.dataset.locations[previous[-1]][:2]
+        else:
+            lat, lon = self.random.uniform(-10, 10), self.random.uniform(-10, 10)
+        while len(nodes) < length:
+            lat += self.random.uniform(-0.001, 0.001)
+            lon += self.random.uniform(-0.001, 0.001)
+            nodes.append(self.add_node(round(lat, 7), round(lon, 7)))
+        way_id = self.next_way
+        self.next_way += 1
+        tags = ["highway", self.random.choice(["residential", "service", "primary"])]
+        self.dataset.ways[way_id] = memory_osmx.Way(nodes, tags, self.metadata())
+        return way_id
+
+    def add_relation(self, members, tags):
+        relation_id = self.next_relation
+        self.next_relation += 1
+        self.dataset.relations[relation_id] = memory_osmx.Relation(
+            members, tags, self.metadata()
+        )
+        return relation_id
+
+    def generate(self):
+        sizes = self.sizes
+        previous = None
+        for _ in range(sizes["ways"]):
+            way_id = self.add_way(sizes["way_length"], previous)
+            previous = self.dataset.ways[way_id].nodes
+        long_ways = [
+            self.add_way(sizes["long_way_length"]) for _ in range(sizes["long_ways"])
+        ]
+        for i in range(sizes["pois"]):
+            self.add_node(
+                round(self.random.uniform(-10, 10), 7),
+                round(self.random.uniform(-10, 10), 7),
+                ["amenity", "cafe", "name", "Cafe {}".format(i)],
+            )
+
+        way_ids = list(self.dataset.ways)
+        for i in range(sizes["relations"]):
+            members = [
+                memory_osmx.RelationMember("way", way_id, "")
+                for way_id in self.random.sample(way_ids, self.random.randint(1, 4))
+            ]
+            if i % 10 == 9:
+                members.append(
+                    memory_osmx.RelationMember("relation", self.next_relation - 1, "")
+                )
+            self.add_relation(members, ["type", "route", "route", "bus"])
+        for _ in range(sizes["multipolygons"]):
+            ring = [self.add_way(sizes["way_length"]) for _ in range(sizes["multipolygon_members"])]
+            members = [
+                memory_osmx.RelationMember("way", way_id, "inner" if i % 5 else "outer")
+                for i, way_id in enumerate(ring)
+            ]
+            self.add_relation(members, ["type", "multipolygon", "landuse", "forest"])
+        self.dataset.build_indexes()
+        self.generate_changes(long_ways)
+
+    def generate_changes(self, long_ways):
+        sizes = self.sizes
+        dataset = self.dataset
+        way_nodes = sorted(dataset.node_way)
+        moved = self.random.sample(way_nodes, min(sizes["node_moves"], len(way_nodes)))
+        # Always move a node of each long way, which forces its whole geometry to be read
+        moved.extend(dataset.ways[way_id].nodes[0] for way_id in long_ways)
+        for node_id in sorted(set(moved)):
+            lat, lon, version = dataset.locations[node_id]
+            lat += self.random.uniform(-0.0001, 0.0001)
+            lon += self.random.uniform(-0.0001, 0.0001)
+            self.changes["modify"].append(self.node_xml(node_id, version + 1, lat, lon))
+
+        edited = self.random.sample(list(dataset.ways), min(sizes["way_edits"], len(dataset.ways)))
+        for way_id in sorted(edited):
+            way = dataset.ways[way_id]
+            tags = way.tags + ["name", "Street {}".format(way_id)]
+            self.changes["modify"].append(
+                self.way_xml(way_id, way.metadata.version + 1, way.nodes, tags)
+            )
+
+        relation_ids = list(dataset.relations)
+        edited = self.random.sample(relation_ids, min(sizes["relation_edits"], len(relation_ids)))
+        for relation_id in sorted(edited):
+            relation = dataset.relations[relation_id]
+            tags = relation.tags + ["name", "Relation {}".format(relation_id)]
+            self.changes["modify"].append(
+                self.relation_xml(
+                    relation_id, relation.metadata.version + 1, relation.members, tags
+                )
+            )
+
+        created = []
+        for i in range(sizes["creates"]):
+            node_id = self.next_node + i
+            lat, lon = self.random.uniform(-10, 10), self.random.uniform(-10, 10)
+            self.changes["create"].append(self.node_xml(node_id, 1, lat, lon))
+            created.append(node_id)
+            if len(created) == 10:
+                self.changes["create"].append(
+                    self.way_xml(self.next_way, 1, created, ["highway", "footway"])
+                )
+                self.next_way += 1
+                created = []
+
+        pois = [
+            node_id for node_id in dataset.nodes
+            if node_id not in dataset.node_way and node_id not in dataset.node_relation
+        ]
+        deleted = self.random.sample(pois, min(sizes["deletes"], len(pois)))
+        for node_id in sorted(deleted):
+            self.changes["delete"].append(
+                self.node_xml(node_id, dataset.locations[node_id][2] + 1)
+            )
+        unused_ways = [
+            way_id for way_id in dataset.ways
+            if way_id not in dataset.way_relation and way_id not in long_ways
+        ]
+        deleted = self.random.sample(unused_ways, min(len(deleted) // 10, len(unused_ways)))
+        for way_id in sorted(deleted):
+            self.changes["delete"].append(
+                self.way_xml(way_id, dataset.ways[way_id].metadata.version + 1)
+            )
+
+    def attributes(self, elem_id, version):
+        return 'id="{}" version="{}" timestamp="{}" uid="{}" user={} changeset="{}"'.format(
+            elem_id,
+            version,
+            END_TIMESTAMP.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            self.random.randint(1, 10 ** 6),
+            quoteattr("user{}".format(self.random.randint(1, 1000))),
+            10 ** 7 + self.random.randint(1, 1000),
+        )
+
+    @staticmethod
+    def tags_xml(tags):
+        it = iter(tags)
+        return "".join(
+            "      <tag k={} v={}/>\n".format(quoteattr(k), quoteattr(v)) for k, v in zip(it, it)
+        )
+
+    def node_xml(self, node_id, version, lat=None, lon=None):
+        xml = "    <node " + self.attributes(node_id, version)
+        if lat is None:
+            return xml + "/>\n"
+        xml += ' lat="{:.7f}" lon="{:.7f}"'.format(lat, lon)
+        node = self.dataset.nodes.get(node_id)
+        if node is None:
+            return xml + "/>\n"
+        return xml + ">\n" + self.tags_xml(node.tags) + "    </node>\n"
+
+    def way_xml(self, way_id, version, nodes=(), tags=()):
+        return (
+            "    <way " + self.attributes(way_id, version) + ">\n"
+            + "".join('      <nd ref="{}"/>\n'.format(node_id) for node_id in nodes)
+            + self.tags_xml(tags)
+            + "    </way>\n"
+        )
+
+    def relation_xml(self, relation_id, version, members=(), tags=()):
+        return (
+            "    <relation " + self.attributes(relation_id, version) + ">\n"
+            + "".join(
+                '      <member type="{}" ref="{}" role={}/>\n'.format(
+                    m.type, m.ref, quoteattr(m.role)
+                )
+                for m in members
+            )
+            + self.tags_xml(tags)
+            + "    </relation>\n"
+        )
+
+    def write_osc(self, path):
+        with open(path, "w", encoding="utf-8") as fp:
+            fp.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            fp.write('<osmChange version="0.6" generator="onramp benchmark">\n')
+            for block in ("create", "modify", "delete"):
+                if self.changes[block]:
+                    fp.write("  <{}>\n".format(block))
+                    fp.writelines(self.changes[block])
+                    fp.write("  </{}>\n".format(block))
+            fp.write("</osmChange>\n")
+
+
+def max_rss():
+    """ High-water mark of the RSS of this process and of its waited-for children, in bytes """
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit,
+    )
+
+
+class PassRecorder:
+    """ Collect the timings, allocations and RSS of each pass """
+
+    def __init__(self):
+        self.passes = {}
+        self.trace_allocations = False
+
+    def result(self, name):
+        return self.passes.setdefault(name, {"runs": []})
+
+    def add(self, name, seconds):
+        if not self.trace_allocations:
+            self.result(name)["runs"].append(seconds)
+
+    @contextmanager
+    def measure(self, name):
+        gc.collect()
+        if self.trace_allocations:
+            tracemalloc.start()
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        if self.trace_allocations:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result = self.result(name)
+            result["retained_bytes"] = current
+            result["peak_allocated_bytes"] = peak
+        else:
+            result = self.result(name)
+            result["runs"].append(elapsed)
+
+    def summary(self):
+        for result in self.passes.values():
+            runs = result["runs"]
+            if runs:
+                result["min"] = min(runs)
+                result["median"] = statistics.median(runs)
+                result["mean"] = statistics.mean(runs)
+        return self.passes
+
+
+def run_passes(recorder, osc_file, output_file, args):
+    """ Generate the diff once and record the duration of each of its passes
+
+    Returns the db lookup stats of the diff.
+
+    """
+    metrics = Metrics()
+    with recorder.measure("augmented_diff"):
+        augmented_diff(
+            OSMX_FILE,
+            osc_file,
+            output_file,
+            end_timestamp=END_TIMESTAMP,
+            osc_sequence=0,
+            osc_url="benchmark",
+            processes=args.processes,
+            gzip_threads=args.gzip_threads,
+            metrics=metrics,
+            relation_depth=args.relation_depth,
+            geometry_budget=args.geometry_budget,
+        )
+    for name, seconds in metrics.durations.items():
+        recorder.add(name, seconds)
+    return metrics.lookups
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=str(Path(__file__).resolve().parent),
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parameter_mismatches(results, baseline):
+    """ Return a message for each parameter of results that differs from baseline """
+    mismatches = []
+    before = baseline.get("parameters", {})
+    after = results["parameters"]
+    for name, default in COMPARED_PARAMETERS.items():
+        if before.get(name, default) != after[name]:
+            mismatches.append(
+                "{}: {} in baseline, {} now".format(
+                    name, json.dumps(before.get(name, default)), json.dumps(after[name])
+                )
+            )
+    return mismatches
+
+
+def compare(results, baseline, tolerance):
+    """ Return a message for each pass that is slower than in baseline by more than tolerance """
+    regressions = []
+    for name, result in results["passes"].items():
+        # Generating the synthetic data isn't part of onramp
+        if name == "synthetic_data":
+            continue
+        before = baseline.get("passes", {}).get(name, {}).get("min")
+        after = result.get("min")
+        if not before or after is None:
+            continue
+        change = after / before - 1
+        result["baseline_change"] = change
+        if change > tolerance:
+            regressions.append(
+                "{}: {:.3f}s, {:.0%} slower than {:.3f}s".format(name, after, change, before)
+            )
+    return regressions
+
+
+def main():
+    args = parse_args()
+    if not args.verbose:
+        for name in list(logging.root.manager.loggerDict):
+            if name.startswith("onramp"):
+                logging.getLogger(name).setLevel(logging.ERROR)
+
+    sizes = scaled_sizes(args)
+    recorder = PassRecorder()
+    with tempfile.TemporaryDirectory(prefix="onramp-benchmark-") as tmpdir:
+        osc_file = os.path.join(tmpdir, "benchmark.osc")
+        output_file = os.path.join(tmpdir, "benchmark.adiff.{}".format(args.format))
+
+        with recorder.measure("synthetic_data"):
+            data = SyntheticData(sizes, args.seed)
+            data.generate()
+            data.write_osc(osc_file)
+        memory_osmx.register(OSMX_FILE, data.dataset)
+
+        for _ in range(args.repeat):
+            lookups = run_passes(recorder, osc_file, output_file, args)
+        output_bytes = os.path.getsize(output_file)
+        memory = {"scope": MEMORY_SCOPE}
+        memory["max_rss_bytes"], memory["children_max_rss_bytes"] = max_rss()
+        if not args.no_allocations:
+            recorder.trace_allocations = True
+            run_passes(recorder, osc_file, output_file, args)
+
+        results = {
+            "benchmark": "augmented_diff",
+            "created": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "parameters": {
+                "seed": args.seed,
+                "sizes": sizes,
+                "repeat": args.repeat,
+                "processes": args.processes,
+                "format": args.format,
+                "gzip_threads": args.gzip_threads,
+                "relation_depth": args.relation_depth,
+                "geometry_budget": args.geometry_budget,
+            },
+            "dataset": data.dataset.counts(),
+            "changes": {block: len(elems) for block, elems in data.changes.items()},
+            "osc_bytes": os.path.getsize(osc_file),
+            "output_bytes": output_bytes,
+            "lookups": lookups,
+            "memory": memory,
+            "passes": recorder.summary(),
+        }
+
+    regressions = []
+    mismatches = []
+    if args.baseline is not None:
+        with args.baseline.open() as fp:
+            baseline = json.load(fp)
+        mismatches = parameter_mismatches(results, baseline)
+        results["parameter_mismatches"] = mismatches
+        if not mismatches or args.ignore_parameters:
+            regressions = compare(results, baseline, args.tolerance)
+            results["regressions"] = regressions
+
+    if args.output is not None:
+        with args.output.open("w") as fp:
+            json.dump(results, fp, indent=2)
+            fp.write("\n")
+    else:
+        print(json.dumps(results, indent=2))
+
+    for mismatch in mismatches:
+        print("Baseline parameter differs, {}".format(mismatch), file=sys.stderr)
+    if mismatches and not args.ignore_parameters:
+        print(
+            "Not compared with the baseline, pass --ignore-parameters to compare anyway",
+            file=sys.stderr,
+        )
+        sys.exit(2)
+    for regression in regressions:
+        print("Regression in {}".format(regression), file=sys.stderr)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+""" Pure-Python, in-memory stand-in for the osmx module
+
+Implements the parts of the osmx API that onramp reads: Environment, Transaction
+and the Locations, Nodes, Ways, Relations, NodeWay, NodeRelation, WayRelation and
+RelationRelation tables. Data is held in a Dataset of dictionaries, which lets the
+diff engine be exercised without an OSMX database.
+
+To use it in place of osmx, put this module in sys.modules["osmx"] before importing
+onramp, then register a Dataset under the path that is passed to onramp as the
+osmx file:
+
+    sys.modules["osmx"] = memory_osmx
+    memory_osmx.register("bench.osmx", dataset)
+
+Worker processes started with fork inherit registered datasets, so onramp's
+parallel mode works as well.
+
+"""
+from collections import namedtuple
+
+Metadata = namedtuple("Metadata", ["version", "timestamp", "changeset", "uid", "user"])
+Node = namedtuple("Node", ["tags", "metadata"])
+Way = namedtuple("Way", ["nodes", "tags", "metadata"])
+Relation = namedtuple("Relation", ["members", "tags", "metadata"])
+RelationMember = namedtuple("RelationMember", ["type", "ref", "role"])
+
+# Datasets by the path they are opened with, see register
+_datasets = {}
+
+
+class Dataset:
+    """ Contents of an osmx database
+
+    locations: node id > (lat, lon, version)
+    nodes: node id > Node, for nodes with tags
+    ways: way id > Way
+    relations: relation id > Relation
+    node_way, node_relation, way_relation, relation_relation:
+        reverse indexes from member id to a list of parent ids
+
+    Tags are flat lists [k1, v1, k2, v2, ...] and timestamps are seconds since the
+    epoch, as osmx stores them. Call build_indexes() once ways and relations are added.
+
+    """
+
+    def __init__(self):
+        self.locations = {}
+        self.nodes = {}
+        self.ways = {}
+        self.relations = {}
+        self.node_way = {}
+        self.node_relation = {}
+        self.way_relation = {}
+        self.relation_relation = {}
+
+    def build_indexes(self):
+        """ Rebuild the reverse indexes from ways and relations """
+        self.node_way = {}
+        self.node_relation = {}
+        self.way_relation = {}
+        self.relation_relation = {}
+        for way_id, way in self.ways.items():
+            for node_id in way.nodes:
+                self.node_way.setdefault(node_id, []).append(way_id)
+        indexes = {
+            "node": self.node_relation,
+            "way": self.way_relation,
+            "relation": self.relation_relation,
+        }
+        for relation_id, relation in self.relations.items():
+            for member in relation.members:
+                indexes[member.type].setdefault(member.ref, []).append(relation_id)
+
+    def counts(self):
+        return {
+            "locations": len(self.locations),
+            "nodes": len(self.nodes),
+            "ways": len(self.ways),
+            "relations": len(self.relations),
+            "way_nodes": sum(len(way.nodes) for way in self.ways.values()),
+            "relation_members": sum(len(r.members) for r in self.relations.values()),
+        }
+
+
+def register(path, dataset):
+    """ Make Environment(path) open dataset """
+    _datasets[str(path)] = dataset
+
+
+def unregister(path):
+    _datasets.pop(str(path), None)
+
+
+class Environment:
+    def __init__(self, path):
+        try:
+            self.dataset = _datasets[str(path)]
+        except KeyError:
+            raise FileNotFoundError("No dataset registered for {}".format(path))
+
+
+class Transaction:
+    def __init__(self, env):
+        self.dataset = env.dataset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class _Table:
+    name = None
+
+    def __init__(self, txn):
+        self.data = getattr(txn.dataset, self.name)
+
+    def get(self, elem_id):
+        return self.data.get(int(elem_id))
+
+
+class _Index(_Table):
+    def get(self, elem_id):
+        return iter(self.data.get(int(elem_id), ()))
+
+
+class Locations(_Table):
+    name = "locations"
+
+
+class Nodes(_Table):
+    name = "nodes"
+
+
+class Ways(_Table):
+    name = "ways"
+
+
+class Relations(_Table):
+    name = "relations"
+
+
+class NodeWay(_Index):
+    name = "node_way"
+
+
+class NodeRelation(_Index):
+    name = "node_relation"
+
+
+class WayRelation(_Index):
+    name = "way_relation"
+
+
+class RelationRelation(_Index):
+    name = "relation_relation"
@@ -0,0 +1,113 @@
+""" Tests of augmented_diff in app/onramp/diff.py against memory_osmx
+
+Run with python3 -m pytest tests/test_diff.py, or python3 -m unittest from tests/.
+
+"""
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+import memory_osmx
+
+# onramp imports osmx, so the stand-in has to be in place first
+sys.modules["osmx"] = memory_osmx
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from onramp.diff import augmented_diff  # noqa: E402
+from onramp.metrics import Metrics  # noqa: E402
+
+OSMX_FILE = "test_diff.osmx"
+WAYS = 100
+WAY_LENGTH = 10
+
+OSC = """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6" generator="test_diff">
+  <modify>
+    <node id="1" version="2" timestamp="2020-09-01T00:01:00Z" changeset="2" uid="1" user="test"
+      lat="0.5" lon="0.5"/>
+  </modify>
+</osmChange>
+"""
+
+
+def boundary_dataset():
+    """ A relation of WAYS member ways of WAY_LENGTH nodes each, the first with node 1 """
+    dataset = memory_osmx.Dataset()
+    metadata = memory_osmx.Metadata(1, 1598918400, 1, 1, "test")
+    members = []
+    for way_id in range(1, WAYS + 1):
+        nodes = []
+        for i in range(WAY_LENGTH):
+            node_id = (way_id - 1) * WAY_LENGTH + i + 1
+            dataset.locations[node_id] = (way_id * 0.01, i * 0.01, 1)
+            nodes.append(node_id)
+        dataset.ways[way_id] = memory_osmx.Way(nodes, [], metadata)
+        members.append(memory_osmx.RelationMember("way", way_id, "outer"))
+    dataset.relations[1] = memory_osmx.Relation(
+        members, ["type", "boundary", "boundary", "administrative"], metadata
+    )
+    dataset.build_indexes()
+    return dataset
+
+
+class GeometryBudgetTest(unittest.TestCase):
+    def setUp(self):
+        memory_osmx.register(OSMX_FILE, boundary_dataset())
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.osc_file = str(Path(self.tmpdir.name) / "change.osc")
+        with open(self.osc_file, "w") as f:
+            f.write(OSC)
+
+    def tearDown(self):
+        memory_osmx.unregister(OSMX_FILE)
+        self.tmpdir.cleanup()
+
+    def diff(self, geometry_budget=None, processes=1):
+        metrics = Metrics()
+        output_file = str(Path(self.tmpdir.name) / "adiff.xml")
+        augmented_diff(
+            OSMX_FILE,
+            self.osc_file,
+            output_file,
+            metrics=metrics,
+            geometry_budget=geometry_budget,
+            processes=processes,
+        )
+        relations = ET.parse(output_file).getroot().findall("action/*/relation")
+        return relations, metrics.lookups
+
+    def test_oversized_relation_stops_reading_geometry(self):
+        relations, lookups = self.diff()
+        self.assertEqual(len(relations), 2)
+        self.assertEqual(lookups["way_geometry"]["reads"], 2 * WAYS)
+        self.assertEqual(lookups["way_geometry"]["skipped"], 0)
+
+        budget = 5 * WAY_LENGTH
+        relations, lookups = self.diff(geometry_budget=budget)
+        self.assertEqual(len(relations), 2)
+        # Member ways are read until the relation has more than budget locations
+        self.assertEqual(lookups["way_geometry"]["reads"], 2 * (budget // WAY_LENGTH + 1))
+        self.assertEqual(lookups["way_geometry"]["skipped"], 2 * (WAYS - budget // WAY_LENGTH - 1))
+        self.assertLess(lookups["ways"]["reads"], WAYS // 2)
+        self.assertLess(lookups["locations"]["reads"], WAYS * WAY_LENGTH // 2)
+        self.assertEqual([r.get("truncated") for r in relations], ["true", "true"])
+        # Bounds are of the member ways that were read, the old and the new node 1
+        self.assertEqual(
+            [r.find("bounds").get("maxlat") for r in relations], ["0.0600000", "0.5000000"]
+        )
+
+    def test_parallel_lookups(self):
+        _, serial = self.diff()
+        _, parallel = self.diff(processes=2)
+        # The parent ways and relations are only looked up while finding the affected
+        # elements, in the main process
+        for table in ("node_way", "node_relation", "way_relation", "relation_relation"):
+            self.assertEqual(parallel[table], serial[table])
+        self.assertEqual(parallel["node_way"]["lookups"], 1)
+        self.assertEqual(parallel["way_geometry"], serial["way_geometry"])
+
+
+if __name__ == "__main__":
+    unittest.main()
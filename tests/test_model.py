@@ -0,0 +1,71 @@
+""" Tests of the xml and JSON output of app/onramp/model.py
+
+Run with python3 -m pytest tests/test_model.py, or python3 -m unittest from tests/.
+
+"""
+from pathlib import Path
+import sys
+import unittest
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from onramp.model import escape, OsmElement, TEXT_ESCAPES  # noqa: E402
+
+
+def element(xml):
+    return OsmElement.from_xml(ET.fromstring(xml))
+
+
+class EscapeTest(unittest.TestCase):
+    def test_attribute(self):
+        self.assertEqual(escape('a & <b> "c"\nd'), "a &amp; &lt;b&gt; &quot;c&quot;&#10;d")
+        # Like ElementTree on Python 3.6, \r and \t are written as they are
+        self.assertEqual(escape("a\tb\rc"), "a\tb\rc")
+        self.assertEqual(escape("&amp;"), "&amp;amp;")
+
+    def test_text(self):
+        self.assertEqual(escape('a & <b> "c"\n', TEXT_ESCAPES), 'a &amp; &lt;b&gt; "c"\n')
+
+    def test_element_attributes_and_tags(self):
+        elem = element(
+            '<node id="1" user="a &amp; &lt;b&gt;" lat="1" lon="2">'
+            '<tag k="name" v="&quot;x&quot;&#10;y" /></node>'
+        )
+        self.assertEqual(elem.user, "a & <b>")
+        self.assertEqual(elem.tags, [("name", '"x"\ny')])
+        self.assertEqual(
+            elem.to_xml(level=0),
+            '<node id="1" user="a &amp; &lt;b&gt;" lat="1.0000000" lon="2.0000000">\n'
+            '  <tag k="name" v="&quot;x&quot;&#10;y" />\n'
+            "</node>",
+        )
+        # Escaped \t and \r are read back as themselves, and written unescaped
+        elem = element('<node id="1"><tag k="a&#9;b" v="c&#13;" /></node>')
+        self.assertEqual(elem.tags, [("a\tb", "c\r")])
+        self.assertIn('<tag k="a\tb" v="c\r" />', elem.to_xml(level=0))
+
+
+class ChildlessElementTest(unittest.TestCase):
+    def test_text_round_trip(self):
+        for xml in (
+            '<way id="1" version="2">\n    </way>',
+            '<relation id="1">\n</relation>',
+            '<node id="1">a &amp; &lt;b&gt; "c"</node>',
+        ):
+            elem = element(xml)
+            self.assertEqual(elem.to_xml(level=0), xml)
+            self.assertEqual(elem.copy().to_xml(level=0), xml)
+
+    def test_no_text(self):
+        self.assertEqual(element('<node id="1"></node>').to_xml(level=0), '<node id="1" />')
+        self.assertEqual(element('<way id="1"/>').to_xml(level=0), '<way id="1" />')
+
+    def test_children_drop_text(self):
+        elem = element('<way id="1">\n  <nd ref="2"/>\n</way>')
+        self.assertIsNone(elem.text)
+        self.assertEqual(elem.to_xml(level=0), '<way id="1">\n  <nd ref="2" />\n</way>')
+
+
+if __name__ == "__main__":
+    unittest.main()
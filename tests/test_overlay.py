@@ -0,0 +1,236 @@
+""" Tests of catching up with an onramp.overlay.Overlay against memory_osmx
+
+Run with python3 -m pytest tests/test_overlay.py, or python3 -m unittest from tests/.
+
+"""
+import calendar
+import io
+from pathlib import Path
+import sys
+import tempfile
+import time
+import unittest
+import xml.etree.ElementTree as ET
+
+import memory_osmx
+
+# onramp imports osmx, so the stand-in has to be in place first
+sys.modules["osmx"] = memory_osmx
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from onramp.diff import augmented_diff  # noqa: E402
+from onramp.osc import merge_osmchanges  # noqa: E402
+from onramp.overlay import Overlay  # noqa: E402
+
+# onramp keeps the osmx.Environment of each path open, so each run has its own path
+OSMX_FILE = "test_overlay-{}.osmx"
+
+OSMCHANGES = [
+    # Node 10 and way 3 are created, way 1 gets node 10 and relation 1 gets way 3
+    """<osmChange version="0.6" generator="test_overlay">
+  <create>
+    <node id="10" version="1" timestamp="2020-09-01T00:01:00Z" changeset="2" uid="1" user="a"
+      lat="0.05" lon="0.25">
+      <tag k="amenity" v="bench"/>
+    </node>
+    <way id="3" version="1" timestamp="2020-09-01T00:01:00Z" changeset="2" uid="1" user="a">
+      <nd ref="4"/>
+      <nd ref="5"/>
+      <tag k="highway" v="path"/>
+    </way>
+  </create>
+  <modify>
+    <way id="1" version="2" timestamp="2020-09-01T00:01:00Z" changeset="2" uid="1" user="a">
+      <nd ref="1"/>
+      <nd ref="10"/>
+      <nd ref="2"/>
+      <nd ref="3"/>
+      <tag k="highway" v="residential"/>
+    </way>
+    <relation id="1" version="2" timestamp="2020-09-01T00:01:00Z" changeset="2" uid="1"
+      user="a">
+      <member type="way" ref="1" role=""/>
+      <member type="way" ref="2" role=""/>
+      <member type="way" ref="3" role=""/>
+      <tag k="type" v="route"/>
+    </relation>
+  </modify>
+</osmChange>
+""",
+    # The created node is moved and retagged, and the created way deleted again
+    """<osmChange version="0.6" generator="test_overlay">
+  <modify>
+    <node id="10" version="2" timestamp="2020-09-01T00:02:00Z" changeset="3" uid="2" user="b"
+      lat="0.06" lon="0.26">
+      <tag k="amenity" v="bench"/>
+      <tag k="backrest" v="yes"/>
+    </node>
+    <relation id="1" version="3" timestamp="2020-09-01T00:02:00Z" changeset="3" uid="2"
+      user="b">
+      <member type="way" ref="1" role=""/>
+      <member type="way" ref="2" role=""/>
+      <tag k="type" v="route"/>
+    </relation>
+  </modify>
+  <delete>
+    <way id="3" version="2" timestamp="2020-09-01T00:02:00Z" changeset="3" uid="2" user="b"/>
+  </delete>
+</osmChange>
+""",
+    # Node 10 is deleted, after it is taken out of way 1
+    """<osmChange version="0.6" generator="test_overlay">
+  <modify>
+    <way id="1" version="3" timestamp="2020-09-01T00:03:00Z" changeset="4" uid="1" user="a">
+      <nd ref="1"/>
+      <nd ref="2"/>
+      <nd ref="3"/>
+      <tag k="highway" v="residential"/>
+    </way>
+    <node id="5" version="2" timestamp="2020-09-01T00:03:00Z" changeset="4" uid="1" user="a"
+      lat="0.1" lon="0.55"/>
+  </modify>
+  <delete>
+    <node id="10" version="3" timestamp="2020-09-01T00:03:00Z" changeset="4" uid="1" user="a"/>
+  </delete>
+</osmChange>
+""",
+]
+
+
+def initial_dataset():
+    """ Two ways of a route relation, and a loose pair of nodes """
+    dataset = memory_osmx.Dataset()
+    metadata = memory_osmx.Metadata(1, 1598918400, 1, 1, "a")
+    for node_id in range(1, 7):
+        dataset.locations[node_id] = (0.0 if node_id < 4 else 0.1, node_id * 0.1, 1)
+    dataset.ways[1] = memory_osmx.Way([1, 2, 3], ["highway", "residential"], metadata)
+    dataset.ways[2] = memory_osmx.Way([3, 6], ["highway", "residential"], metadata)
+    dataset.relations[1] = memory_osmx.Relation(
+        [memory_osmx.RelationMember("way", 1, ""), memory_osmx.RelationMember("way", 2, "")],
+        ["type", "route"],
+        metadata,
+    )
+    dataset.build_indexes()
+    return dataset
+
+
+def commit(dataset, osc_file):
+    """ Apply an osmChange to dataset, as `osmx update` commits it to the db """
+    for block in ET.parse(osc_file).getroot():
+        deleted = block.tag == "delete"
+        for e in block:
+            elem_id = int(e.get("id"))
+            version = int(e.get("version"))
+            tags = [value for tag in e.findall("tag") for value in (tag.get("k"), tag.get("v"))]
+            metadata = memory_osmx.Metadata(
+                version,
+                calendar.timegm(time.strptime(e.get("timestamp"), "%Y-%m-%dT%H:%M:%SZ")),
+                int(e.get("changeset")),
+                int(e.get("uid")),
+                e.get("user"),
+            )
+            table = getattr(dataset, e.tag + "s")
+            if e.tag == "node":
+                if deleted:
+                    dataset.locations.pop(elem_id, None)
+                else:
+                    dataset.locations[elem_id] = (float(e.get("lat")), float(e.get("lon")), version)
+                table.pop(elem_id, None)
+                if tags and not deleted:
+                    table[elem_id] = memory_osmx.Node(tags, metadata)
+            elif deleted:
+                table.pop(elem_id, None)
+            elif e.tag == "way":
+                nodes = [int(nd.get("ref")) for nd in e.findall("nd")]
+                table[elem_id] = memory_osmx.Way(nodes, tags, metadata)
+            else:
+                members = [
+                    memory_osmx.RelationMember(m.get("type"), int(m.get("ref")), m.get("role"))
+                    for m in e.findall("member")
+                ]
+                table[elem_id] = memory_osmx.Relation(members, tags, metadata)
+    dataset.build_indexes()
+
+
+class OverlayTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.osc_files = []
+        for i, osc in enumerate(OSMCHANGES):
+            osc_file = Path(self.tmpdir.name) / "{}.osc".format(i)
+            osc_file.write_text(osc)
+            self.osc_files.append(str(osc_file))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def diffs(self, overlay=None):
+        """ Return the augmented diff of each osmChange, committing each to the db in turn
+        or adding it to overlay
+        """
+        osmx_file = OSMX_FILE.format("sequential" if overlay is None else "overlay")
+        dataset = initial_dataset()
+        memory_osmx.register(osmx_file, dataset)
+        self.addCleanup(memory_osmx.unregister, osmx_file)
+        diffs = []
+        for i, osc_file in enumerate(self.osc_files):
+            output_file = Path(self.tmpdir.name) / "{}-{}.xml".format(i, overlay is not None)
+            augmented_diff(osmx_file, osc_file, str(output_file), overlay=overlay)
+            if overlay is None:
+                commit(dataset, osc_file)
+            diffs.append(output_file.read_bytes())
+        return diffs
+
+    def test_same_as_sequential(self):
+        sequential = self.diffs()
+        # Make sure the osmChanges depend on each other
+        self.assertIn(b'<node id="10" version="2"', sequential[1])
+        self.assertIn(b'<node id="10" version="3"', sequential[2])
+        self.assertEqual(self.diffs(overlay=Overlay()), sequential)
+
+    def test_revert(self):
+        # Profiling a diff again takes the changes of its first run back out of the overlay
+        memory_osmx.register(OSMX_FILE.format("revert"), initial_dataset())
+        self.addCleanup(memory_osmx.unregister, OSMX_FILE.format("revert"))
+        overlay = Overlay()
+        outputs = []
+        for i in (0, 1, 1):
+            if len(outputs) == 2:
+                before = {name: dict(table) for name, table in overlay.tables.items()}
+                overlay.revert()
+                self.assertNotEqual(overlay.tables, before)
+            output_file = Path(self.tmpdir.name) / "revert-{}.xml".format(len(outputs))
+            augmented_diff(
+                OSMX_FILE.format("revert"), self.osc_files[i], str(output_file), overlay=overlay
+            )
+            outputs.append(output_file.read_bytes())
+        self.assertEqual(outputs[2], outputs[1])
+        self.assertEqual(overlay.tables, before)
+
+    def test_merged_versions_in_order(self):
+        merged = io.BytesIO()
+        merge_osmchanges(self.osc_files, merged)
+        merged.seek(0)
+        root = ET.parse(merged).getroot()
+        self.assertEqual(
+            [
+                (block.tag, e.get("version"))
+                for block in root
+                for e in block
+                if e.tag == "node" and e.get("id") == "10"
+            ],
+            [("create", "1"), ("modify", "2"), ("delete", "3")],
+        )
+
+        # Committing the merged osmChange has the same result as committing each in turn
+        dataset = initial_dataset()
+        for osc_file in self.osc_files:
+            commit(dataset, osc_file)
+        merged_dataset = initial_dataset()
+        merged.seek(0)
+        commit(merged_dataset, merged)
+        self.assertEqual(vars(merged_dataset), vars(dataset))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+""" Tests of onramp.pgzip.ParallelGzipWriter
+
+Run with python3 -m pytest tests/test_pgzip.py, or python3 -m unittest from tests/.
+
+"""
+import gzip
+import io
+from pathlib import Path
+import random
+import sys
+import unittest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from onramp.pgzip import DICT_SIZE, ParallelGzipWriter  # noqa: E402
+
+
+def xmlish(size, seed=1):
+    """ size bytes of repetitive text, like an augmented diff """
+    rng = random.Random(seed)
+    lines = []
+    length = 0
+    while length < size:
+        line = '<nd ref="{}" lon="{:.7f}" lat="{:.7f}" />\n'.format(
+            rng.randint(1, 10 ** 9), rng.uniform(-180, 180), rng.uniform(-90, 90)
+        )
+        lines.append(line)
+        length += len(line)
+    return "".join(lines).encode("utf-8")[:size]
+
+
+class ParallelGzipWriterTest(unittest.TestCase):
+    def compress(self, data, write_size=1000, **kwargs):
+        fp = io.BytesIO()
+        with ParallelGzipWriter(fp, **kwargs) as gz:
+            for i in range(0, len(data), write_size):
+                gz.write(data[i : i + write_size])  # noqa: E203
+        return fp.getvalue(), gz
+
+    def test_multi_block_round_trip(self):
+        data = xmlish(300000)
+        for block_size in (1000, DICT_SIZE, 100000):
+            compressed, gz = self.compress(data, threads=4, block_size=block_size)
+            self.assertEqual(gzip.decompress(compressed), data)
+            size, compressed_size, rate, wait_time = gz.stats()
+            self.assertEqual(size, len(data))
+            self.assertEqual(compressed_size, len(compressed))
+            self.assertGreater(rate, 0)
+            self.assertGreaterEqual(wait_time, 0)
+
+    def test_close_to_single_stream(self):
+        data = xmlish(300000)
+        compressed, _ = self.compress(data, level=9, threads=4, block_size=64 * 1024)
+        self.assertLess(len(compressed), len(gzip.compress(data, compresslevel=9)) * 1.02)
+
+    def test_empty(self):
+        compressed, gz = self.compress(b"", threads=2)
+        self.assertEqual(gzip.decompress(compressed), b"")
+        self.assertEqual(gz.stats()[0], 0)
+
+    def test_block_size_writes(self):
+        data = xmlish(4000)
+        compressed, _ = self.compress(data, write_size=1000, threads=2, block_size=1000)
+        self.assertEqual(gzip.decompress(compressed), data)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+""" Tests of onramp.profiling.DiffProfiler
+
+Run with python3 -m pytest tests/test_profiling.py, or python3 -m unittest from tests/.
+
+"""
+import os
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from onramp.profiling import DiffProfiler  # noqa: E402
+
+
+class DiffProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.calls = []
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def diff(self):
+        self.calls.append("diff")
+        return "result"
+
+    def rerun(self):
+        self.calls.append("rerun")
+
+    def test_over_threshold_is_profiled_again(self):
+        profiler = DiffProfiler(self.tmpdir.name, max_seconds=0)
+        self.assertEqual(profiler.run("1-2", self.diff, self.rerun), "result")
+        self.assertEqual(self.calls, ["diff", "rerun"])
+        self.assertEqual(
+            sorted(os.listdir(self.tmpdir.name)), ["1-2.prof", "1-2.tracemalloc", "1-2.txt"]
+        )
+
+    def test_no_rerun(self):
+        profiler = DiffProfiler(self.tmpdir.name, max_seconds=0)
+        self.assertEqual(profiler.run("1-2", self.diff), "result")
+        self.assertEqual(self.calls, ["diff"])
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_under_threshold(self):
+        profiler = DiffProfiler(self.tmpdir.name, max_seconds=60)
+        profiler.run("1-2", self.diff, self.rerun)
+        self.assertEqual(self.calls, ["diff"])
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_sample(self):
+        profiler = DiffProfiler(self.tmpdir.name, sample=2)
+        for i in range(4):
+            profiler.run(str(i), self.diff, self.rerun)
+        self.assertEqual(self.calls, ["diff"] * 4)
+        self.assertEqual(
+            sorted(name for name in os.listdir(self.tmpdir.name) if name.endswith(".txt")),
+            ["1.txt", "3.txt"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,265 @@
+""" Tests of app/onramp/regions.py and regional augmented diffs against memory_osmx
+
+Run with python3 -m pytest tests/test_regions.py, or python3 -m unittest from tests/.
+
+"""
+import json
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+
+import memory_osmx
+
+# onramp imports osmx, so the stand-in has to be in place first
+sys.modules["osmx"] = memory_osmx
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from onramp.diff import augmented_diff, regional_augmented_diffs  # noqa: E402
+from onramp.lookup import OsmxLookup  # noqa: E402
+from onramp.osc import read_actions  # noqa: E402
+from onramp.regions import load_regions, Region, RegionFilter, RegionIndex  # noqa: E402
+
+OSMX_FILE = "test_regions.osmx"
+
+# A 4x4 degree square around (2, 2) with a 2x2 hole in the middle
+SQUARE_WITH_HOLE = [
+    [(0, 0), (4, 0), (4, 4), (0, 4)],
+    [(1, 1), (3, 1), (3, 3), (1, 3)],
+]
+
+OSC = """<osmChange version="0.6" generator="test_regions">
+  <modify>
+    <node id="1" version="2" timestamp="2020-09-01T00:01:00Z" changeset="2" uid="1" user="a"
+      lat="20.5" lon="20.5"/>
+    <node id="3" version="2" timestamp="2020-09-01T00:01:00Z" changeset="2" uid="1" user="a"
+      lat="30.5" lon="30.5"/>
+    <way id="2" version="2" timestamp="2020-09-01T00:01:00Z" changeset="2" uid="1" user="a">
+      <nd ref="3"/>
+      <nd ref="4"/>
+      <tag k="highway" v="path"/>
+    </way>
+    <way id="3" version="2" timestamp="2020-09-01T00:01:00Z" changeset="2" uid="1" user="a">
+      <nd ref="5"/>
+      <nd ref="6"/>
+      <tag k="highway" v="primary"/>
+    </way>
+  </modify>
+  <create>
+    <node id="10" version="1" timestamp="2020-09-01T00:01:00Z" changeset="2" uid="1" user="a"
+      lat="0.5" lon="0.5"/>
+    <node id="11" version="1" timestamp="2020-09-01T00:01:00Z" changeset="2" uid="1" user="a"
+      lat="40.5" lon="40.5"/>
+    <relation id="2" version="1" timestamp="2020-09-01T00:01:00Z" changeset="2" uid="1"
+      user="a">
+      <member type="way" ref="3" role=""/>
+      <tag k="type" v="route"/>
+    </relation>
+    <relation id="3" version="1" timestamp="2020-09-01T00:01:00Z" changeset="2" uid="1"
+      user="a">
+      <member type="node" ref="1" role=""/>
+      <tag k="type" v="site"/>
+    </relation>
+  </create>
+</osmChange>
+"""
+
+
+def dataset():
+    """ Nodes 1 and 2 of way 1 inside the (0, 0, 1, 1) bbox and the rest far outside """
+    dataset = memory_osmx.Dataset()
+    metadata = memory_osmx.Metadata(1, 1598918400, 1, 1, "a")
+    dataset.locations = {
+        1: (0.2, 0.2, 1),
+        2: (0.3, 0.3, 1),
+        3: (30.0, 30.0, 1),
+        4: (30.1, 30.1, 1),
+        5: (50.0, 50.0, 1),
+        6: (50.1, 50.1, 1),
+    }
+    dataset.ways[1] = memory_osmx.Way([1, 2], ["highway", "path"], metadata)
+    dataset.ways[2] = memory_osmx.Way([3, 4], ["highway", "path"], metadata)
+    dataset.ways[3] = memory_osmx.Way([5, 6], ["highway", "primary"], metadata)
+    dataset.build_indexes()
+    return dataset
+
+
+class CountingRegion(Region):
+    """ Region that counts the points it is asked about """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tested = 0
+
+    def contains(self, lon, lat):
+        self.tested += 1
+        return super().contains(lon, lat)
+
+
+class RegionTest(unittest.TestCase):
+    def test_polygon_with_hole(self):
+        region = Region("square", [SQUARE_WITH_HOLE])
+        self.assertEqual(region.bbox, (0, 0, 4, 4))
+        self.assertTrue(region.contains(0.5, 0.5))
+        self.assertTrue(region.contains(3.5, 2))
+        self.assertFalse(region.contains(2, 2))
+        self.assertFalse(region.contains(5, 2))
+        self.assertFalse(region.contains(2, -0.5))
+
+    def test_multipolygon(self):
+        triangle = [[(10, 10), (12, 10), (10, 12)]]
+        region = Region("two", [SQUARE_WITH_HOLE, triangle])
+        self.assertTrue(region.contains(10.5, 10.5))
+        self.assertFalse(region.contains(11.5, 11.5))
+        self.assertFalse(region.contains(7, 7))
+        self.assertTrue(region.contains(0.5, 3.5))
+
+    def test_bbox(self):
+        region = Region.from_bbox("box", -1, -2, 1, 2)
+        self.assertTrue(region.contains(0, 0))
+        self.assertTrue(region.contains(1, 2))
+        self.assertFalse(region.contains(1.1, 0))
+        self.assertFalse(region.contains(0, -2.1))
+
+    def test_no_coordinates(self):
+        with self.assertRaises(ValueError):
+            Region("empty", [])
+
+
+class RegionIndexTest(unittest.TestCase):
+    def test_only_candidates_are_tested(self):
+        regions = [
+            CountingRegion("square", [SQUARE_WITH_HOLE]),
+            CountingRegion("far", [[[(100, 50), (101, 50), (101, 51)]]]),
+            CountingRegion("big", [[[(-10, -10), (10, -10), (10, 10), (-10, 10)]]]),
+        ]
+        index = RegionIndex(regions, cell_size=1.0)
+        self.assertEqual(index.cells[(0, 0)], [0, 2])
+        self.assertEqual(index.cells[(100, 50)], [1])
+        self.assertNotIn((50, 50), index.cells)
+
+        self.assertEqual(index.matching([(0.5, 0.5)]), {0, 2})
+        self.assertEqual(index.matching([(2.5, 2.5), (None, None)]), {2})
+        self.assertEqual(index.matching([(50.5, 50.5), (100.5, 50.2)]), {1})
+        self.assertEqual(index.matching([(-50, -50)]), set())
+        self.assertEqual([region.tested for region in regions], [2, 1, 2])
+
+    def test_negative_coordinates(self):
+        index = RegionIndex([Region.from_bbox("box", -2.5, -2.5, -1.5, -1.5)])
+        self.assertEqual(sorted(index.cells), [(-3, -3), (-3, -2), (-2, -3), (-2, -2)])
+        self.assertEqual(index.matching([(-2, -2)]), {0})
+
+
+class RegionFilterTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        memory_osmx.register("test_regions_filter.osmx", dataset())
+
+    @classmethod
+    def tearDownClass(cls):
+        memory_osmx.unregister("test_regions_filter.osmx")
+
+    def select(self, *bbox):
+        """ Keys of the actions of OSC that are in a bbox region """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            osc_file = Path(tmpdir) / "change.osc"
+            osc_file.write_text(OSC)
+            actions = read_actions(str(osc_file))
+        txn = memory_osmx.Transaction(memory_osmx.Environment("test_regions_filter.osmx"))
+        index = RegionIndex([Region.from_bbox("box", *bbox)])
+        return sorted(RegionFilter(actions, OsmxLookup(txn), index).run())
+
+    def test_old_locations(self):
+        # Node 1 moves out of the region and node 10 is created in it. Relation 3 is
+        # created with node 1 as a member, which is only outside by then
+        self.assertEqual(self.select(0, 0, 1, 1), [("node", 1), ("node", 10)])
+
+    def test_new_locations(self):
+        # Node 3 and so way 2 move to the region, relation 2 is of way 3 which doesn't
+        self.assertEqual(self.select(30.4, 30.4, 30.6, 30.6), [("node", 3), ("way", 2)])
+
+    def test_way_members(self):
+        # Relation 2 is created with way 3, which is changed but stays where it was
+        self.assertEqual(self.select(49.9, 49.9, 50.05, 50.05), [("relation", 2), ("way", 3)])
+
+
+class RegionalAugmentedDiffsTest(unittest.TestCase):
+    def setUp(self):
+        memory_osmx.register(OSMX_FILE, dataset())
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name)
+        (self.path / "change.osc").write_text(OSC)
+
+    def tearDown(self):
+        memory_osmx.unregister(OSMX_FILE)
+        self.tmpdir.cleanup()
+
+    def test_world_region_is_whole_diff(self):
+        osc_file = str(self.path / "change.osc")
+        augmented_diff(OSMX_FILE, osc_file, str(self.path / "full.xml"))
+        regions = [
+            (Region.from_bbox("world", -180, -90, 180, 90), str(self.path / "world.xml")),
+            (Region.from_bbox("box", 0, 0, 1, 1), str(self.path / "box.ndjson")),
+            (Region.from_bbox("empty", -10, -10, -9, -9), str(self.path / "empty.xml")),
+        ]
+        for processes in (1, 2):
+            regional_augmented_diffs(OSMX_FILE, osc_file, regions, processes=processes)
+            self.assertEqual(
+                (self.path / "world.xml").read_bytes(), (self.path / "full.xml").read_bytes()
+            )
+            lines = [
+                json.loads(line) for line in (self.path / "box.ndjson").read_text().splitlines()
+            ]
+            self.assertEqual(
+                [(line["new"]["type"], line["new"]["id"]) for line in lines[3:]],
+                # Way 1 is only affected by the move of node 1
+                [("node", 1), ("node", 10), ("way", 1)],
+            )
+            empty = (self.path / "empty.xml").read_text()
+            self.assertIn("<meta", empty)
+            self.assertNotIn("<action", empty)
+
+
+class LoadRegionsTest(unittest.TestCase):
+    def load(self, features):
+        with tempfile.NamedTemporaryFile("w", suffix=".geojson") as f:
+            json.dump({"type": "FeatureCollection", "features": features}, f)
+            f.flush()
+            return load_regions(f.name)
+
+    def test_polygons_and_bbox(self):
+        regions = self.load(
+            [
+                {
+                    "type": "Feature",
+                    "properties": {"name": "square"},
+                    "geometry": {"type": "Polygon", "coordinates": SQUARE_WITH_HOLE},
+                },
+                {
+                    "type": "Feature",
+                    "properties": {"name": "box"},
+                    "bbox": [-1, -2, 1, 2],
+                    "geometry": None,
+                },
+            ]
+        )
+        self.assertEqual([region.name for region in regions], ["square", "box"])
+        self.assertFalse(regions[0].contains(2, 2))
+        self.assertTrue(regions[1].is_bbox)
+        self.assertEqual(regions[1].bbox, (-1, -2, 1, 2))
+
+    def test_invalid(self):
+        box = {"type": "Feature", "properties": {"name": "box"}, "bbox": [0, 0, 1, 1]}
+        for features in (
+            [],
+            [box, box],
+            [dict(box, properties={})],
+            [dict(box, bbox=[0, 0, 1])],
+            [dict(box, bbox=None, geometry={"type": "Point", "coordinates": [0, 0]})],
+        ):
+            with self.assertRaises(ValueError):
+                self.load(features)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+""" Tests of the S3 upload sink in app/onramp/s3.py against a stub S3 client
+
+Run with python3 -m pytest tests/test_s3.py, or python3 -m unittest from tests/.
+
+"""
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from onramp import utils  # noqa: E402
+from onramp.s3 import MIN_PART_SIZE, S3Writer  # noqa: E402
+
+
+class StubS3Client:
+    """ The parts of the boto3 S3 client that S3Writer uses, keeping objects in a dict """
+
+    def __init__(self, fail_part=None):
+        self.objects = {}
+        self.calls = []
+        self.uploads = {}
+        # upload_part raises for this part number
+        self.fail_part = fail_part
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.calls.append("put_object")
+        self.objects[(Bucket, Key)] = (Body, kwargs)
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.calls.append("create_multipart_upload")
+        upload_id = "upload-{}".format(len(self.uploads) + 1)
+        self.uploads[upload_id] = {"key": (Bucket, Key), "parts": {}, "args": kwargs}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.calls.append("upload_part")
+        if PartNumber == self.fail_part:
+            raise IOError("Part {} failed".format(PartNumber))
+        self.uploads[UploadId]["parts"][PartNumber] = Body
+        return {"ETag": '"{}"'.format(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.calls.append("complete_multipart_upload")
+        upload = self.uploads.pop(UploadId)
+        parts = upload["parts"]
+        numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+        self.objects[(Bucket, Key)] = (b"".join(parts[n] for n in numbers), upload["args"])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append("abort_multipart_upload")
+        del self.uploads[UploadId]
+
+
+class S3WriterTest(unittest.TestCase):
+    def multipart_writer(self, client):
+        return S3Writer("bucket", "a.xml", "text/xml", part_size=MIN_PART_SIZE, client=client)
+
+    def test_small_body_is_put(self):
+        client = StubS3Client()
+        with S3Writer("bucket", "a.xml.gz", "text/xml", "gzip", client=client) as f:
+            f.write(b"<osm>")
+            f.write(b"</osm>")
+        self.assertEqual(client.calls, ["put_object"])
+        self.assertEqual(
+            client.objects[("bucket", "a.xml.gz")],
+            (b"<osm></osm>", {"ContentType": "text/xml", "ContentEncoding": "gzip"}),
+        )
+
+    def test_multipart_upload(self):
+        client = StubS3Client()
+        chunk = bytes(range(256)) * 4096
+        data = chunk * (3 * MIN_PART_SIZE // len(chunk)) + b"last part"
+        with self.multipart_writer(client) as f:
+            for i in range(0, len(data), 100000):
+                f.write(data[i : i + 100000])  # noqa: E203
+        self.assertEqual(
+            client.calls,
+            ["create_multipart_upload"] + ["upload_part"] * 4 + ["complete_multipart_upload"],
+        )
+        body, args = client.objects[("bucket", "a.xml")]
+        self.assertEqual(body, data)
+        self.assertEqual(args, {"ContentType": "text/xml"})
+        self.assertEqual(client.uploads, {})
+
+    def test_abort_on_error(self):
+        client = StubS3Client()
+        with self.assertRaises(ValueError):
+            with self.multipart_writer(client) as f:
+                f.write(b"x" * (MIN_PART_SIZE + 1))
+                raise ValueError("Diff failed")
+        self.assertEqual(client.calls[-1], "abort_multipart_upload")
+        self.assertEqual(client.uploads, {})
+        self.assertEqual(client.objects, {})
+
+    def test_abort_on_failed_part(self):
+        client = StubS3Client(fail_part=2)
+        with self.assertRaises(IOError):
+            with self.multipart_writer(client) as f:
+                f.write(b"x" * (2 * MIN_PART_SIZE + 1))
+        self.assertEqual(client.calls[-1], "abort_multipart_upload")
+        self.assertEqual(client.uploads, {})
+        self.assertEqual(client.objects, {})
+
+
+class WriteAugmentedDiffStatusTest(unittest.TestCase):
+    def test_s3(self):
+        client = StubS3Client()
+        with mock.patch.object(utils, "get_client", return_value=client):
+            utils.write_augmented_diff_status("s3://bucket/adiffs/", 4300000)
+        self.assertEqual(
+            client.objects[("bucket", "adiffs/status.txt")],
+            (b"4300000", {"ContentType": "text/plain"}),
+        )
+
+    def test_local(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            utils.write_augmented_diff_status(tmpdir, 4300000)
+            self.assertEqual((Path(tmpdir) / "status.txt").read_text(), "4300000")
+
+
+if __name__ == "__main__":
+    unittest.main()
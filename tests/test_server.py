@@ -0,0 +1,276 @@
+""" Tests of the replication server clients in app/server.py
+
+Run with python3 -m pytest tests/test_server.py, or python3 -m unittest from tests/.
+
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import random
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.error
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from server import (  # noqa: E402
+    AsyncReplicationServer,
+    OsmosisState,
+    ReplicationServer,
+    StateCache,
+)
+
+START = datetime(2020, 9, 1, tzinfo=timezone.utc)
+
+
+class FakeStateServer(ReplicationServer):
+    """ ReplicationServer whose state files are a dict of sequence > timestamp """
+
+    def __init__(self, timestamps, state_cache=None):
+        super().__init__("http://localhost/replication", state_cache=state_cache)
+        self.timestamps = timestamps
+        self.requested = []
+
+    def get_state_info(self, seq=None):
+        if seq is not None and self.cache is not None and self.cache.get(seq) is not None:
+            return self.cache.get(seq)
+        self.requested.append(seq)
+        if seq is None:
+            seq = max(self.timestamps)
+        if seq not in self.timestamps:
+            return None
+        state = OsmosisState(sequence=seq, timestamp=self.timestamps[seq])
+        if self.cache is not None:
+            self.cache.put(state)
+        return state
+
+
+def minutely(sequences):
+    return {seq: START + timedelta(minutes=seq) for seq in sequences}
+
+
+class ReplicationHandler(BaseHTTPRequestHandler):
+    """ Serves server.files, a dict of path > body, after answering server.errors[path]
+    statuses one request at a time. Paths that aren't in files are 404s.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        errors = self.server.errors.get(self.path)
+        if errors:
+            self.respond(errors.pop(0), b"error")
+        elif self.path in self.server.files:
+            self.respond(200, self.server.files[self.path])
+        else:
+            self.respond(404, b"not found")
+
+    def respond(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def state_file(seq):
+    timestamp = (START + timedelta(minutes=seq)).strftime("%Y-%m-%dT%H\\:%M\\:%SZ")
+    return "sequenceNumber={}\ntimestamp={}\n".format(seq, timestamp).encode("utf-8")
+
+
+class AsyncTimestampToSequenceTest(unittest.TestCase):
+    def async_search(self, server, timestamp, **kwargs):
+        client = AsyncReplicationServer(server)
+        try:
+            return asyncio.run(client.timestamp_to_sequence(timestamp, **kwargs))
+        finally:
+            client.close()
+
+    def test_leading_sequences_missing(self):
+        server = FakeStateServer(minutely(range(88, 101)))
+        timestamp = START + timedelta(minutes=89, seconds=30)
+        self.assertEqual(server.timestamp_to_sequence(timestamp), 89)
+        self.assertEqual(self.async_search(server, timestamp), 89)
+
+    def test_matches_serial_search(self):
+        rng = random.Random(1)
+        for _ in range(200):
+            latest = rng.randint(2, 300)
+            first = rng.randint(0, latest - 1)
+            server = FakeStateServer(minutely(range(first, latest + 1)))
+            timestamp = START + timedelta(minutes=rng.uniform(first, latest + 1))
+            for balanced_search in (False, True):
+                self.assertEqual(
+                    self.async_search(server, timestamp, balanced_search=balanced_search),
+                    server.timestamp_to_sequence(timestamp, balanced_search=balanced_search),
+                    "sequences {}..{}, timestamp {}".format(first, latest, timestamp),
+                )
+
+    def test_missing_sequences(self):
+        # The serial search can overshoot gaps, so this checks against the last state
+        # before timestamp instead
+        rng = random.Random(2)
+        for _ in range(300):
+            latest = rng.randint(2, 300)
+            first = rng.randint(0, latest - 1)
+            sequences = [
+                seq
+                for seq in range(first, latest + 1)
+                if seq in (first, latest) or rng.random() > 0.2
+            ]
+            server = FakeStateServer(minutely(sequences))
+            timestamp = START + timedelta(minutes=rng.uniform(first, latest + 1))
+            before = [seq for seq in sequences if server.timestamps[seq] < timestamp]
+            if timestamp >= server.timestamps[latest]:
+                expected = latest
+            else:
+                expected = before[-1] if before else first
+            for balanced_search in (False, True):
+                self.assertEqual(
+                    self.async_search(server, timestamp, balanced_search=balanced_search),
+                    expected,
+                    "sequences {}, timestamp {}".format(sequences, timestamp),
+                )
+
+
+class StateCacheTest(unittest.TestCase):
+    URL = "http://localhost/replication"
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name) / "states.txt"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def state(self, seq):
+        return OsmosisState(seq, START + timedelta(minutes=seq))
+
+    def test_missing_file(self):
+        cache = StateCache(str(self.path), self.URL)
+        self.assertEqual(self.path.read_text(), "# {}\n".format(self.URL))
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.bracket(START), (None, None))
+
+    def test_put_and_load(self):
+        cache = StateCache(str(self.path), self.URL)
+        for seq in (30, 10, 20, 10):
+            cache.put(self.state(seq))
+        cache.put(OsmosisState(40, None))
+        self.assertEqual(self.path.read_text().count("\n"), 4)
+
+        loaded = StateCache(str(self.path), self.URL)
+        self.assertEqual(loaded.sequences, [10, 20, 30])
+        self.assertEqual(loaded.timestamps, [self.state(seq).timestamp for seq in (10, 20, 30)])
+        self.assertEqual(loaded.get(20), self.state(20))
+        self.assertIsNone(loaded.get(40))
+
+    def test_bracket(self):
+        cache = StateCache(str(self.path), self.URL)
+        for seq in (10, 20, 30):
+            cache.put(self.state(seq))
+        minute = timedelta(minutes=1)
+        for timestamp, expected in (
+            (START, (None, 10)),
+            (START + 10 * minute, (None, 10)),
+            (START + 15 * minute, (10, 20)),
+            (START + 20 * minute, (10, 20)),
+            (START + 20 * minute + timedelta(seconds=1), (20, 30)),
+            (START + 31 * minute, (30, None)),
+        ):
+            lower, upper = cache.bracket(timestamp)
+            self.assertEqual(
+                (lower and lower.sequence, upper and upper.sequence), expected, timestamp
+            )
+
+    def test_corrupt_lines(self):
+        self.path.write_bytes(
+            "# {}\n10 2020-09-01T00:10:00Z\nabc 2020-09-01T00:11:00Z\n".format(self.URL).encode()
+            + b"\xff\xfe\n12\n10 2020-09-01T00:10:00Z\n20 2020-09-01T00:2"
+        )
+        cache = StateCache(str(self.path), self.URL)
+        self.assertEqual(cache.sequences, [10])
+        self.assertEqual(cache.get(10), self.state(10))
+
+    def test_other_server(self):
+        self.path.write_text("# http://elsewhere/\n10 2020-09-01T00:10:00Z\n")
+        cache = StateCache(str(self.path), self.URL)
+        self.assertEqual(cache.sequences, [])
+        self.assertEqual(self.path.read_text(), "# {}\n".format(self.URL))
+
+    def test_search_starts_from_cached_states(self):
+        timestamps = minutely(range(0, 1001))
+        timestamp = START + timedelta(minutes=500, seconds=30)
+        server = FakeStateServer(timestamps, state_cache=str(self.path))
+        for seq in (490, 510):
+            server.cache.put(self.state(seq))
+        self.assertEqual(server.timestamp_to_sequence(timestamp), 500)
+        # Only the latest state and ones between the cached states are downloaded
+        self.assertIsNone(server.requested[0])
+        self.assertTrue(all(490 < seq < 510 for seq in server.requested[1:]), server.requested)
+
+        server = FakeStateServer(timestamps, state_cache=str(self.path))
+        self.assertIn(500, server.cache.states)
+        client = AsyncReplicationServer(server)
+        try:
+            self.assertEqual(asyncio.run(client.timestamp_to_sequence(timestamp)), 500)
+        finally:
+            client.close()
+        # The states of the first search were all cached
+        self.assertEqual(server.requested, [None])
+
+    def test_search_between_adjacent_cached_states(self):
+        server = FakeStateServer(minutely(range(0, 1001)), state_cache=str(self.path))
+        for seq in (499, 500):
+            server.cache.put(self.state(seq))
+        timestamp = START + timedelta(minutes=499, seconds=30)
+        self.assertEqual(server.timestamp_to_sequence(timestamp), 499)
+        self.assertEqual(server.requested, [None])
+
+
+class ReplicationServerRetryTest(unittest.TestCase):
+    """ ReplicationServer against a local http.server stand-in for a replication server """
+
+    def setUp(self):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), ReplicationHandler)
+        self.httpd.files = {"/replication/000/000/042.state.txt": state_file(42)}
+        self.httpd.errors = {}
+        self.httpd.requests = []
+        thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        thread.start()
+        url = "http://127.0.0.1:{}/replication".format(self.httpd.server_address[1])
+        self.server = ReplicationServer(url, timeout=5, retries=2, backoff=0.01)
+
+    def tearDown(self):
+        self.server.close()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def test_server_error_is_retried(self):
+        self.httpd.errors["/replication/000/000/042.state.txt"] = [503, 500]
+        state = self.server.get_state_info(42)
+        self.assertEqual(state, OsmosisState(42, START + timedelta(minutes=42)))
+        self.assertEqual(len(self.httpd.requests), 3)
+        self.assertEqual(self.server.stats["retries"], 2)
+
+    def test_retries_used_up(self):
+        self.httpd.errors["/replication/000/000/042.state.txt"] = [503, 502, 500]
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            self.server.get_state_info(42)
+        self.assertEqual(raised.exception.code, 500)
+        self.assertEqual(len(self.httpd.requests), 3)
+
+    def test_missing_state_file(self):
+        self.assertIsNone(self.server.get_state_info(43))
+        self.assertEqual(len(self.httpd.requests), 1)
+        self.assertEqual(self.server.stats["retries"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,318 @@
+""" Tests of the comparison of onramp and Overpass augmented diffs in tests/validate.py
+
+Run with python3 -m pytest tests/test_validate.py, or python3 -m unittest from tests/.
+
+"""
+import argparse
+import gzip
+import json
+from pathlib import Path
+import tempfile
+import unittest
+
+from validate import (
+    batch_report,
+    compare,
+    compare_sequence,
+    different_elements,
+    read_diff,
+    report_differences,
+    run_batch,
+    sequence_path,
+)
+
+ONRAMP = """<?xml version='1.0' encoding='UTF-8'?>
+<osm version="0.6" generator="onramp">
+  <note>note</note>
+  <meta osm_base="2020-09-01T00:01:00Z" />
+  <action type="create">
+    <node id="1" version="1" lat="1.0000000" lon="2.0000000">
+      <tag k="amenity" v="cafe" />
+    </node>
+  </action>
+  <action type="modify">
+    <old>
+      <way id="2" version="1">
+        <nd ref="1" />
+        <nd ref="3" />
+        <tag k="highway" v="path" />
+        <tag k="name" v="A" />
+      </way>
+    </old>
+    <new>
+      <way id="2" version="2">
+        <nd ref="1" />
+        <nd ref="3" />
+        <tag k="highway" v="path" />
+        <tag k="name" v="B" />
+      </way>
+    </new>
+  </action>
+  <action type="delete">
+    <old>
+      <node id="4" version="1" lat="1.0000000" lon="2.0000000" />
+    </old>
+    <new>
+      <node id="4" version="2" visible="false" />
+    </new>
+  </action>
+  <action type="create">
+    <node id="1" version="1" lat="1.0000000" lon="2.0000000">
+      <tag k="amenity" v="cafe" />
+    </node>
+  </action>
+</osm>
+"""
+
+# The same as ONRAMP without its duplicate and with compact formatting and attributes in
+# another order, except that way 2 has its tags in another order, node 4 is deleted
+# with another version and there is a relation that onramp doesn't have
+OVERPASS = """<osm version="0.6" generator="Overpass API">
+<note>note</note>
+<meta osm_base="2020-09-01T00:01:00Z"/>
+<action type="create"><node id="1" lon="2.0000000" lat="1.0000000" version="1"><tag k="amenity"
+ v="cafe"/></node></action>
+<action type="modify"><old><way id="2" version="1"><nd ref="1"/><nd ref="3"/><tag k="highway"
+ v="path"/><tag k="name" v="A"/></way></old><new><way id="2" version="2"><nd ref="1"/><nd
+ ref="3"/><tag k="name" v="B"/><tag k="highway" v="path"/></way></new></action>
+<action type="delete"><old><node id="4" version="1" lat="1.0000000" lon="2.0000000"/></old><new>
+<node id="4" version="3" visible="false"/></new></action>
+<action type="create"><relation id="5" version="1"><member type="node" ref="1" role=""/>
+</relation></action>
+</osm>
+"""
+
+WAY_OLD = ("modify", "old", "way", "2", "1")
+WAY_NEW = ("modify", "new", "way", "2", "2")
+NODE_CREATE = ("create", "new", "node", "1", "1")
+
+
+def write(path, text, compress=False):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(gzip.compress(text.encode()) if compress else text.encode())
+    return path
+
+
+class ReadDiffTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_keys(self):
+        for compress in (False, True):
+            onramp = write(self.path / "onramp.xml", ONRAMP, compress=compress)
+            keys, digests = read_diff(onramp)
+            self.assertEqual(
+                keys,
+                [
+                    NODE_CREATE,
+                    WAY_OLD,
+                    WAY_NEW,
+                    ("delete", "old", "node", "4", "1"),
+                    ("delete", "new", "node", "4", "2"),
+                    NODE_CREATE,
+                ],
+            )
+            self.assertEqual(set(digests), set(keys))
+
+    def test_keep(self):
+        onramp = write(self.path / "onramp.xml", ONRAMP)
+        fields = read_diff(onramp, keep={WAY_NEW, ("create", "new", "node", "9", "1")})
+        self.assertEqual(list(fields), [WAY_NEW])
+        self.assertEqual(fields[WAY_NEW]["@id"], "2")
+        self.assertEqual(
+            fields[WAY_NEW]["tag"],
+            (
+                ("tag", (("k", "highway"), ("v", "path")), "", ()),
+                ("tag", (("k", "name"), ("v", "B")), "", ()),
+            ),
+        )
+        self.assertEqual(len(fields[WAY_NEW]["nd"]), 2)
+
+    def test_formatting_and_attribute_order_are_ignored(self):
+        onramp = write(self.path / "onramp.xml", ONRAMP)
+        overpass = write(self.path / "overpass.xml", OVERPASS)
+        _, onramp_digests = read_diff(onramp)
+        _, overpass_digests = read_diff(overpass)
+        self.assertEqual(onramp_digests[NODE_CREATE], overpass_digests[NODE_CREATE])
+        self.assertEqual(onramp_digests[WAY_OLD], overpass_digests[WAY_OLD])
+
+    def test_tag_order_and_repeated_keys(self):
+        a = 'k="a" v="1"'
+        b = 'k="b" v="2"'
+        digests = []
+        for tags in ((a, b), (b, a), (a, b, b)):
+            action = '<action type="create"><node id="1" version="1">{}</node></action>'.format(
+                "".join("<tag {} />".format(tag) for tag in tags)
+            )
+            path = write(self.path / "tags.xml", "<osm>{}</osm>".format(action))
+            digests.append(read_diff(path)[1][NODE_CREATE])
+        self.assertEqual(len(set(digests)), 3)
+
+
+class CompareTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name)
+        self.onramp = write(self.path / "onramp.xml.gz", ONRAMP, compress=True)
+        self.overpass = write(self.path / "overpass.xml", OVERPASS)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_summary(self):
+        results, onramp_digests, overpass_digests = compare(self.onramp, self.overpass)
+        self.assertEqual(results["both"], {"count": 4})
+        self.assertEqual(
+            results["onramp"],
+            {"count": 5, "is_subset": False, "difference_count": 1, "duplicates": [NODE_CREATE]},
+        )
+        self.assertEqual(
+            results["overpass"],
+            {"count": 6, "is_subset": False, "difference_count": 2, "duplicates": []},
+        )
+        self.assertEqual(different_elements(onramp_digests, overpass_digests), [WAY_NEW])
+
+    def test_report_differences(self):
+        report = report_differences(self.onramp, self.overpass, [WAY_NEW])
+        self.assertEqual(len(report), 1)
+        self.assertEqual(report[0]["element"], list(WAY_NEW))
+        self.assertEqual(
+            report[0]["fields"],
+            {
+                "tag": {
+                    "onramp_count": 2,
+                    "overpass_count": 2,
+                    "first_difference": 0,
+                    "onramp": {"k": "highway", "v": "path"},
+                    "overpass": {"k": "name", "v": "B"},
+                }
+            },
+        )
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name)
+        self.onramp_dir = self.path / "onramp"
+        self.overpass_dir = self.path / "overpass"
+        # 4300000 and 4300001 have both diffs, 4300002 only an onramp one, and the
+        # Overpass diff of 4300003 is truncated
+        for sequence in range(4300000, 4300004):
+            write(sequence_path(self.onramp_dir, sequence), ONRAMP, compress=True)
+        for sequence in (4300000, 4300001):
+            write(self.overpass_dir / "{}.xml".format(sequence), OVERPASS)
+        write(self.overpass_dir / "4300003.xml", OVERPASS[:200])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_sequence_path(self):
+        self.assertEqual(sequence_path("a", 4300001), Path("a/004/300/001.xml.gz"))
+        self.assertEqual(sequence_path("", 12, suffix=""), Path("000/000/012"))
+
+    def test_compare_sequence(self):
+        result = compare_sequence(
+            4300000, self.onramp_dir, self.overpass_dir, "{sequence}.xml", detailed=True
+        )
+        self.assertEqual(
+            result["both"], {"count": 4, "different_count": 1, "different": [list(WAY_NEW)]}
+        )
+        self.assertGreater(result["bytes"], 0)
+
+        result = compare_sequence(
+            4300000, self.onramp_dir, self.onramp_dir, "{path}.xml.gz", detailed=False
+        )
+        self.assertEqual(result["both"], {"count": 5})
+        self.assertTrue(result["onramp"]["is_subset"])
+
+        result = compare_sequence(
+            4300002, self.onramp_dir, self.overpass_dir, "{sequence}.xml", detailed=False
+        )
+        self.assertEqual(result["missing"], [str(self.overpass_dir / "4300002.xml")])
+
+        result = compare_sequence(
+            4300003, self.onramp_dir, self.overpass_dir, "{sequence}.xml", detailed=False
+        )
+        self.assertTrue(result["error"].startswith("ParseError"))
+
+    def test_run_batch(self):
+        report_file = self.path / "report.json"
+        args = argparse.Namespace(
+            first=4300000,
+            last=4300004,
+            processes=2,
+            onramp_dir=self.onramp_dir,
+            overpass_dir=self.overpass_dir,
+            overpass_name="{sequence}.xml",
+            detailed=True,
+            report=str(report_file),
+        )
+        run_batch(args)
+        report = json.loads(report_file.read_text())
+        sequences = report["sequences"]
+        self.assertEqual(sequences["compared"], 2)
+        self.assertEqual((sequences["first"], sequences["last"]), (4300000, 4300004))
+        self.assertEqual(sorted(sequences["missing"]), ["4300002", "4300004"])
+        self.assertEqual(list(sequences["errors"]), ["4300003"])
+        self.assertEqual(
+            report["both"],
+            {
+                "count": 8,
+                "different_count": 2,
+                "different": {"4300000": [list(WAY_NEW)], "4300001": [list(WAY_NEW)]},
+            },
+        )
+        self.assertEqual(report["onramp"]["count"], 10)
+        self.assertEqual(report["onramp"]["difference_count"], 2)
+        self.assertEqual(report["onramp"]["not_subset"], [4300000, 4300001])
+        self.assertEqual(
+            report["onramp"]["duplicates"],
+            {"4300000": [list(NODE_CREATE)], "4300001": [list(NODE_CREATE)]},
+        )
+        self.assertEqual(report["overpass"]["duplicates"], {})
+        self.assertEqual(report["throughput"]["processes"], 2)
+        self.assertGreater(report["throughput"]["elements_per_second"], 0)
+
+    def test_batch_report(self):
+        counts = {"count": 3, "is_subset": True, "difference_count": 0, "duplicates": []}
+        results = [
+            {"sequence": 1, "missing": ["a"]},
+            {"sequence": 2, "error": "ParseError: no element found"},
+            {
+                "sequence": 3,
+                "both": {"count": 3},
+                "onramp": counts,
+                "overpass": dict(counts, count=4, is_subset=False, difference_count=1),
+                "seconds": 0.5,
+                "bytes": 2000000,
+            },
+        ]
+        report = batch_report(results, 2.0, 4)
+        self.assertEqual(
+            report["sequences"],
+            {"compared": 1, "missing": {1: ["a"]}, "errors": {2: results[1]["error"]}},
+        )
+        self.assertEqual(report["both"], {"count": 3})
+        self.assertEqual(report["overpass"]["not_subset"], [3])
+        self.assertEqual(report["onramp"]["not_subset"], [])
+        self.assertEqual(
+            report["throughput"],
+            {
+                "processes": 4,
+                "seconds": 2.0,
+                "compare_seconds": 0.5,
+                "sequences_per_second": 0.5,
+                "elements_per_second": 4,
+                "megabytes_per_second": 1.0,
+            },
+        )
+        self.assertIsNone(batch_report([], 0, 1)["throughput"]["sequences_per_second"])
+
+
+if __name__ == "__main__":
+    unittest.main()
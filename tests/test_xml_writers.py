@@ -0,0 +1,152 @@
+""" Tests of the output writers in app/onramp/xml_writers.py
+
+Run with python3 -m pytest tests/test_xml_writers.py, or python3 -m unittest from tests/.
+
+"""
+import gzip
+import io
+import json
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from onramp.model import DiffAction, OsmElement, SerializedActions  # noqa: E402
+from onramp.xml_writers import (  # noqa: E402
+    BackgroundTreeWriter,
+    NdjsonTree,
+    StreamingTree,
+    write_xml,
+)
+
+
+def read(path):
+    data = path.read_bytes()
+    return gzip.decompress(data) if path.suffix == ".gz" else data
+
+
+def actions(count):
+    return ['<action type="create" n="{}" />'.format(i) for i in range(count)]
+
+
+def way(version, nds, tags):
+    elem = OsmElement("way", 7, attrs=("id", "version"))
+    elem.version = version
+    elem.nds = nds
+    elem.tags = tags
+    return elem
+
+
+class NdjsonTreeTest(unittest.TestCase):
+    def test_lines(self):
+        root = ET.Element("osm", {"version": "0.6", "generator": "test"})
+        note = ET.Element("note")
+        note.text = "note"
+        meta = ET.SubElement(ET.Element("x"), "meta", {"osm_base": "2020-09-01T00:01:00Z"})
+        modify = DiffAction("modify", way(1, [1, 2], [("highway", "path")]), way(2, [1], []))
+        create = DiffAction("create", None, way(1, [3], [("name", 'a "b"\n')]))
+        serialized = SerializedActions([json.dumps(create.to_json())] * 2)
+        fp = io.BytesIO()
+        NdjsonTree(StreamingTree(root, [note, meta, modify, serialized])).write(fp)
+
+        lines = fp.getvalue().decode("utf-8").split("\n")
+        self.assertEqual(lines[-1], "")
+        objs = [json.loads(line) for line in lines[:-1]]
+        self.assertEqual(
+            objs[:3],
+            [
+                {"type": "osm", "version": "0.6", "generator": "test"},
+                {"type": "note", "text": "note"},
+                {"type": "meta", "osm_base": "2020-09-01T00:01:00Z"},
+            ],
+        )
+        self.assertEqual(
+            objs[3],
+            {
+                "type": "action",
+                "action": "modify",
+                "old": {
+                    "type": "way",
+                    "id": 7,
+                    "version": 1,
+                    "nodes": [1, 2],
+                    "tags": {"highway": "path"},
+                },
+                "new": {"type": "way", "id": 7, "version": 2, "nodes": [1], "tags": {}},
+            },
+        )
+        self.assertEqual(objs[4:], [create.to_json()] * 2)
+        self.assertEqual(objs[4]["new"]["tags"], {"name": 'a "b"\n'})
+        self.assertNotIn("old", objs[4])
+
+    def test_element_tree(self):
+        root = ET.Element("osm")
+        ET.SubElement(root, "note").text = "note"
+        fp = io.BytesIO()
+        NdjsonTree(ET.ElementTree(root)).write(fp)
+        self.assertEqual(
+            [json.loads(line) for line in fp.getvalue().splitlines()],
+            [{"type": "osm"}, {"type": "note", "text": "note"}],
+        )
+
+
+class BackgroundTreeWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name)
+        self.root = ET.Element("osm", {"version": "0.6"})
+        self.note = ET.Element("note")
+        self.note.text = "note"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_same_as_write_xml(self):
+        for output_name in ("a.xml", "a.xml.gz", "a.ndjson"):
+            expected = self.path / ("expected-" + output_name)
+            write_xml(
+                StreamingTree(self.root, [self.note, SerializedActions(actions(50))]),
+                str(expected),
+            )
+            output = self.path / output_name
+            with BackgroundTreeWriter(self.root, [self.note], str(output), queue_size=2) as w:
+                for i in range(0, 50, 7):
+                    w.put(SerializedActions(actions(50)[i : i + 7]))  # noqa: E203
+            self.assertEqual(w.close(), output.stat().st_size)
+            self.assertEqual(read(output), read(expected))
+
+    def test_no_children(self):
+        output = self.path / "empty.xml"
+        with BackgroundTreeWriter(self.root, [self.note], str(output)):
+            pass
+        expected = self.path / "expected.xml"
+        write_xml(StreamingTree(self.root, [self.note]), str(expected))
+        self.assertEqual(output.read_bytes(), expected.read_bytes())
+
+    def test_abort(self):
+        writer = BackgroundTreeWriter(self.root, [], str(self.path / "a.xml"), queue_size=1)
+        writer.put(SerializedActions(actions(1)))
+        writer.abort(ValueError("Diff failed"))
+        self.assertFalse(writer.thread.is_alive())
+        with self.assertRaises(ValueError):
+            writer.close()
+
+    def test_write_error(self):
+        # The output directory is a file, so the writer fails before taking any children
+        (self.path / "file").write_text("")
+        output_file = str(self.path / "file" / "a.xml")
+        writer = BackgroundTreeWriter(self.root, [], output_file, queue_size=1)
+        for _ in range(5):
+            try:
+                writer.put(SerializedActions(actions(1)))
+            except OSError:
+                break
+        with self.assertRaises(OSError):
+            writer.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,53 +1,77 @@
 import argparse
 from collections import Counter
+from functools import partial
 import gzip
 import json
+import multiprocessing
+import os
 from pathlib import Path
+import time
 import xml.etree.ElementTree as ET
 
+OSM_TYPES = frozenset(["node", "way", "relation"])
+
 
 def list_duplicates(elements):
     """ Return list of elements that are visible more than once in the input elements. """
     return [item for item, count in Counter(elements).items() if count > 1]
 
 
-def elements_equal(e1, e2):
-    """ Equality comparison for two xml.etree.ElementTree.Element
+def open_diff(path):
+    """ Open an augmented diff for reading, decompressing it if it is gzipped """
+    with open(str(path), "rb") as fp:
+        magic = fp.read(2)
+    if magic == b"\x1f\x8b":
+        return gzip.open(str(path))
+    return open(str(path), "rb")
+
+
+def canonical(e):
+    """ Hashable form of an xml.etree.ElementTree.Element that is equal for equal elements
 
-    From https://stackoverflow.com/a/24349916
+    Attribute order, whitespace around text and tails, which are only indentation in
+    augmented diffs, are ignored. Children are compared in order.
 
     """
-    if e1.tag != e2.tag:
-        return False
-    if (
-        (
-            e1.text is not None
-            and e2.text is not None
-            and e1.text.strip() != e2.text.strip()
-        )
-        or (e1.text is None and e2.text is not None)
-        or (e1.text is not None and e2.text is None)
-    ):
-        return False
-    if (
-        (
-            e1.tail is not None
-            and e2.tail is not None
-            and e1.tail.strip() != e2.tail.strip()
-        )
-        or (e1.tail is None and e2.tail is not None)
-        or (e1.tail is not None and e2.tail is None)
-    ):
-        return False
-    if e1.attrib != e2.attrib:
-        return False
-    if len(e1) != len(e2):
-        return False
-    return all(elements_equal(c1, c2) for c1, c2 in zip(e1, e2))
+    return (
+        e.tag,
+        tuple(sorted(e.items())),
+        (e.text or "").strip(),
+        tuple(map(canonical, e)) if len(e) else (),
+    )
+
+
+def element_fields(e):
+    """ Fields of an osm element, which are compared and reported one by one
+
+    "@name" for each attribute, "text" if the element has text other than whitespace,
+    and the tuple of the canonical form of each kind of child in order, e.g. "nd",
+    "member", "tag" and "bounds". So tags are compared in order, including repeated
+    keys, like the rest of the element. Only the order of the kinds of children relative
+    to each other, e.g. of the nds and the tags of a way, isn't compared.
+
+    """
+    fields = {"@" + name: value for name, value in e.attrib.items()}
+    text = (e.text or "").strip()
+    if text:
+        fields["text"] = text
+    children = {}
+    for child in e:
+        children.setdefault(child.tag, []).append(canonical(child))
+    for tag, values in children.items():
+        fields[tag] = tuple(values)
+    return fields
 
 
-def elements_from_root(root_element):
-    """ Retrieve list of unique tuples for each element
+def fields_digest(fields):
+    """ Digest of element_fields, only comparable within one process """
+    return hash(tuple(sorted(fields.items())))
+
+
+def read_diff(path, keep=None):
+    """ Index the elements of an augmented diff in one streaming pass
+
+    Each element is keyed by a tuple
 
     (
         "create"|"modify"|"delete",
@@ -57,58 +81,125 @@ def elements_from_root(root_element):
         object_version
     )
 
-    Boy this processing is a pain because create skips the intermediate
-    <old>|<new> element.
+    where create actions, which skip the intermediate <old>|<new> element, count as new.
+
+    Returns (keys, digests): the key of every element in the order they appear,
+    including duplicates, and a dict from each key to the fields_digest of its first
+    element. If keep is a set of keys, returns a dict from each of them that is in the
+    diff to the element_fields of its first element instead.
+
+    """
+    keys = []
+    digests = {}
+    kept = {}
+
+    def add(action_type, container, e):
+        key = (action_type, container, e.tag, e.get("id"), e.get("version"))
+        if keep is not None:
+            if key in keep and key not in kept:
+                kept[key] = element_fields(e)
+            return
+        keys.append(key)
+        if key not in digests:
+            digests[key] = fields_digest(element_fields(e))
+
+    with open_diff(path) as fp:
+        for _, action in ET.iterparse(fp):
+            # Each action is indexed once it is complete, then emptied
+            if action.tag != "action":
+                continue
+            action_type = action.get("type")
+            if action_type is not None:
+                for child in action:
+                    if child.tag in OSM_TYPES:
+                        add(action_type, "new", child)
+                    elif child.tag in ("old", "new"):
+                        for e in child:
+                            if e.tag in OSM_TYPES:
+                                add(action_type, child.tag, e)
+            action.clear()
+    if keep is not None:
+        return kept
+    return keys, digests
+
+
+def describe_child(child):
+    """ Readable form of a canonical child, for reports """
+    tag, attrib, text, children = child
+    description = dict(attrib)
+    if text:
+        description["text"] = text
+    if children:
+        description["children"] = len(children)
+    return description
+
+
+def sequence_difference(onramp_children, overpass_children):
+    """ Lengths of two sequences of canonical children, and their first difference
+
+    If the first different children only differ in their own children, e.g. the nds of
+    a member, the first difference of those is included as "children".
 
     """
-    osm_types = set(["node", "way", "relation"])
+    first = next(
+        (i for i, (a, b) in enumerate(zip(onramp_children, overpass_children)) if a != b),
+        min(len(onramp_children), len(overpass_children)),
+    )
+    onramp_child = onramp_children[first] if first < len(onramp_children) else None
+    overpass_child = overpass_children[first] if first < len(overpass_children) else None
+    difference = {
+        "onramp_count": len(onramp_children),
+        "overpass_count": len(overpass_children),
+        "first_difference": first,
+        "onramp": describe_child(onramp_child) if onramp_child is not None else None,
+        "overpass": describe_child(overpass_child) if overpass_child is not None else None,
+    }
+    if (
+        onramp_child is not None
+        and overpass_child is not None
+        and onramp_child[:3] == overpass_child[:3]
+    ):
+        difference["children"] = sequence_difference(onramp_child[3], overpass_child[3])
+    return difference
 
-    elements = []
-    for action in root_element:
-        action_type = action.get("type")
-        if action_type is None:
+
+def field_differences(onramp_fields, overpass_fields):
+    """ Dict of each field that differs between two elements to how it differs
+
+    Sequences of children are reported by their lengths and first difference.
+
+    """
+    differences = {}
+    for name in sorted(set(onramp_fields) | set(overpass_fields)):
+        onramp_value = onramp_fields.get(name)
+        overpass_value = overpass_fields.get(name)
+        if onramp_value == overpass_value:
             continue
+        if isinstance(onramp_value, tuple) or isinstance(overpass_value, tuple):
+            differences[name] = sequence_difference(onramp_value or (), overpass_value or ())
+        else:
+            differences[name] = {"onramp": onramp_value, "overpass": overpass_value}
+    return differences
 
-        new = action.find("new")
-        old = action.find("old")
-        if new is not None:
-            elements += [
-                (action_type, "new", e.tag, e.get("id"), e.get("version"),)
-                for e in new
-                if e.tag in osm_types
-            ]
-        if old is not None:
-            elements += [
-                (action_type, "old", e.tag, e.get("id"), e.get("version"),)
-                for e in old
-                if e.tag in osm_types
-            ]
-        if new is None and old is None:
-            elements += [
-                (action_type, "new", e.tag, e.get("id"), e.get("version"),)
-                for e in action
-                if e.tag in osm_types
-            ]
-    return elements
 
+def element_sort_key(element):
+    return tuple(str(value) for value in element)
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--onramp-diff", type=str)
-    parser.add_argument("--overpass-diff", type=Path, default=None)
-    parser.add_argument("--detailed", action="store_true")
-    args = parser.parse_args()
 
-    # Load onramp diff from local path
-    with gzip.open(args.onramp_diff) as fp:
-        onramp_root_element = ET.parse(fp).getroot()
-    onramp_elements = elements_from_root(onramp_root_element)
-    onramp_elements_set = set(onramp_elements)
+def compare(onramp_diff, overpass_diff):
+    """ Compare the elements of an onramp and an Overpass augmented diff
+
+    Returns (results, onramp_digests, overpass_digests), where results is the JSON
+    summary of element counts, subsets and duplicates.
+
+    """
+    # Index onramp diff from local path, which may be gzipped
+    onramp_elements, onramp_digests = read_diff(onramp_diff)
+    onramp_elements_set = set(onramp_digests)
 
-    # Open and parse Overpass API augmented diff
-    overpass_root_element = ET.parse(str(args.overpass_diff)).getroot()
-    overpass_elements = elements_from_root(overpass_root_element)
-    overpass_elements_set = set(overpass_elements)
+    # Index Overpass API augmented diff
+    overpass_elements, overpass_digests = read_diff(overpass_diff)
+    overpass_elements_set = set(overpass_digests)
 
     results = {"both": {}, "onramp": {}, "overpass": {}}
     # Set element counts
@@ -138,49 +229,219 @@ def main():
     # List duplicate elements
     results["overpass"]["duplicates"] = list_duplicates(overpass_elements)
 
+    return results, onramp_digests, overpass_digests
+
+
+def different_elements(onramp_digests, overpass_digests):
+    """ Sorted keys of the elements in both diffs that aren't equal """
+    return sorted(
+        (
+            element
+            for element in onramp_digests.keys() & overpass_digests.keys()
+            if onramp_digests[element] != overpass_digests[element]
+        ),
+        key=element_sort_key,
+    )
+
+
+def report_differences(onramp_diff, overpass_diff, elements):
+    """ Field by field differences of elements, read again from both diffs """
+    keep = frozenset(elements)
+    onramp_fields = read_diff(onramp_diff, keep=keep)
+    overpass_fields = read_diff(overpass_diff, keep=keep)
+    return [
+        {
+            "element": list(element),
+            "fields": field_differences(onramp_fields[element], overpass_fields[element]),
+        }
+        for element in elements
+    ]
+
+
+def sequence_path(directory, sequence, suffix=".xml.gz"):
+    """ Path of an augmented diff in the NNN/NNN/NNN layout of osmx-update's output """
+    name = str(sequence).zfill(9)
+    return Path(directory, name[0:3], name[3:6], name[6:9] + suffix)
+
+
+def compare_sequence(sequence, onramp_dir, overpass_dir, overpass_name, detailed):
+    """ Compare the diffs of one sequence in a batch, returns a dict of its results """
+    onramp_diff = sequence_path(onramp_dir, sequence)
+    overpass_diff = Path(
+        overpass_dir,
+        overpass_name.format(sequence=sequence, path=sequence_path("", sequence, suffix="")),
+    )
+    result = {"sequence": sequence}
+    missing = [str(path) for path in (onramp_diff, overpass_diff) if not path.exists()]
+    if missing:
+        result["missing"] = missing
+        return result
+    start = time.perf_counter()
+    try:
+        results, onramp_digests, overpass_digests = compare(onramp_diff, overpass_diff)
+        if detailed:
+            different = different_elements(onramp_digests, overpass_digests)
+            results["both"]["different_count"] = len(different)
+            results["both"]["different"] = [list(element) for element in different[:20]]
+    except (OSError, EOFError, ET.ParseError) as e:
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+        return result
+    result.update(results)
+    result["seconds"] = time.perf_counter() - start
+    result["bytes"] = onramp_diff.stat().st_size + overpass_diff.stat().st_size
+    return result
+
+
+def batch_report(results, seconds, processes):
+    """ Aggregate the results of compare_sequence for a range of sequences """
+    report = {
+        "sequences": {"compared": 0, "missing": {}, "errors": {}},
+        "both": {"count": 0},
+        "onramp": {"count": 0, "difference_count": 0, "not_subset": [], "duplicates": {}},
+        "overpass": {"count": 0, "difference_count": 0, "not_subset": [], "duplicates": {}},
+    }
+    compare_seconds = 0
+    compared_bytes = 0
+    for result in results:
+        sequence = result["sequence"]
+        if "missing" in result:
+            report["sequences"]["missing"][sequence] = result["missing"]
+            continue
+        if "error" in result:
+            report["sequences"]["errors"][sequence] = result["error"]
+            continue
+        report["sequences"]["compared"] += 1
+        report["both"]["count"] += result["both"]["count"]
+        if "different_count" in result["both"]:
+            both = report["both"]
+            both["different_count"] = both.get("different_count", 0) + result["both"][
+                "different_count"
+            ]
+            if result["both"]["different_count"]:
+                both.setdefault("different", {})[sequence] = result["both"]["different"]
+        for source in ("onramp", "overpass"):
+            totals = report[source]
+            totals["count"] += result[source]["count"]
+            totals["difference_count"] += result[source]["difference_count"]
+            if not result[source]["is_subset"]:
+                totals["not_subset"].append(sequence)
+            if result[source]["duplicates"]:
+                totals["duplicates"][sequence] = result[source]["duplicates"]
+        compare_seconds += result["seconds"]
+        compared_bytes += result["bytes"]
+    report["throughput"] = {
+        "processes": processes,
+        "seconds": round(seconds, 3),
+        "compare_seconds": round(compare_seconds, 3),
+        "sequences_per_second": round(report["sequences"]["compared"] / seconds, 3)
+        if seconds
+        else None,
+        "elements_per_second": round(
+            (report["onramp"]["count"] + report["overpass"]["count"]) / seconds
+        )
+        if seconds
+        else None,
+        "megabytes_per_second": round(compared_bytes / 1e6 / seconds, 3) if seconds else None,
+    }
+    return report
+
+
+def run_batch(args):
+    sequences = range(args.first, args.last + 1)
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.processes) as pool:
+        results = pool.map(
+            partial(
+                compare_sequence,
+                onramp_dir=args.onramp_dir,
+                overpass_dir=args.overpass_dir,
+                overpass_name=args.overpass_name,
+                detailed=args.detailed,
+            ),
+            sequences,
+            chunksize=1,
+        )
+    report = batch_report(results, time.perf_counter() - start, args.processes)
+    report["sequences"].update(first=args.first, last=args.last)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.report is not None:
+        with open(args.report, "w") as fp:
+            fp.write(output + "\n")
+    else:
+        print(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare onramp augmented diffs with Overpass augmented diffs, one pair "
+        "with --onramp-diff and --overpass-diff, or a range of sequences with --onramp-dir, "
+        "--overpass-dir, --first and --last."
+    )
+    parser.add_argument("--onramp-diff", type=str)
+    parser.add_argument("--overpass-diff", type=Path, default=None)
+    parser.add_argument("--detailed", action="store_true")
+    parser.add_argument(
+        "--max-reports",
+        type=int,
+        default=20,
+        help="Number of different elements to report field by field with --detailed",
+    )
+    parser.add_argument(
+        "--onramp-dir",
+        type=Path,
+        help="Directory of onramp diffs in the NNN/NNN/NNN.xml.gz layout osmx-update writes",
+    )
+    parser.add_argument("--overpass-dir", type=Path, help="Directory of Overpass diffs")
+    parser.add_argument(
+        "--overpass-name",
+        default="{sequence}.xml",
+        help="Name of the Overpass diff of each sequence in --overpass-dir, formatted with "
+        "{sequence}, the adiff sequence id, and {path}, its NNN/NNN/NNN path without a "
+        "suffix. Default: {sequence}.xml",
+    )
+    parser.add_argument("--first", type=int, help="First adiff sequence id of a batch")
+    parser.add_argument("--last", type=int, help="Last adiff sequence id of a batch")
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes comparing a batch. Default: number of CPUs",
+    )
+    parser.add_argument("--report", help="Write the JSON report of a batch to this file")
+    args = parser.parse_args()
+
+    if args.onramp_dir is not None or args.first is not None:
+        if None in (args.onramp_dir, args.overpass_dir, args.first, args.last):
+            parser.error("--onramp-dir, --overpass-dir, --first and --last are all required")
+        run_batch(args)
+        return
+    if args.onramp_diff is None or args.overpass_diff is None:
+        parser.error("--onramp-diff and --overpass-diff are required")
+
+    results, onramp_digests, overpass_digests = compare(args.onramp_diff, args.overpass_diff)
+
     # Print comparison summary
     print(json.dumps(results, indent=2))
 
-    intersection = onramp_elements_set.intersection(overpass_elements_set)
     if args.detailed:
-        equal_elements = set()
-        different_elements = set()
-        for element in intersection:
-            if element[0] == "create":
-                onramp_element = onramp_root_element.find(
-                    "./action[@type='{}']/{}[@id='{}'][@version='{}']".format(
-                        element[0], element[2], element[3], element[4]
-                    )
-                )
-                overpass_element = overpass_root_element.find(
-                    "./action[@type='{}']/{}[@id='{}'][@version='{}']".format(
-                        element[0], element[2], element[3], element[4]
-                    )
-                )
-            else:
-                onramp_element = onramp_root_element.find(
-                    "./action[@type='{}']/{}/{}[@id='{}'][@version='{}']".format(
-                        *element
-                    )
-                )
-                overpass_element = overpass_root_element.find(
-                    "./action[@type='{}']/{}/{}[@id='{}'][@version='{}']".format(
-                        *element
-                    )
+        different = different_elements(onramp_digests, overpass_digests)
+        print(
+            "{}/{} elements are equal".format(
+                results["both"]["count"] - len(different), results["both"]["count"]
+            )
+        )
+        print("Different: {}".format(different[:20]))
+
+        # Read the fields of the first few different elements again to report them
+        reported = different[: args.max_reports]
+        if reported:
+            print(
+                json.dumps(
+                    report_differences(args.onramp_diff, args.overpass_diff, reported),
+                    indent=2,
                 )
-            if (
-                onramp_element is not None
-                and overpass_element is not None
-                and elements_equal(onramp_element, overpass_element)
-            ):
-                equal_elements.add(element)
-            else:
-                # print(element)
-                different_elements.add(element)
-
-        # print(equal_elements)
-        print("{}/{} elements are equal".format(len(equal_elements), len(intersection)))
-        print("Different: {}".format(list(different_elements)[:20]))
+            )
 
 
 if __name__ == "__main__":